@@ -0,0 +1,254 @@
+"""
+Пакетная генерация путевых листов для всего автопарка
+
+Вход - CSV или JSONL со строками (telegram_id, start_time, odometer).
+Результаты пишутся в папку или ZIP по мере готовности, статус каждой строки - в отчет CSV.
+
+Примеры:
+    python batch.py shift.csv --output out/
+    python batch.py shift.jsonl --output shift.zip --report shift_report.csv --workers 8
+"""
+import argparse
+import csv
+import json
+import logging
+import os
+import sys
+import time
+import zipfile
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from pdf_handler import PDFFiller
+from template_registry import TemplateRegistry
+from render_pool import render_waybill_job
+from image_profiles import DEFAULT_PROFILES, EXTENSIONS, detect_format
+from driver_records import create_driver_records
+from memory_stats import peak_rss_bytes, reset_peak_rss
+
+logger = logging.getLogger(__name__)
+
+BatchRow = namedtuple('BatchRow', ['row_num', 'telegram_id', 'start_time', 'odometer'])
+
+# Результат строки: status - 'ok' или 'error'
+BatchResult = namedtuple('BatchResult', ['row_num', 'telegram_id', 'status', 'output', 'error', 'duration_ms',
+                                         'peak_rss_mb'])
+
+REPORT_COLUMNS = BatchResult._fields
+
+
+def read_rows(path):
+    """
+    Читает строки задания из CSV (с заголовком) или JSONL
+
+    Ожидаемые поля: telegram_id, start_time, odometer.
+    Нечитаемые строки JSONL возвращаются с пустыми полями - ошибка попадет в отчет.
+    """
+    if path.lower().endswith(('.jsonl', '.json', '.ndjson')):
+        with open(path, encoding='utf-8') as f:
+            for row_num, line in enumerate(f, start=1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    record = {}
+                yield BatchRow(
+                    row_num,
+                    str(record.get('telegram_id', '')).strip(),
+                    str(record.get('start_time', '')).strip(),
+                    str(record.get('odometer', '')).strip()
+                )
+    else:
+        with open(path, encoding='utf-8-sig', newline='') as f:
+            for row_num, record in enumerate(csv.DictReader(f), start=1):
+                yield BatchRow(
+                    row_num,
+                    (record.get('telegram_id') or '').strip(),
+                    (record.get('start_time') or '').strip(),
+                    (record.get('odometer') or '').strip()
+                )
+
+
+def _timed_render_job(template_path, start_time, odometer, filler_options, dpi, driver_fields=None):
+    """render_waybill_job с замером времени и пикового RSS внутри воркера"""
+    reset_peak_rss()
+    started = time.perf_counter()
+    image_bytes = render_waybill_job(template_path, start_time, odometer, filler_options, dpi, driver_fields)
+    return image_bytes, (time.perf_counter() - started) * 1000, peak_rss_bytes()
+
+
+class OutputWriter:
+    def __init__(self, output):
+        """Пишет результаты в папку или в ZIP (если путь оканчивается на .zip)"""
+        self.output = output
+        self._zip = None
+        if output.lower().endswith('.zip'):
+            os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+            # JPEG/PNG/WebP уже сжаты - храним без повторного сжатия
+            self._zip = zipfile.ZipFile(output, 'w', compression=zipfile.ZIP_STORED)
+        else:
+            os.makedirs(output, exist_ok=True)
+
+    def write(self, name, data):
+        """Сохраняет файл и возвращает его путь (для ZIP - путь внутри архива)"""
+        if self._zip is not None:
+            self._zip.writestr(name, data)
+            return name
+        path = os.path.join(self.output, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def close(self):
+        if self._zip is not None:
+            self._zip.close()
+            self._zip = None
+
+
+def generate_batch(rows, output, report_path=None, templates_dir='templates', template_registry=None,
+                   filler_options=None, workers=None, dpi=None, pool_kind='process', driver_records=None):
+    """
+    Генерирует путевые листы для всех строк параллельно
+
+    Шаблоны разбираются один раз в каждом воркере (кэш PDFFiller), ошибки отдельных
+    строк не прерывают выполнение.
+
+    Args:
+        rows: Итерируемые BatchRow (см. read_rows)
+        output: Папка или путь к .zip для результатов
+        report_path: Путь к отчету CSV (None - без отчета)
+        templates_dir: Папка с шаблонами (если не передан template_registry)
+        template_registry: Готовый TemplateRegistry
+        filler_options: Параметры PDFFiller (PDFFiller.get_options())
+        workers: Количество воркеров (None - по числу ядер)
+        dpi: Разрешение изображений (None - из профиля изображения в filler_options)
+        pool_kind: 'process' или 'thread'
+        driver_records: Записи водителей на базовых шаблонах (проверяются раньше driver_*.pdf)
+
+    Returns:
+        dict: Сводка {'total', 'ok', 'error', 'elapsed_s'}
+    """
+    if template_registry is None:
+        template_registry = TemplateRegistry(templates_dir, watch='off')
+        template_registry.scan()
+
+    validator = PDFFiller(template_registry=template_registry, driver_records=driver_records)
+    filler_options = filler_options or PDFFiller(render_mode='overlay').get_options()
+    workers = workers or os.cpu_count() or 1
+    executor_class = ProcessPoolExecutor if pool_kind == 'process' else ThreadPoolExecutor
+    # Окно заданий в полете: не держим в памяти результаты всего автопарка сразу
+    max_in_flight = workers * 4
+
+    writer = OutputWriter(output)
+    report_file = open(report_path, 'w', encoding='utf-8', newline='') if report_path else None
+    report = csv.writer(report_file) if report_file else None
+    if report:
+        report.writerow(REPORT_COLUMNS)
+
+    summary = {'total': 0, 'ok': 0, 'error': 0}
+    started = time.perf_counter()
+
+    def record(result):
+        summary['total'] += 1
+        summary[result.status] += 1
+        if report:
+            report.writerow(result)
+        if result.status == 'error':
+            logger.warning(f"Строка {result.row_num} (ID {result.telegram_id}): {result.error}")
+
+    def collect(future, row):
+        try:
+            image_bytes, duration_ms, peak_rss = future.result()
+            extension = EXTENSIONS.get(detect_format(image_bytes), 'bin')
+            name = f"waybill_{row.telegram_id}_{row.row_num}.{extension}"
+            record(BatchResult(row.row_num, row.telegram_id, 'ok', writer.write(name, image_bytes), '',
+                               round(duration_ms, 1), round(peak_rss / 1024 / 1024, 1)))
+        except Exception as e:
+            record(BatchResult(row.row_num, row.telegram_id, 'error', '', f"{type(e).__name__}: {e}", '', ''))
+
+    try:
+        with executor_class(max_workers=workers) as executor:
+            in_flight = {}
+            for row in rows:
+                error = None
+                driver = validator.find_driver(row.telegram_id) if row.telegram_id else None
+                if not row.telegram_id:
+                    error = "не указан telegram_id"
+                elif driver is None:
+                    error = "шаблон не найден"
+                elif not validator.validate_time_format(row.start_time):
+                    error = f"неверный формат времени: '{row.start_time}'"
+                elif not row.odometer.isdigit():
+                    error = f"пробег должен быть числом: '{row.odometer}'"
+                if error:
+                    record(BatchResult(row.row_num, row.telegram_id, 'error', '', error, '', ''))
+                    continue
+
+                future = executor.submit(_timed_render_job, driver.path, row.start_time, row.odometer,
+                                         filler_options, dpi, driver.fields)
+                in_flight[future] = row
+                if len(in_flight) >= max_in_flight:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        collect(future, in_flight.pop(future))
+
+            for future in list(in_flight):
+                collect(future, in_flight.pop(future))
+    finally:
+        writer.close()
+        if report_file:
+            report_file.close()
+
+    summary['elapsed_s'] = round(time.perf_counter() - started, 2)
+    logger.info(
+        f"Пакет обработан: {summary['ok']} успешно, {summary['error']} с ошибками "
+        f"из {summary['total']} за {summary['elapsed_s']} с"
+    )
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Пакетная генерация путевых листов")
+    parser.add_argument('input', help="CSV или JSONL со столбцами telegram_id, start_time, odometer")
+    parser.add_argument('--output', required=True, help="Папка или файл .zip для результатов")
+    parser.add_argument('--report', help="Отчет CSV по строкам (по умолчанию <output>_report.csv)")
+    parser.add_argument('--templates', default='templates', help="Папка с шаблонами")
+    parser.add_argument('--records', default=None,
+                        help="Записи водителей на базовых шаблонах (.json или .sqlite3)")
+    parser.add_argument('--base-dir', default='templates/base', help="Папка с базовыми шаблонами")
+    parser.add_argument('--workers', type=int, default=None, help="Количество воркеров")
+    parser.add_argument('--dpi', type=int, default=None, help="Разрешение (по умолчанию из профиля)")
+    parser.add_argument('--profile', choices=sorted(DEFAULT_PROFILES), default='default',
+                        help="Профиль кодирования изображений")
+    parser.add_argument('--pool', choices=('process', 'thread'), default='process')
+    parser.add_argument('--crop', action='store_true', help="Обрезать пустые поля страниц")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    report_path = args.report or f"{args.output.rstrip('/').rsplit('.zip', 1)[0]}_report.csv"
+
+    driver_records = None
+    if args.records:
+        backend = 'json' if args.records.endswith('.json') else 'sqlite'
+        driver_records = create_driver_records(backend, path=args.records, base_dir=args.base_dir)
+
+    summary = generate_batch(
+        read_rows(args.input),
+        args.output,
+        report_path=report_path,
+        templates_dir=args.templates,
+        filler_options=PDFFiller(render_mode='overlay', image_profile=args.profile,
+                                 crop_to_content=args.crop).get_options(),
+        workers=args.workers,
+        dpi=args.dpi,
+        pool_kind=args.pool,
+        driver_records=driver_records
+    )
+    print(f"Готово: {summary['ok']} из {summary['total']}, ошибок: {summary['error']}, "
+          f"время: {summary['elapsed_s']} с. Отчет: {report_path}")
+    return 0 if summary['error'] == 0 else 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
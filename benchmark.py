@@ -0,0 +1,337 @@
+"""
+Бенчмарк генерации путевых листов на реальных шаблонах из templates/
+
+Примеры:
+    python benchmark.py
+    python benchmark.py --dpi 100 200 --quality 75 95 --iterations 50
+    python benchmark.py --concurrency 1 2 4 8 --json results.json
+    python benchmark.py --stages rasterize --profiles default fast compact webp adaptive
+"""
+import argparse
+import asyncio
+import glob
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime
+from pdf_handler import PDFFiller, HAS_FITZ, HAS_PIL
+from render_pool import RenderPool, render_waybill_job
+from image_profiles import DEFAULT_PROFILES, AdaptiveProfile, get_profile, render_dpi, measure_psnr
+from memory_stats import peak_rss_bytes, reset_peak_rss, children_peak_rss_bytes
+
+if HAS_FITZ:
+    import fitz
+
+logger = logging.getLogger(__name__)
+
+# Этапы генерации: (название, зависит ли от DPI, зависит ли от качества JPEG)
+STAGES = (
+    ('compile', False, False),       # чтение шаблона, поиск полей, удаление виджетов
+    ('fill', False, False),          # впечатывание значений в скомпилированный шаблон
+    ('save', False, False),          # сохранение заполненного PDF в байты
+    ('fill_pdf', False, False),      # публичный fill_pdf с записью файла
+    ('rasterize', True, False),      # рендер страниц в изображение
+    ('encode', True, True),          # кодирование JPEG
+    ('pdf_to_jpg', True, False),     # публичный pdf_to_jpg (открытие файла + рендер + JPEG)
+    ('waybill_full', True, True),    # render_waybill в режиме full
+    ('waybill_overlay', True, True), # render_waybill в режиме overlay
+)
+
+START_TIME = '08:00'
+ODOMETER = '123456'
+
+
+def percentile(samples, p):
+    """Перцентиль по методу ближайшего ранга"""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    rank = max(0, min(len(ordered) - 1, int(round(p / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+
+def summarize(samples):
+    """p50/p95/p99/среднее в миллисекундах"""
+    return {
+        'n': len(samples),
+        'p50_ms': round(percentile(samples, 50) * 1000, 3),
+        'p95_ms': round(percentile(samples, 95) * 1000, 3),
+        'p99_ms': round(percentile(samples, 99) * 1000, 3),
+        'mean_ms': round(sum(samples) / len(samples) * 1000, 3),
+    }
+
+
+def git_commit():
+    """Текущий коммит (для сравнения прогонов), None вне git"""
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class StageBenchmark:
+    def __init__(self, template_path, iterations, work_dir):
+        self.template_path = template_path
+        self.iterations = iterations
+        self.work_dir = work_dir
+        self.filler = PDFFiller()
+        self.entry = self.filler.load_template(template_path)
+        self.values = self.filler.build_field_values(START_TIME, ODOMETER)
+
+    def _filled_doc(self):
+        doc = self.entry.open_document()
+        self.filler.stamp_fields(doc, self.entry.plan, self.values)
+        return doc
+
+    def stage_callable(self, stage, dpi, quality):
+        """Возвращает (подготовка, замеряемая функция) для этапа"""
+        filler = self.filler
+        pdf_path = os.path.join(self.work_dir, 'bench.pdf')
+        jpg_path = os.path.join(self.work_dir, 'bench.jpg')
+
+        if stage == 'compile':
+            return filler.template_cache.clear, lambda: filler.load_template(self.template_path)
+        if stage == 'fill':
+            def fill():
+                self._filled_doc().close()
+            return None, fill
+        if stage == 'save':
+            state = {}
+            def prepare():
+                state['doc'] = self._filled_doc()
+            def save():
+                state['doc'].tobytes()
+                state['doc'].close()
+            return prepare, save
+        if stage == 'fill_pdf':
+            return None, lambda: filler.fill_pdf(START_TIME, ODOMETER, pdf_path, template_path=self.template_path)
+        if stage == 'rasterize':
+            state = {}
+            def prepare():
+                state['doc'] = self._filled_doc()
+            def rasterize():
+                filler._render_document(state['doc'], dpi)
+                state['doc'].close()
+            return prepare, rasterize
+        if stage == 'encode':
+            doc = self._filled_doc()
+            image = filler._render_document(doc, dpi)
+            doc.close()
+            profile = filler.resolve_profile('default', dpi, quality)
+            return None, lambda: filler.encode_image(image, profile, dpi)
+        if stage == 'pdf_to_jpg':
+            def prepare():
+                if not os.path.exists(pdf_path):
+                    filler.fill_pdf(START_TIME, ODOMETER, pdf_path, template_path=self.template_path)
+            return prepare, lambda: filler.pdf_to_jpg(pdf_path, jpg_path, dpi=dpi)
+        if stage in ('waybill_full', 'waybill_overlay'):
+            mode = stage.split('_', 1)[1]
+            return None, lambda: filler.render_waybill(
+                START_TIME, ODOMETER, template_path=self.template_path,
+                dpi=dpi, render_mode=mode, quality=quality
+            )
+        raise ValueError(f"Неизвестный этап: {stage}")
+
+    def run(self, stage, dpi, quality):
+        prepare, func = self.stage_callable(stage, dpi, quality)
+        # Прогрев: кэши шаблона и фона, ленивые инициализации PyMuPDF
+        if prepare:
+            prepare()
+        func()
+
+        reset_supported = reset_peak_rss()
+        samples = []
+        for _ in range(self.iterations):
+            if prepare:
+                prepare()
+            started = time.perf_counter()
+            func()
+            samples.append(time.perf_counter() - started)
+
+        result = summarize(samples)
+        result['peak_rss_mb'] = round(peak_rss_bytes() / 1024 / 1024, 1)
+        result['peak_rss_reset'] = reset_supported
+        return result
+
+    def run_profile(self, name):
+        """Время кодирования, размер и PSNR (относительно рендера) для профиля изображения"""
+        profile = get_profile(name)
+        dpi = render_dpi(profile)
+        doc = self._filled_doc()
+        image = self.filler._render_document(doc, dpi)
+        doc.close()
+        reference = image.convert('L')
+
+        samples = []
+        for _ in range(self.iterations):
+            started = time.perf_counter()
+            data, stats = self.filler.encode_image(image, profile, dpi)
+            samples.append(time.perf_counter() - started)
+
+        result = summarize(samples)
+        result.update({
+            'profile': name,
+            'chosen': stats.profile,
+            'format': stats.format,
+            'dpi': stats.dpi,
+            'size_bytes': stats.size,
+            'psnr_db': round(measure_psnr(reference, data), 2),
+        })
+        if isinstance(profile, AdaptiveProfile):
+            # Время адаптивного режима - полный перебор кандидатов (первый запрос на шаблон)
+            result['adaptive_target_bytes'] = profile.target_bytes
+        return result
+
+
+async def run_concurrency(template_paths, concurrency, jobs, dpi, pool_kind):
+    """Пропускная способность end-to-end через RenderPool при N параллельных заданиях"""
+    pool = RenderPool(kind=pool_kind, max_workers=concurrency, max_queue=jobs, job_timeout=None,
+                      max_jobs_per_worker=None)
+    filler_options = PDFFiller(render_mode='overlay').get_options()
+    try:
+        # Прогрев воркеров: компиляция шаблонов и растров фона
+        await asyncio.gather(*[
+            pool.run(render_waybill_job, path, START_TIME, ODOMETER, filler_options, dpi)
+            for path in template_paths for _ in range(concurrency)
+        ])
+
+        latencies = []
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def one_job(i):
+            async with semaphore:
+                started = time.perf_counter()
+                await pool.run(render_waybill_job, template_paths[i % len(template_paths)],
+                               START_TIME, ODOMETER, filler_options, dpi)
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*[one_job(i) for i in range(jobs)])
+        elapsed = time.perf_counter() - started
+    finally:
+        pool.shutdown(wait=True)
+
+    result = summarize(latencies)
+    result.update({
+        'concurrency': concurrency,
+        'dpi': dpi,
+        'pool': pool_kind,
+        'throughput_per_s': round(jobs / elapsed, 2),
+        'workers_peak_rss_mb': round(children_peak_rss_bytes() / 1024 / 1024, 1) if pool_kind == 'process' else None,
+    })
+    return result
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Бенчмарк генерации путевых листов")
+    parser.add_argument('--templates', nargs='+', default=None,
+                        help="Шаблоны PDF (по умолчанию все templates/*.pdf)")
+    parser.add_argument('--stages', nargs='+', default=[name for name, _, _ in STAGES],
+                        choices=[name for name, _, _ in STAGES])
+    parser.add_argument('--iterations', type=int, default=20, help="Замеров на этап")
+    parser.add_argument('--dpi', type=int, nargs='+', default=[200])
+    parser.add_argument('--quality', type=int, nargs='+', default=[95])
+    parser.add_argument('--profiles', nargs='*', default=sorted(DEFAULT_PROFILES), choices=sorted(DEFAULT_PROFILES),
+                        help="Профили изображения для замера кодирования (пусто - не замерять)")
+    parser.add_argument('--concurrency', type=int, nargs='*', default=[1, os.cpu_count() or 1],
+                        help="Число параллельных заданий для замера пропускной способности")
+    parser.add_argument('--jobs', type=int, default=40, help="Заданий на замер пропускной способности")
+    parser.add_argument('--pool', choices=('process', 'thread'), default='process')
+    parser.add_argument('--json', metavar='PATH', help="Сохранить результаты в JSON ('-' - в stdout)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+
+    if not HAS_FITZ or not HAS_PIL:
+        print("Для бенчмарка нужны PyMuPDF и Pillow")
+        return 1
+
+    template_paths = args.templates or sorted(glob.glob(os.path.join('templates', '*.pdf')))
+    if not template_paths:
+        print("Шаблоны не найдены")
+        return 1
+
+    out = sys.stderr if args.json == '-' else sys.stdout
+    stage_flags = {name: (by_dpi, by_quality) for name, by_dpi, by_quality in STAGES}
+    results = []
+    profile_results = []
+    work_dir = os.path.join(os.getcwd(), '.benchmark_tmp')
+    os.makedirs(work_dir, exist_ok=True)
+    try:
+        print(f"{'этап':<16} {'шаблон':<24} {'dpi':>4} {'q':>3} {'p50':>9} {'p95':>9} {'p99':>9} {'RSS МБ':>8}", file=out)
+        for template_path in template_paths:
+            bench = StageBenchmark(template_path, args.iterations, work_dir)
+            for stage in args.stages:
+                by_dpi, by_quality = stage_flags[stage]
+                for dpi in (args.dpi if by_dpi else [None]):
+                    for quality in (args.quality if by_quality else [None]):
+                        result = bench.run(stage, dpi or args.dpi[0], quality or args.quality[0])
+                        result.update({'stage': stage, 'template': template_path, 'dpi': dpi, 'quality': quality})
+                        results.append(result)
+                        print(f"{stage:<16} {os.path.basename(template_path):<24} {dpi or '-':>4} {quality or '-':>3} "
+                              f"{result['p50_ms']:>9.2f} {result['p95_ms']:>9.2f} {result['p99_ms']:>9.2f} "
+                              f"{result['peak_rss_mb']:>8.1f}", file=out)
+
+        if args.profiles:
+            print(f"\n{'профиль':<12} {'шаблон':<24} {'выбран':<20} {'формат':>6} {'dpi':>4} "
+                  f"{'p50':>9} {'p95':>9} {'байт':>9} {'PSNR':>6}", file=out)
+        for template_path in (template_paths if args.profiles else []):
+            bench = StageBenchmark(template_path, args.iterations, work_dir)
+            for name in args.profiles:
+                result = bench.run_profile(name)
+                result['template'] = template_path
+                profile_results.append(result)
+                print(f"{name:<12} {os.path.basename(template_path):<24} {result['chosen']:<20} "
+                      f"{result['format']:>6} {result['dpi']:>4} {result['p50_ms']:>9.2f} {result['p95_ms']:>9.2f} "
+                      f"{result['size_bytes']:>9} {result['psnr_db']:>6.1f}", file=out)
+    finally:
+        for name in ('bench.pdf', 'bench.jpg'):
+            path = os.path.join(work_dir, name)
+            if os.path.exists(path):
+                os.unlink(path)
+        os.rmdir(work_dir)
+
+    concurrency_results = []
+    for dpi in args.dpi:
+        for concurrency in args.concurrency:
+            result = asyncio.run(run_concurrency(template_paths, concurrency, args.jobs, dpi, args.pool))
+            concurrency_results.append(result)
+            print(f"параллельно {concurrency:>3} ({args.pool}, {dpi} DPI): {result['throughput_per_s']:.2f} заданий/с, "
+                  f"p50 {result['p50_ms']:.1f} мс, p99 {result['p99_ms']:.1f} мс", file=out)
+
+    if args.json:
+        report = {
+            'meta': {
+                'commit': git_commit(),
+                'timestamp': datetime.now().isoformat(timespec='seconds'),
+                'python': platform.python_version(),
+                'pymupdf': fitz.VersionBind,
+                'cpu_count': os.cpu_count(),
+                'iterations': args.iterations,
+            },
+            'stages': results,
+            'profiles': profile_results,
+            'concurrency': concurrency_results,
+        }
+        if args.json == '-':
+            json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+        else:
+            with open(args.json, 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+            print(f"Результаты сохранены: {args.json}", file=out)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
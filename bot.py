@@ -1,59 +1,404 @@
+import asyncio
+import functools
+import io
 import logging
+import time
+import weakref
 from telegram import Update
+from telegram.error import TelegramError
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 from pdf_handler import PDFFiller
-import os
-import tempfile
+from template_registry import TemplateRegistry
+from state_store import create_state_store
+from render_pool import RenderPool, RenderPoolBusy, RenderTimeout, RenderInterrupted
+from render_jobs import RenderScheduler, SchedulerBusy, SpeculativeRenders, WaybillJob, DELIVERY_MODES, execute_archive
+from image_profiles import get_profile
+from driver_records import create_driver_records
+from metrics import REGISTRY, MetricsServer, stage
+from warmup import warm_up, collect_template_paths
+from result_cache import ResultCache
+from waybill_archive import WaybillArchive
+from profiling import ProfilingControl
+from memory_stats import MappedMemory
 try:
     from config import PDF_FONT_NAME, PDF_FONT_SIZE, PDF_FIELD_FONT_SIZES
 except ImportError:
     PDF_FONT_NAME = 'Helvetica'
     PDF_FONT_SIZE = 10
     PDF_FIELD_FONT_SIZES = {}
+try:
+    from config import PDF_FONT_FILE
+except ImportError:
+    PDF_FONT_FILE = None  # TTF/OTF для листов с кириллицей (например DejaVuSans.ttf); остальные - PDF_FONT_NAME
+try:
+    from config import TEMPLATE_CACHE_SIZE, TEMPLATE_CACHE_MAX_BYTES
+except ImportError:
+    TEMPLATE_CACHE_SIZE = 256  # скомпилированных шаблонов на процесс
+    TEMPLATE_CACHE_MAX_BYTES = 256 * 1024 * 1024
+try:
+    from config import SHARED_TEMPLATES_DIR
+except ImportError:
+    # Общий каталог скомпилированных шаблонов для всех процессов хоста (например /dev/shm/taxi_templates):
+    # одна копия шаблона на хост вместо копии в каждом воркере; None - выключено
+    SHARED_TEMPLATES_DIR = None
+try:
+    from config import TEMPLATES_DIR, TEMPLATES_SHARD_DEPTH, TEMPLATES_WATCH, TEMPLATES_POLL_INTERVAL
+except ImportError:
+    TEMPLATES_DIR = 'templates'
+    TEMPLATES_SHARD_DEPTH = 2  # templates/<шард>/<шард>/driver_<id>.pdf
+    TEMPLATES_WATCH = 'auto'  # 'auto', 'inotify', 'poll' или 'off'
+    TEMPLATES_POLL_INTERVAL = 30  # секунд
+try:
+    from config import DRIVER_RECORDS_BACKEND, DRIVER_RECORDS_PATH, BASE_TEMPLATES_DIR
+except ImportError:
+    DRIVER_RECORDS_BACKEND = 'json'  # 'json', 'sqlite' или None - только driver_*.pdf
+    DRIVER_RECORDS_PATH = 'templates/drivers.json'  # создается migrate_templates.py
+    BASE_TEMPLATES_DIR = 'templates/base'
+try:
+    from config import RENDER_MODE, BACKGROUND_CACHE_MAX_BYTES
+except ImportError:
+    RENDER_MODE = 'overlay'  # 'overlay' - кэшированный фон + текст полей, 'full' - полный рендер
+    BACKGROUND_CACHE_MAX_BYTES = 256 * 1024 * 1024
+try:
+    from config import CROP_TO_CONTENT, CROP_MARGIN
+except ImportError:
+    CROP_TO_CONTENT = False  # обрезать пустые поля страниц вокруг содержимого
+    CROP_MARGIN = 12  # отступ от содержимого в пунктах
+try:
+    from config import WAYBILL_DELIVERY, WAYBILL_DELIVERY_DRIVERS, PDF_THUMBNAIL_SIZE
+except ImportError:
+    WAYBILL_DELIVERY = 'photo'  # 'photo' - изображение, 'pdf' - документ без растеризации и JPEG
+    WAYBILL_DELIVERY_DRIVERS = {}  # способ отправки для отдельных водителей: {'telegram_id': 'pdf'}
+    PDF_THUMBNAIL_SIZE = 320  # превью PDF-документа в пикселях (не больше 320); None - без превью
+try:
+    from config import IMAGE_PROFILE, IMAGE_PROFILES
+except ImportError:
+    IMAGE_PROFILE = 'default'  # 'default', 'fast', 'compact', 'gray', 'webp', 'png' или 'adaptive'
+    IMAGE_PROFILES = {}  # свои профили: {'имя': {'format': 'JPEG', 'dpi': 150, 'quality': 80, ...}}
+try:
+    from config import (STATE_BACKEND, STATE_DB_PATH, STATE_CACHE_SIZE, STATE_TTL,
+                        STATE_FLUSH_INTERVAL, STATE_FLUSH_BATCH)
+except ImportError:
+    STATE_BACKEND = 'sqlite'  # 'sqlite' или 'memory'
+    STATE_DB_PATH = 'bot_state.sqlite3'
+    STATE_CACHE_SIZE = 10000  # диалогов в памяти
+    STATE_TTL = 6 * 3600  # секунд без активности до удаления диалога
+    STATE_FLUSH_INTERVAL = 1.0  # секунд
+    STATE_FLUSH_BATCH = 100
+try:
+    from config import (RENDER_POOL_KIND, RENDER_POOL_WORKERS, RENDER_QUEUE_SIZE,
+                        RENDER_JOB_TIMEOUT, RENDER_WORKER_MAX_JOBS)
+except ImportError:
+    RENDER_POOL_KIND = 'process'  # 'process' или 'thread'
+    RENDER_POOL_WORKERS = None  # None - по числу ядер; в режиме вебхука - на все процессы бота, делится между ними
+    RENDER_QUEUE_SIZE = 32
+    RENDER_JOB_TIMEOUT = 30  # секунд
+    RENDER_WORKER_MAX_JOBS = 200
+try:
+    from config import RENDER_MAX_CONCURRENCY, RENDER_MAX_WAITING
+except ImportError:
+    RENDER_MAX_CONCURRENCY = None  # None - по числу воркеров пула
+    RENDER_MAX_WAITING = 32  # заданий в ожидании, сверх - ответ "занято, повторите"
+try:
+    from config import SPECULATIVE_RENDER, SPECULATIVE_TTL, SPECULATIVE_MAX_ITEMS
+except ImportError:
+    SPECULATIVE_RENDER = True  # рендерить все, кроме пробега, пока водитель его вводит
+    SPECULATIVE_TTL = 300  # секунд ожидания пробега, потом заготовка выбрасывается
+    SPECULATIVE_MAX_ITEMS = 32  # заготовок в памяти (растр 200 DPI - около 12 МБ)
+
+try:
+    from config import RESULT_CACHE_TTL, RESULT_CACHE_MAX_ITEMS, RESULT_CACHE_MAX_BYTES
+except ImportError:
+    RESULT_CACHE_TTL = 600  # секунд, в течение которых повтор тех же данных отдает готовый лист; 0 - выкл.
+    RESULT_CACHE_MAX_ITEMS = 1000
+    RESULT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+try:
+    from config import WAYBILL_ARCHIVE_PATH, WAYBILL_HISTORY_LIMIT
+except ImportError:
+    WAYBILL_ARCHIVE_PATH = 'waybills.sqlite3'  # архив выданных листов и номеров; None - без архива
+    WAYBILL_HISTORY_LIMIT = 10  # листов в /history
+try:
+    from config import WARMUP_ENABLED, WARMUP_TIMEOUT
+except ImportError:
+    WARMUP_ENABLED = True  # проверить шаблоны и прогреть воркеры до приема обновлений
+    WARMUP_TIMEOUT = 120  # секунд; дальше бот запускается без полного прогрева
+try:
+    from config import PROFILE_DIR, PROFILE_ADMINS
+except ImportError:
+    PROFILE_DIR = 'profiles'  # профили заданий (см. profiling; включаются WAYBILL_PROFILE_* или /profile)
+    PROFILE_ADMINS = set()  # telegram_id, которым доступна команда /profile
+
+try:
+    from config import METRICS_HOST, METRICS_PORT
+except ImportError:
+    METRICS_HOST = '127.0.0.1'
+    METRICS_PORT = 9108  # GET /metrics; None - без эндпоинта; воркеры вебхука - METRICS_PORT + номер
+
+try:
+    from config import BOT_MODE, BOT_API_BASE_URL, BOT_CONCURRENT_UPDATES
+except ImportError:
+    BOT_MODE = 'polling'  # 'polling' или 'webhook'
+    BOT_API_BASE_URL = None  # None - api.telegram.org; например локальная заглушка Bot API
+    BOT_CONCURRENT_UPDATES = 256  # сколько обновлений обрабатывается одновременно
+try:
+    from config import (WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_URL, WEBHOOK_SECRET,
+                        WEBHOOK_WORKERS)
+except ImportError:
+    WEBHOOK_HOST = '0.0.0.0'
+    WEBHOOK_PORT = 8443
+    WEBHOOK_PATH = '/webhook'
+    WEBHOOK_URL = None  # публичный URL для setWebhook (None - не регистрировать)
+    WEBHOOK_SECRET = None
+    WEBHOOK_WORKERS = 2  # процессов бота за одним портом
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+WAYBILL_READY_CAPTION = "✅ Ваш путевой лист готов!"
+
+
+def serialized_per_user(handler):
+    """
+    Обработчик, который для одного пользователя выполняется строго по очереди
+
+    Обновления разных водителей обрабатываются параллельно (concurrent_updates), но шаги диалога
+    одного водителя - нет: иначе время, введенное во время загрузки фото, прочиталось бы
+    как пробег, потому что шаг сбрасывается только после отправки листа.
+    """
+    @functools.wraps(handler)
+    async def wrapper(self, update, context):
+        async with self.user_lock(update.effective_user.id):
+            return await handler(self, update, context)
+    return wrapper
+
+
 class TaxiBot:
-    def __init__(self, token):
-        self.application = Application.builder().token(token).build()
+    def __init__(self, token, base_url=None, updater=True, metrics_port=METRICS_PORT, render_workers=None):
+        """
+        Args:
+            token: Токен бота
+            base_url: Адрес Bot API (None - BOT_API_BASE_URL или api.telegram.org)
+            updater: False для режима вебхука - обновления подаются в update_queue извне
+            metrics_port: Порт эндпоинта метрик (None - без эндпоинта)
+            render_workers: Воркеров пула рендера (None - RENDER_POOL_WORKERS); в режиме вебхука
+                            процессу бота достается своя доля (см. webhook_server.split_render_workers)
+        """
+        builder = (
+            Application.builder()
+            .token(token)
+            # Без этого обработчики выполняются строго по одному и пул рендера простаивает
+            .concurrent_updates(BOT_CONCURRENT_UPDATES)
+            .post_init(self.on_startup)
+            .post_shutdown(self.on_shutdown)
+        )
+        base_url = base_url or BOT_API_BASE_URL
+        if base_url:
+            builder = builder.base_url(base_url)
+        if not updater:
+            builder = builder.updater(None)
+        self.application = builder.build()
+        for mode in {WAYBILL_DELIVERY, *WAYBILL_DELIVERY_DRIVERS.values()}:
+            if mode not in DELIVERY_MODES:
+                raise ValueError(f"Неизвестный способ отправки путевого листа: {mode}")
+        # Индекс шаблонов водителей: сканируется один раз, дальше обновляется в фоне
+        self.template_registry = TemplateRegistry(
+            templates_dir=TEMPLATES_DIR,
+            max_depth=TEMPLATES_SHARD_DEPTH,
+            watch=TEMPLATES_WATCH,
+            poll_interval=TEMPLATES_POLL_INTERVAL
+        )
+        self.template_registry.start()
+        # Водители на общем базовом шаблоне: вместо PDF на каждого - запись с полями водителя
+        self.driver_records = create_driver_records(
+            DRIVER_RECORDS_BACKEND,
+            path=DRIVER_RECORDS_PATH,
+            base_dir=BASE_TEMPLATES_DIR
+        )
         # Инициализируем PDFFiller с настройками шрифта из config
         self.pdf_filler = PDFFiller(
             font_name=PDF_FONT_NAME, 
+            font_file=PDF_FONT_FILE,
             font_size=PDF_FONT_SIZE,
-            field_font_sizes=PDF_FIELD_FONT_SIZES
+            field_font_sizes=PDF_FIELD_FONT_SIZES,
+            cache_size=TEMPLATE_CACHE_SIZE,
+            cache_max_bytes=TEMPLATE_CACHE_MAX_BYTES,
+            render_mode=RENDER_MODE,
+            background_cache_max_bytes=BACKGROUND_CACHE_MAX_BYTES,
+            template_registry=self.template_registry,
+            image_profile=get_profile(IMAGE_PROFILE, IMAGE_PROFILES),
+            driver_records=self.driver_records,
+            crop_to_content=CROP_TO_CONTENT,
+            crop_margin=CROP_MARGIN,
+            pdf_thumbnail_size=PDF_THUMBNAIL_SIZE,
+            shared_templates_dir=SHARED_TEMPLATES_DIR
+        )
+        # Пул воркеров: заполнение и рендер PDF не блокируют event loop
+        self.render_pool = RenderPool(
+            kind=RENDER_POOL_KIND,
+            max_workers=render_workers or RENDER_POOL_WORKERS,
+            max_queue=RENDER_QUEUE_SIZE,
+            job_timeout=RENDER_JOB_TIMEOUT,
+            max_jobs_per_worker=RENDER_WORKER_MAX_JOBS
+        )
+        # Профилирование заданий по запросу: выключено, пока не задано окружение или /profile
+        self.profiling = ProfilingControl.from_environ(PROFILE_DIR)
+        # Каждая генерация - отдельное задание со своим шаблоном; повторы объединяются
+        self.render_scheduler = RenderScheduler(
+            self.render_pool,
+            max_concurrency=RENDER_MAX_CONCURRENCY,
+            max_waiting=RENDER_MAX_WAITING,
+            profiling=self.profiling
         )
-        self.user_data = {}
+        # Заготовки без пробега: запускаются после ввода времени, только на свободных воркерах
+        self.speculative_renders = SpeculativeRenders(
+            self.render_pool,
+            ttl=SPECULATIVE_TTL,
+            max_items=SPECULATIVE_MAX_ITEMS,
+            profiling=self.profiling
+        )
+        # Архив выданных листов: уникальные номера, поиск и повторная отправка без рендера
+        self.waybill_archive = WaybillArchive(WAYBILL_ARCHIVE_PATH) if WAYBILL_ARCHIVE_PATH else None
+        # SHA-256 шаблонов, уже записанных в архив: воркеры не пересылают их байты заново
+        self.archived_bases = {}
+        self.background_tasks = set()
+        # Блокировки диалога по пользователю; освобожденная и никем не ожидаемая удаляется сама
+        self._user_locks = weakref.WeakValueDictionary()
+        # Готовые листы для повторов: тот же номер, а после первой отправки - file_id без загрузки
+        self.result_cache = ResultCache(
+            ttl=RESULT_CACHE_TTL,
+            max_items=RESULT_CACHE_MAX_ITEMS,
+            max_bytes=RESULT_CACHE_MAX_BYTES
+        )
+        # Состояние диалогов: ограничено по памяти и переживает перезапуск
+        self.user_data = create_state_store(
+            STATE_BACKEND,
+            path=STATE_DB_PATH,
+            max_items=STATE_CACHE_SIZE,
+            ttl=STATE_TTL,
+            flush_interval=STATE_FLUSH_INTERVAL,
+            flush_batch=STATE_FLUSH_BATCH
+        )
+        
+        # Метрики: этапы генерации, очереди, ошибки; эндпоинт запускается в on_startup
+        self.metrics_server = None
+        self.metrics_port = metrics_port
+        # Готовность: обновления принимаются только после прогрева (GET /ready на порту метрик)
+        self.ready = False
+        self.warmup_report = None
+        REGISTRY.register_gauge('waybill_ready', lambda: int(self.ready), "Бот прогрет и принимает обновления")
+        REGISTRY.register_gauge('waybill_scheduler_admitted', lambda: self.render_scheduler.admitted,
+                                "Выполняющиеся и ожидающие задания планировщика")
+        REGISTRY.register_gauge('waybill_scheduler_coalesced', lambda: self.render_scheduler.coalesced,
+                                "Повторные задания, объединенные с выполняющимися")
+        REGISTRY.register_gauge('waybill_scheduler_rejected', lambda: self.render_scheduler.rejected,
+                                "Задания, отклоненные из-за перегрузки")
+        REGISTRY.register_gauge('waybill_speculative_pending', lambda: len(self.speculative_renders),
+                                "Заготовки, ожидающие ввода пробега")
+        REGISTRY.register_gauge('waybill_result_cache_items', lambda: len(self.result_cache),
+                                "Готовые путевые листы в кэше повторов")
+        REGISTRY.register_gauge('waybill_result_cache_bytes', lambda: self.result_cache.total_bytes,
+                                "Память изображений в кэше повторов")
+        REGISTRY.register_gauge('waybill_render_pool_pending', lambda: self.render_pool.pending,
+                                "Задания в работе и в очереди пула")
+        shared_templates = self.pdf_filler.shared_templates
+        if shared_templates is not None:
+            REGISTRY.register_gauge('waybill_shared_templates_disk_bytes', shared_templates.disk_bytes,
+                                    "Общие шаблоны хоста (одна копия)")
+        # Без /proc/self/smaps (не Linux) память отображений не узнать - показатели не публикуются
+        if shared_templates is not None and shared_templates.memory() is not None:
+            # Воркеры пула - см. python shared_templates.py <каталог>
+            REGISTRY.register_gauge('waybill_shared_templates_rss_bytes',
+                                    lambda: (shared_templates.memory() or MappedMemory(0, 0, 0, 0)).rss,
+                                    "Страницы общих шаблонов в памяти процесса бота")
+            REGISTRY.register_gauge('waybill_shared_templates_pss_bytes',
+                                    lambda: (shared_templates.memory() or MappedMemory(0, 0, 0, 0)).pss,
+                                    "Доля процесса бота в памяти общих шаблонов")
         
         self.setup_handlers()
     
+    async def on_startup(self, application):
+        """Запускает эндпоинт метрик и прогревает шаблоны и воркеры до приема обновлений"""
+        if self.metrics_port is not None:
+            self.metrics_server = MetricsServer(REGISTRY, host=METRICS_HOST, port=self.metrics_port,
+                                                ready=lambda: self.ready)
+            await self.metrics_server.start()
+        if WARMUP_ENABLED:
+            self.warmup_report = await warm_up(
+                self.render_pool,
+                self.pdf_filler,
+                collect_template_paths(self.template_registry, self.driver_records),
+                self.warmup_profiles(),
+                timeout=WARMUP_TIMEOUT
+            )
+        self.ready = True
+        logger.info("Бот готов к работе")
+    
+    def warmup_profiles(self):
+        """Профили для пробного рендера: основной и все заданные в IMAGE_PROFILES"""
+        profiles = [self.pdf_filler.image_profile]
+        for name in IMAGE_PROFILES:
+            profile = get_profile(name, IMAGE_PROFILES)
+            if profile not in profiles:
+                profiles.append(profile)
+        return profiles
+    
+    async def on_shutdown(self, application):
+        """Останавливает пул воркеров и наблюдение за шаблонами, сохраняет состояния диалогов"""
+        self.speculative_renders.clear()
+        if self.background_tasks:
+            await asyncio.gather(*self.background_tasks, return_exceptions=True)
+        self.render_pool.shutdown()
+        if self.metrics_server is not None:
+            await self.metrics_server.stop()
+        self.template_registry.stop()
+        if self.driver_records is not None:
+            self.driver_records.close()
+        if self.waybill_archive is not None:
+            self.waybill_archive.close()
+        self.user_data.close()
+    
     def setup_handlers(self):
         """Настройка обработчиков команд"""
         self.application.add_handler(CommandHandler("start", self.start))
+        self.application.add_handler(CommandHandler("history", self.history))
+        self.application.add_handler(CommandHandler("resend", self.resend))
+        self.application.add_handler(CommandHandler("profile", self.profile))
         self.application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_message))
     
+    def user_lock(self, user_id):
+        """asyncio.Lock диалога пользователя (см. serialized_per_user)"""
+        user_id = str(user_id)
+        lock = self._user_locks.get(user_id)
+        if lock is None:
+            lock = self._user_locks[user_id] = asyncio.Lock()
+        return lock
+    
+    @serialized_per_user
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /start"""
         user_id = str(update.effective_user.id)  # Важно: str для сравнения
-        
+        # Диалог начинается заново - заготовка по прежнему времени и ее номер больше не нужны
+        self.speculative_renders.discard(user_id)
+        previous = self.user_data.get(user_id)
+        if previous is not None:
+            self.release_serial(previous.get('serial_number'))
+
         # 🔥 НОВЫЙ ФУНКЦИОНАЛ: ищем шаблон по Telegram ID
-        template_path = self.pdf_filler.find_driver_template(user_id)
+        driver = self.pdf_filler.find_driver(user_id, TEMPLATES_DIR)
         
-        if not template_path:
+        if driver is None:
             await update.message.reply_text(
                 "❌ Ваш персональный шаблон не найден!\n"
                 "Обратитесь к администратору для настройки."
             )
             return
         
-        # Устанавливаем найденный шаблон
-        self.pdf_filler.template_path = template_path
-        
-        self.user_data[user_id] = {
+        self.user_data.put(user_id, {
             'step': 'waiting_time',
-            'template_path': template_path
-        }
+            'template_path': driver.path,
+            'driver_fields': driver.fields
+        })
         
         await update.message.reply_text(
             "🚖 Добро пожаловать!\n\n"
@@ -61,26 +406,32 @@ class TaxiBot:
             "Например: 08:00 или 13:21"
         )
     
+    @serialized_per_user
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработка сообщений от пользователя"""
         user_id = str(update.effective_user.id)
         text = update.message.text.strip()
         
-        if user_id not in self.user_data:
+        user_state = self.user_data.get(user_id)
+        if user_state is None:
             await update.message.reply_text("❌ Напишите /start для начала работы")
             return
         
-        user_state = self.user_data[user_id]
-        
         if user_state['step'] == 'waiting_time':
             if self.validate_time_format(text):
                 user_state['start_time'] = text
                 user_state['step'] = 'waiting_odometer'
+                if SPECULATIVE_RENDER and self.delivery_mode(user_id) == 'photo':
+                    self.start_speculative(user_id, user_state)
+                self.user_data.put(user_id, user_state)
                 await update.message.reply_text(
                     f"⏱ Время принято: {text}\n\n"
                     "Теперь введите показания одометра (пробег):"
                 )
-            else:
+            # Повтор пробега, пришедший во время загрузки, обрабатывается уже после отправки листа
+            # (шаги водителя идут по очереди): это не время новой смены, а тот же лист
+            elif not (text.isdigit() and text == user_state.get('odometer')
+                      and await self.resend_last(update, user_id, user_state)):
                 await update.message.reply_text(
                     "❌ Неверный формат времени!\n"
                     "Введите время в формате ЧЧ:MM (например: 08:00 или 13:21)"
@@ -89,99 +440,388 @@ class TaxiBot:
         elif user_state['step'] == 'waiting_odometer':
             if text.isdigit():
                 user_state['odometer'] = text
-                await self.generate_waybill(update, user_state)
-                user_state['step'] = 'waiting_time'  # Сброс только шага
+                # При перегрузке остаемся на шаге пробега, чтобы водитель просто повторил ввод
+                if await self.generate_waybill(update, user_state):
+                    user_state['step'] = 'waiting_time'  # Сброс только шага
+                    # Номер выдан или освобожден: следующий лист получит новый
+                    user_state.pop('serial_number', None)
+                self.user_data.put(user_id, user_state)
             else:
                 await update.message.reply_text("❌ Пробег должен быть числом!")
     
     async def generate_waybill(self, update: Update, user_state):
-        """Генерирует путевой лист и отправляет как JPG"""
-        pdf_path = None
-        jpg_path = None
+        """
+        Генерирует путевой лист и отправляет как фото или PDF-документ (см. delivery_mode)
+        
+        Returns:
+            bool: False если задание не принято из-за перегрузки (можно повторить ввод)
+        """
+        result = None
         try:
-            # Создаем временный файл для PDF
-            with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as tmp_file:
-                pdf_path = tmp_file.name
-            
-            logger.info(f"Создан временный PDF файл: {pdf_path}")
-            
-            # Заполняем PDF с персональным шаблоном
-            self.pdf_filler.fill_pdf(
-                user_state['start_time'],
-                user_state['odometer'],
-                pdf_path
-            )
-            
-            logger.info(f"PDF заполнен, начинаем конвертацию в JPG")
-            
-            # Конвертируем PDF в JPG
-            with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as tmp_jpg:
-                jpg_path = tmp_jpg.name
-            
-            logger.info(f"Создан временный JPG файл: {jpg_path}")
-            
-            # Конвертируем PDF в JPG
-            self.pdf_filler.pdf_to_jpg(pdf_path, jpg_path)
-            
-            # Проверяем, что JPG файл создан
-            if not os.path.exists(jpg_path):
-                raise FileNotFoundError(f"JPG файл не был создан: {jpg_path}")
-            
-            file_size = os.path.getsize(jpg_path)
-            logger.info(f"JPG файл создан, размер: {file_size} байт")
-            
-            # Отправляем JPG как фото
-            with open(jpg_path, 'rb') as jpg_file:
-                await update.message.reply_photo(
-                    photo=jpg_file,
-                    caption="✅ Ваш путевой лист готов!"
-                )
+            job = self.create_job(update.effective_user.id, user_state)
+            cache_key = None
+            if RESULT_CACHE_TTL:
+                start_date = self.pdf_filler.calculate_times(job.start_time)['start_date']
+                cache_key = self.result_cache.make_key(job, start_date)
+            cached = self.result_cache.get(cache_key) if cache_key is not None else None
+            serial_number = job.serial_number
+            archive_task = None
+            if cached is not None:
+                # Повтор тех же данных: заготовка под него и ее номер больше не нужны
+                self.speculative_renders.discard(job.user_id)
+                self.release_serial(user_state.pop('serial_number', None))
+                job = job._replace(serial_number=None)
+                if cached.file_id and await self.send_cached(update, job, cached.file_id):
+                    return True
+                if cached.file_id:
+                    self.result_cache.discard(cache_key)
+                result = cached.content
+                serial_number = cached.serial_number
+            if result is None:
+                archive = self.waybill_archive is not None
+                if archive and not job.serial_number:
+                    # Номер выделяется только под настоящий рендер; при перегрузке он остается
+                    # в состоянии диалога и достанется повтору ввода пробега
+                    user_state['serial_number'] = self.allocate_serial(job.user_id)
+                    job = job._replace(serial_number=user_state['serial_number'])
+                try:
+                    result, archive_pdf = await self.render_job(job, archive)
+                except (SchedulerBusy, RenderInterrupted):
+                    raise
+                except Exception:
+                    # Лист не получился и в архив не попадет - номер возвращается
+                    self.release_serial(job.serial_number)
+                    raise
+                serial_number = job.serial_number
+                # Повтор с тем же временем и пробегом получит этот результат, а не новый рендер
+                self.result_cache.put(cache_key, result, serial_number=serial_number)
+                # Запись в архив идет параллельно с загрузкой
+                if archive:
+                    archive_task = asyncio.ensure_future(self.archive_waybill(job, archive_pdf))
             
-            logger.info("JPG успешно отправлен пользователю")
+            # Отправляем прямо из памяти
+            with stage('upload'):
+                message = await self.send_waybill(update, job, result, serial_number)
+            if message.document:
+                file_id, file_kind = message.document.file_id, 'document'
+            else:
+                file_id, file_kind = (message.photo[-1].file_id if message.photo else None), 'photo'
+            if file_id:
+                self.result_cache.put(cache_key, file_id=file_id, serial_number=serial_number)
+            if self.waybill_archive is not None and serial_number and (archive_task or file_id):
+                # Архив дописывается в фоне: следующий ввод водителя не ждет сборки PDF
+                self.run_in_background(self.finish_archive(archive_task, serial_number, file_id, file_kind))
             
-            # Удаляем временные файлы
-            if pdf_path and os.path.exists(pdf_path):
-                os.unlink(pdf_path)
-            if jpg_path and os.path.exists(jpg_path):
-                os.unlink(jpg_path)
+            REGISTRY.inc('waybill_requests_total', status='ok')
+            logger.info("Путевой лист отправлен пользователю %s (%s, %d байт)", job.user_id, job.delivery,
+                        len(result.pdf_bytes) if job.delivery == 'pdf' else len(result))
             
+        except SchedulerBusy:
+            REGISTRY.inc('waybill_requests_total', status='busy')
+            logger.warning("Генерация перегружена, задание отклонено")
+            await update.message.reply_text(
+                "⏳ Сервер сейчас перегружен. Повторите ввод пробега через несколько секунд."
+            )
+            return False
+        except RenderInterrupted as e:
+            REGISTRY.inc('waybill_requests_total', status='interrupted')
+            logger.warning(f"Генерация прервана заменой пула воркеров: {e}")
+            await update.message.reply_text(
+                "⏳ Генерация прервана перезапуском воркеров. Повторите ввод пробега."
+            )
+            return False
+        except RenderTimeout as e:
+            REGISTRY.inc('waybill_requests_total', status='timeout')
+            logger.error(f"Таймаут генерации путевого листа: {e}")
+            await update.message.reply_text(
+                "❌ Генерация путевого листа заняла слишком много времени. Попробуйте еще раз."
+            )
         except Exception as e:
+            REGISTRY.inc('waybill_requests_total', status='error')
+            if result is not None:
+                # Ошибки рендера уже учтены планировщиком
+                REGISTRY.inc('waybill_errors_total', stage='upload', error=type(e).__name__)
             logger.error(f"Error generating waybill: {e}", exc_info=True)
             error_msg = f"❌ Ошибка при генерации путевого листа: {str(e)}\n\nПроверьте логи для подробностей."
             await update.message.reply_text(error_msg)
-            
-            # Очистка в случае ошибки
-            if pdf_path and os.path.exists(pdf_path):
-                try:
-                    os.unlink(pdf_path)
-                except:
-                    pass
-            if jpg_path and os.path.exists(jpg_path):
+        
+        return True
+
+    async def send_waybill(self, update, job, result, serial_number):
+        """Отправляет готовый лист: фото или PDF-документ с превью (result - WaybillPdf)"""
+        if job.delivery == 'pdf':
+            return await update.message.reply_document(
+                document=io.BytesIO(result.pdf_bytes),
+                filename=self.waybill_filename(serial_number),
+                thumbnail=io.BytesIO(result.thumbnail) if result.thumbnail else None,
+                caption=WAYBILL_READY_CAPTION
+            )
+        return await update.message.reply_photo(photo=io.BytesIO(result), caption=WAYBILL_READY_CAPTION)
+    
+    @staticmethod
+    def waybill_filename(serial_number):
+        """Имя PDF-файла путевого листа: по цифрам номера"""
+        digits = ''.join(ch for ch in serial_number or '' if ch.isdigit())
+        return f"waybill_{digits}.pdf" if digits else "waybill.pdf"
+    
+    async def resend_last(self, update, user_id, user_state):
+        """
+        Отправляет последний выданный лист еще раз по file_id из кэша результатов
+
+        Returns:
+            bool: False, если листа в кэше нет (тогда ввод считается временем новой смены)
+        """
+        if not RESULT_CACHE_TTL or not user_state.get('start_time'):
+            return False
+        job = self.create_job(user_id, user_state)
+        start_date = self.pdf_filler.calculate_times(job.start_time)['start_date']
+        cached = self.result_cache.get(self.result_cache.make_key(job, start_date))
+        if cached is None or not cached.file_id:
+            return False
+        return await self.send_cached(update, job, cached.file_id)
+
+    async def send_cached(self, update, job, file_id):
+        """
+        Отправляет уже загруженный путевой лист по file_id
+        
+        Returns:
+            bool: False, если Telegram не принял file_id (тогда лист отправляется заново)
+        """
+        try:
+            with stage('upload'):
+                if job.delivery == 'pdf':
+                    await update.message.reply_document(document=file_id, caption=WAYBILL_READY_CAPTION)
+                else:
+                    await update.message.reply_photo(photo=file_id, caption=WAYBILL_READY_CAPTION)
+        except TelegramError as e:
+            logger.warning(f"Не удалось отправить путевой лист по file_id: {e}")
+            return False
+        REGISTRY.inc('waybill_requests_total', status='ok')
+        logger.info("Путевой лист повторно отправлен пользователю %s по file_id", job.user_id)
+        return True
+    
+    def create_job(self, user_id, user_state):
+        """Задание несет свой шаблон и настройки - общий PDFFiller не меняется"""
+        return WaybillJob.create(
+            user_id,
+            user_state['template_path'],
+            user_state['start_time'],
+            user_state.get('odometer', ''),
+            self.pdf_filler.get_options(),
+            driver_fields=user_state.get('driver_fields'),
+            serial_number=user_state.get('serial_number'),
+            delivery=self.delivery_mode(user_id)
+        )
+    
+    def delivery_mode(self, user_id):
+        """Способ отправки листа водителю: из WAYBILL_DELIVERY_DRIVERS, иначе WAYBILL_DELIVERY"""
+        return WAYBILL_DELIVERY_DRIVERS.get(str(user_id), WAYBILL_DELIVERY)
+    
+    def allocate_serial(self, user_id):
+        """Номер путевого листа, проверенный по архиву (без архива - None, номер выберет рендер)"""
+        if self.waybill_archive is None:
+            return None
+        return self.waybill_archive.allocate_serial(user_id, self.pdf_filler.generate_serial_number)
+
+    def release_serial(self, serial_number):
+        """Возвращает архиву номер, под который лист так и не выдан"""
+        if self.waybill_archive is None or not serial_number:
+            return
+        try:
+            self.waybill_archive.release_serial(serial_number)
+        except Exception as e:
+            logger.error(f"Не удалось освободить номер путевого листа {serial_number}: {e}", exc_info=True)
+
+    def start_speculative(self, user_id, user_state):
+        """
+        Запускает заготовку листа, пока водитель вводит пробег
+
+        Номер впечатывается в заготовку, поэтому выделяется здесь, но только если заготовка
+        действительно запущена; иначе он будет выделен при рендере
+        """
+        self.release_serial(user_state.pop('serial_number', None))
+        try:
+            user_state['serial_number'] = self.allocate_serial(user_id)
+        except Exception as e:
+            logger.error(f"Не удалось выделить номер путевого листа для заготовки: {e}", exc_info=True)
+            return
+        if not self.speculative_renders.start(self.create_job(user_id, user_state)):
+            self.release_serial(user_state.pop('serial_number', None))
+
+    def run_in_background(self, coro):
+        """Фоновая задача, которую on_shutdown дождется перед закрытием хранилищ"""
+        task = asyncio.ensure_future(coro)
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+    
+    async def finish_archive(self, archive_task, serial_number, file_id, file_kind='photo'):
+        """Дожидается записи листа в архив и запоминает file_id фото или документа"""
+        if archive_task is not None:
+            await archive_task
+        if file_id:
+            await asyncio.to_thread(self.waybill_archive.set_file_id, serial_number, file_id, file_kind)
+    
+    async def archive_waybill(self, job, archive_pdf=None):
+        """
+        Сохраняет выданный лист в архив: сжатый PDF и значения полей
+
+        PDF собирается в пуле воркеров (обычно вместе с рендером, см. execute_job),
+        основной процесс только записывает его в SQLite.
+        """
+        known_base = self.archived_bases.get(job.template_path)
+        try:
+            if archive_pdf is None:
                 try:
-                    os.unlink(jpg_path)
-                except:
-                    pass
+                    archive_pdf = await self.render_pool.run(execute_archive, job, known_base)
+                except RenderPoolBusy:
+                    # Лист уже выдан и должен попасть в архив, даже если пул занят
+                    archive_pdf = await asyncio.to_thread(execute_archive, job, known_base, self.pdf_filler)
+            await asyncio.to_thread(self.waybill_archive.add_pdf, job.serial_number, job.user_id,
+                                    job.template_path, archive_pdf)
+            self.archived_bases[job.template_path] = archive_pdf.base_sha256
+        except Exception as e:
+            REGISTRY.inc('waybill_errors_total', stage='archive', error=type(e).__name__)
+            logger.error(f"Не удалось сохранить путевой лист {job.serial_number} в архив: {e}", exc_info=True)
+    
+    async def history(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработчик команды /history - последние путевые листы водителя"""
+        if self.waybill_archive is None:
+            await update.message.reply_text("❌ Архив путевых листов не ведется")
+            return
+        records = await asyncio.to_thread(self.waybill_archive.history, update.effective_user.id,
+                                          WAYBILL_HISTORY_LIMIT)
+        if not records:
+            await update.message.reply_text("📭 Выданных путевых листов пока нет")
+            return
+        lines = [
+            f"№ {record.serial} — {record.fields.get('start_date', '')} {record.fields.get('start_time', '')}, "
+            f"пробег {record.fields.get('odometr', '')}"
+            for record in records
+        ]
+        await update.message.reply_text(
+            "🗂 Ваши путевые листы:\n" + "\n".join(lines) + "\n\nПовторно отправить: /resend <номер>"
+        )
+    
+    async def resend(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработчик команды /resend [номер] - повторная отправка листа из архива (без номера - последнего)"""
+        if self.waybill_archive is None:
+            await update.message.reply_text("❌ Архив путевых листов не ведется")
+            return
+        user_id = str(update.effective_user.id)
+        digits = ''.join(ch for ch in ''.join(context.args or ()) if ch.isdigit())
+        if digits:
+            # Номер можно ввести как «123456 - 1234567» или одними цифрами
+            record = await asyncio.to_thread(self.waybill_archive.get, f"{digits[:6]} - {digits[6:]}")
+        else:
+            records = await asyncio.to_thread(self.waybill_archive.history, user_id, 1)
+            record = records[0] if records else None
+        if record is None or record.telegram_id != user_id:
+            await update.message.reply_text("❌ Путевой лист не найден. Список ваших листов: /history")
+            return
+        
+        caption = f"📄 Путевой лист № {record.serial}"
+        if record.file_id:
+            try:
+                if record.file_kind == 'document':
+                    await update.message.reply_document(document=record.file_id, caption=caption)
+                else:
+                    await update.message.reply_photo(photo=record.file_id, caption=caption)
+                return
+            except TelegramError as e:
+                logger.warning(f"Не удалось отправить путевой лист {record.serial} по file_id: {e}")
+        # Лист не загружался - отправляем архивный PDF
+        pdf_bytes = await asyncio.to_thread(self.waybill_archive.get_pdf, record.serial)
+        await update.message.reply_document(
+            document=io.BytesIO(pdf_bytes),
+            filename=self.waybill_filename(record.serial),
+            caption=caption
+        )
+    
+    async def profile(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """
+        Обработчик команды /profile (только PROFILE_ADMINS):
+            /profile               - состояние и последние профили
+            /profile next N [mem]  - профилировать N следующих заданий
+            /profile slow MS [mem] - сохранять профили заданий дольше MS миллисекунд
+            /profile off           - выключить
+        mem - вместе с cProfile снимать tracemalloc
+        """
+        if str(update.effective_user.id) not in {str(admin) for admin in PROFILE_ADMINS}:
+            await update.message.reply_text("❌ Команда доступна только администраторам")
+            return
+        args = [arg.lower() for arg in context.args or ()]
+        memory_frames = 1 if 'mem' in args[2:] else 0
+        try:
+            if args[:1] == ['off']:
+                self.profiling.disable()
+            elif args[:1] == ['next'] and len(args) > 1:
+                self.profiling.enable_next(int(args[1]), memory_frames)
+            elif args[:1] == ['slow'] and len(args) > 1:
+                self.profiling.enable_slow(float(args[1]) / 1000, memory_frames)
+            elif args:
+                raise ValueError(args[0])
+        except ValueError:
+            await update.message.reply_text(
+                "Использование: /profile [next N [mem] | slow МС [mem] | off]"
+            )
+            return
+        lines = [f"🔬 Профилирование: {self.profiling.describe()}"]
+        dumps = await asyncio.to_thread(self.profiling.recent_dumps)
+        if dumps:
+            lines.append("Последние профили:")
+            lines.extend(dumps)
+        await update.message.reply_text("\n".join(lines))
+    
+    async def render_job(self, job, archive=False):
+        """
+        Рендерит путевой лист: дописывает пробег в готовую заготовку, а если ее нет -
+        выполняет задание целиком в пуле воркеров (PDF-документ - всегда в пуле, без заготовок)
 
+        Args:
+            archive: Собрать в пуле и PDF листа для архива
+
+        Returns:
+            tuple: (результат рендера, ArchivePdf или None - если собрать его не удалось попутно)
+        """
+        if SPECULATIVE_RENDER and job.delivery == 'photo':
+            prerender = await self.speculative_renders.take(job)
+            if prerender is not None and self.pdf_filler.is_prerender_current(prerender):
+                started = time.perf_counter()
+                try:
+                    # Осталось одно поле и кодирование - без пересылки растра обратно в воркер
+                    image_bytes = await asyncio.to_thread(self.pdf_filler.finish_waybill, prerender, job.odometer)
+                except Exception as e:
+                    REGISTRY.inc('waybill_errors_total', stage='finish', error=type(e).__name__)
+                    logger.warning(f"Не удалось дописать заготовку, полный рендер: {e}")
+                else:
+                    REGISTRY.observe('waybill_render_duration_seconds', time.perf_counter() - started)
+                    return image_bytes, None
+        # Заполнение, flatten и рендер выполняются в пуле воркеров
+        return await self.render_scheduler.submit(job, archive, self.archived_bases.get(job.template_path))
+    
     def validate_time_format(self, time_str):
         """Проверяет формат времени"""
-        try:
-            time_str = time_str.strip()
-            if ':' not in time_str:
-                return False
-            
-            parts = time_str.split(':')
-            if len(parts) != 2:
-                return False
-            
-            hours, minutes = map(int, parts)
-            return 0 <= hours <= 23 and 0 <= minutes <= 59
-            
-        except:
-            return False
+        return self.pdf_filler.validate_time_format(time_str)
 
 def main():
     BOT_TOKEN = ""
     
+    if BOT_MODE == 'webhook':
+        from webhook_server import WebhookServer
+        print(f"Бот запущен в режиме вебхука ({WEBHOOK_WORKERS} воркеров)...")
+        WebhookServer(
+            BOT_TOKEN,
+            host=WEBHOOK_HOST,
+            port=WEBHOOK_PORT,
+            path=WEBHOOK_PATH,
+            workers=WEBHOOK_WORKERS,
+            render_workers=RENDER_POOL_WORKERS,
+            secret_token=WEBHOOK_SECRET,
+            webhook_url=WEBHOOK_URL,
+            base_url=BOT_API_BASE_URL
+        ).run()
+        return
+    
     # 🔥 ИЗМЕНЕНИЕ: передаем только токен, без шаблона
     bot = TaxiBot(BOT_TOKEN)
     
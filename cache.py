@@ -0,0 +1,108 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    def __init__(self, max_items=None, max_bytes=None, sizeof=None, ttl=None):
+        """
+        Потокобезопасный LRU-кэш с ограничением по числу записей, по памяти и по времени жизни
+
+        Args:
+            max_items: Максимальное количество записей (None - без ограничения)
+            max_bytes: Максимальный суммарный размер записей в байтах (None - без ограничения)
+            sizeof: Функция оценки размера значения в байтах (по умолчанию len)
+            ttl: Время жизни записи в секундах с момента put (None - без ограничения)
+        """
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof or len
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._sizes = {}
+        self._expires = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items and not self._expired(key)
+
+    @property
+    def total_bytes(self):
+        """Суммарный размер записей в байтах"""
+        return self._bytes
+
+    def get(self, key, default=None):
+        """Возвращает значение и помечает запись как недавно использованную"""
+        with self._lock:
+            if key in self._items and self._expired(key):
+                self._remove(key)
+            if key not in self._items:
+                self.misses += 1
+                return default
+            self._items.move_to_end(key)
+            self.hits += 1
+            return self._items[key]
+
+    def put(self, key, value):
+        """Добавляет значение, вытесняя самые старые записи при превышении лимитов"""
+        size = self.sizeof(value)
+        with self._lock:
+            if key in self._items:
+                self._remove(key)
+            if self.max_bytes is not None and size > self.max_bytes:
+                # Значение больше всего кэша - не кэшируем
+                return
+            self._items[key] = value
+            self._sizes[key] = size
+            self._bytes += size
+            if self.ttl is not None:
+                self._expires[key] = time.monotonic() + self.ttl
+                self._purge_expired()
+            while self._items and (
+                (self.max_items is not None and len(self._items) > self.max_items) or
+                (self.max_bytes is not None and self._bytes > self.max_bytes)
+            ):
+                self._remove(next(iter(self._items)))
+
+    def pop(self, key, default=None):
+        """Удаляет запись и возвращает ее значение"""
+        with self._lock:
+            if key not in self._items:
+                return default
+            value = self._items[key]
+            expired = self._expired(key)
+            self._remove(key)
+            return default if expired else value
+
+    def clear(self):
+        """Очищает кэш"""
+        with self._lock:
+            self._items.clear()
+            self._sizes.clear()
+            self._expires.clear()
+            self._bytes = 0
+
+    def _expired(self, key):
+        expires = self._expires.get(key)
+        return expires is not None and expires <= time.monotonic()
+
+    def _purge_expired(self):
+        """Удаляет истекшие записи из начала очереди (их время жизни отсчитывается от put)"""
+        while self._items:
+            key = next(iter(self._items))
+            if not self._expired(key):
+                # Дальше - записи, которые использовались позже; истекшие среди них удалит get
+                break
+            self._remove(key)
+
+    def _remove(self, key):
+        del self._items[key]
+        self._bytes -= self._sizes.pop(key)
+        self._expires.pop(key, None)
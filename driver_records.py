@@ -0,0 +1,198 @@
+"""
+Записи водителей: общий базовый шаблон + небольшой набор полей водителя
+
+Вместо копии PDF на каждого водителя хранится запись {telegram_id, base, fields}:
+base - имя базового шаблона в папке базовых шаблонов, fields - значения полей формы
+базового шаблона, которые относятся к водителю (например telegram_id).
+Записи создает migrate_templates.py из существующих driver_*.pdf.
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+DriverRecord = namedtuple('DriverRecord', ['telegram_id', 'base', 'fields'])
+
+# Шаблон для генерации: путь к PDF и значения полей водителя (для driver_*.pdf - пустые)
+DriverTemplate = namedtuple('DriverTemplate', ['path', 'fields'])
+
+
+class JsonDriverRecords:
+    def __init__(self, path='templates/drivers.json', base_dir='templates/base', check_interval=5):
+        """
+        Записи водителей в одном JSON-файле: {telegram_id: {"base": ..., "fields": {...}}}
+
+        Файл перечитывается, если изменился, но не чаще раза в check_interval секунд.
+
+        Args:
+            path: Путь к JSON-файлу (может не существовать - тогда записей нет)
+            base_dir: Папка с базовыми шаблонами
+            check_interval: Как часто проверять изменение файла, в секундах
+        """
+        self.path = path
+        self.base_dir = base_dir
+        self.check_interval = check_interval
+        self._records = {}
+        self._mtime = None
+        self._checked_at = 0
+        self._lock = threading.Lock()
+        self._reload()
+
+    def __len__(self):
+        self._maybe_reload()
+        return len(self._records)
+
+    def __contains__(self, telegram_id):
+        return self.get(telegram_id) is not None
+
+    def __iter__(self):
+        self._maybe_reload()
+        return iter(list(self._records.values()))
+
+    def _reload(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            self._records, self._mtime = {}, None
+            return
+        if mtime == self._mtime:
+            return
+        with open(self.path, encoding='utf-8') as f:
+            data = json.load(f)
+        self._records = {
+            str(telegram_id): DriverRecord(str(telegram_id), item['base'], dict(item.get('fields') or {}))
+            for telegram_id, item in data.items()
+        }
+        self._mtime = mtime
+        logger.info(f"Загружено записей водителей: {len(self._records)} из {self.path}")
+
+    def _maybe_reload(self):
+        now = time.monotonic()
+        if now - self._checked_at < self.check_interval:
+            return
+        with self._lock:
+            self._checked_at = now
+            try:
+                self._reload()
+            except (OSError, ValueError, KeyError) as e:
+                # Битый файл (например, во время ручной правки) - работаем с прежними записями
+                logger.error(f"Не удалось перечитать записи водителей {self.path}: {e}")
+
+    def get(self, telegram_id):
+        """Возвращает DriverRecord или None"""
+        self._maybe_reload()
+        return self._records.get(str(telegram_id))
+
+    def put_many(self, records):
+        """Добавляет или заменяет записи и атомарно перезаписывает файл"""
+        with self._lock:
+            self._reload()
+            for record in records:
+                self._records[str(record.telegram_id)] = DriverRecord(
+                    str(record.telegram_id), record.base, dict(record.fields))
+            data = {
+                telegram_id: {'base': record.base, 'fields': record.fields}
+                for telegram_id, record in sorted(self._records.items())
+            }
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.path)
+            self._mtime = os.stat(self.path).st_mtime_ns
+
+    def put(self, record):
+        self.put_many([record])
+
+    def resolve(self, telegram_id):
+        """DriverTemplate водителя по записи или None, если записи нет"""
+        record = self.get(telegram_id)
+        if record is None:
+            return None
+        return DriverTemplate(os.path.join(self.base_dir, record.base), record.fields)
+
+    def close(self):
+        pass
+
+
+class SQLiteDriverRecords(JsonDriverRecords):
+    def __init__(self, path='drivers.sqlite3', base_dir='templates/base'):
+        """
+        Записи водителей в SQLite - для большого автопарка и правок без перезаписи файла
+
+        Args:
+            path: Путь к файлу базы SQLite
+            base_dir: Папка с базовыми шаблонами
+        """
+        self.path = path
+        self.base_dir = base_dir
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS driver_records ("
+            "telegram_id TEXT PRIMARY KEY, base TEXT NOT NULL, fields TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+        logger.info(f"Записи водителей: {path} ({len(self)} шт.)")
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM driver_records").fetchone()[0]
+
+    def __iter__(self):
+        with self._lock:
+            rows = self._db.execute("SELECT telegram_id, base, fields FROM driver_records").fetchall()
+        return iter([DriverRecord(telegram_id, base, json.loads(fields)) for telegram_id, base, fields in rows])
+
+    def get(self, telegram_id):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT base, fields FROM driver_records WHERE telegram_id = ?", (str(telegram_id),)
+            ).fetchone()
+        if row is None:
+            return None
+        return DriverRecord(str(telegram_id), row[0], json.loads(row[1]))
+
+    def put_many(self, records):
+        now = time.time()
+        rows = [(str(record.telegram_id), record.base, json.dumps(record.fields, ensure_ascii=False), now)
+                for record in records]
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                self._db.executemany(
+                    "INSERT INTO driver_records (telegram_id, base, fields, updated_at) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(telegram_id) DO UPDATE SET base = excluded.base, fields = excluded.fields, "
+                    "updated_at = excluded.updated_at",
+                    rows
+                )
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def create_driver_records(backend='json', **options):
+    """
+    Создает хранилище записей водителей
+
+    Args:
+        backend: 'json', 'sqlite' или None (без записей - только driver_*.pdf)
+        options: Параметры конструктора выбранного хранилища
+    """
+    if backend is None:
+        return None
+    if backend == 'json':
+        return JsonDriverRecords(**options)
+    if backend == 'sqlite':
+        options.pop('check_interval', None)
+        return SQLiteDriverRecords(**options)
+    raise ValueError(f"Неизвестное хранилище записей водителей: {backend}")
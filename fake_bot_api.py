@@ -0,0 +1,218 @@
+"""
+Локальная заглушка Telegram Bot API для тестов и нагрузочных прогонов
+
+Поддерживает getMe, getUpdates (long polling), setWebhook/deleteWebhook, sendMessage,
+sendPhoto и sendDocument. Бот подключается через base_url = FakeBotApi.base_url.
+deliver_update доставляет обновление как Telegram: на вебхук, если он зарегистрирован.
+
+Пример:
+    api = await FakeBotApi().start()
+    bot = TaxiBot(api.token, base_url=api.base_url)
+"""
+import asyncio
+import email.parser
+import email.policy
+import itertools
+import json
+import logging
+import time
+from urllib.parse import parse_qsl, urlsplit
+from simple_http import SimpleHttpServer, HttpError
+
+logger = logging.getLogger(__name__)
+
+BOT_ID = 7000000001
+
+
+def parse_params(request):
+    """
+    Параметры вызова Bot API из JSON, формы или multipart
+
+    Returns:
+        tuple: (параметры, {имя файла-поля: размер в байтах})
+    """
+    content_type = request.headers.get('content-type', '')
+    files = {}
+    if content_type.startswith('application/json'):
+        params = json.loads(request.body or b'{}')
+    elif content_type.startswith('multipart/form-data'):
+        message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode('latin-1') + request.body
+        )
+        params = {}
+        for part in message.iter_parts():
+            name = part.get_param('name', header='content-disposition')
+            payload = part.get_payload(decode=True) or b''
+            if part.get_filename():
+                files[name] = len(payload)
+            else:
+                params[name] = payload.decode('utf-8')
+    else:
+        params = dict(parse_qsl(request.body.decode('utf-8')))
+        params.update(request.query)
+    return params, files
+
+
+class FakeBotApi:
+    def __init__(self, token='123456:TEST', host='127.0.0.1', port=0):
+        """
+        Args:
+            token: Токен, который должен использовать бот
+            host: Адрес для прослушивания
+            port: Порт (0 - любой свободный)
+        """
+        self.token = token
+        self.server = SimpleHttpServer(self._handle, host=host, port=port, max_body=50 * 1024 * 1024)
+        self.webhook_url = None
+        self.webhook_secret = None
+        self.sent = []
+        self.listeners = []
+        self.calls = {}
+        self._updates = []
+        self._update_event = asyncio.Event()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._file_ids = itertools.count(1)
+
+    @property
+    def base_url(self):
+        """base_url для Application.builder().base_url(...)"""
+        return f"{self.server.url}/bot"
+
+    async def start(self):
+        await self.server.start()
+        logger.info(f"Заглушка Bot API слушает {self.server.url}")
+        return self
+
+    async def stop(self):
+        self._update_event.set()
+        await self.server.stop()
+
+    def make_text_update(self, user_id, text):
+        """Создает update с текстовым сообщением (команды - с entity bot_command)"""
+        message = {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private', 'first_name': f"Driver {user_id}"},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f"Driver {user_id}"},
+            'text': text,
+        }
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return {'update_id': next(self._update_ids), 'message': message}
+
+    def push_update(self, update):
+        """Ставит update в очередь для getUpdates"""
+        self._updates.append(update)
+        self._update_event.set()
+
+    async def deliver_update(self, update):
+        """
+        Доставляет update: POST на зарегистрированный вебхук, без вебхука - в очередь getUpdates
+
+        Returns:
+            int: HTTP-статус ответа вебхука (без вебхука - 200)
+        """
+        if not self.webhook_url:
+            self.push_update(update)
+            return 200
+        url = urlsplit(self.webhook_url)
+        body = json.dumps(update).encode('utf-8')
+        head = (
+            f"POST {url.path or '/'} HTTP/1.1\r\nHost: {url.netloc}\r\nContent-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n"
+        )
+        if self.webhook_secret:
+            head += f"X-Telegram-Bot-Api-Secret-Token: {self.webhook_secret}\r\n"
+        reader, writer = await asyncio.open_connection(url.hostname, url.port or 80)
+        try:
+            writer.write(head.encode('latin-1') + b"\r\n" + body)
+            await writer.drain()
+            status_line = await reader.readline()
+        finally:
+            writer.close()
+        return int(status_line.split()[1])
+
+    def _message(self, chat_id, **fields):
+        message = {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': int(chat_id), 'type': 'private'},
+            'from': {'id': BOT_ID, 'is_bot': True, 'first_name': 'TaxiBot', 'username': 'taxi_test_bot'},
+        }
+        message.update(fields)
+        return message
+
+    def _record(self, method, params, files):
+        record = {
+            'method': method,
+            'chat_id': int(params.get('chat_id', 0)),
+            'text': params.get('text') or params.get('caption'),
+            'file_size': sum(files.values()),
+            # Повторная отправка по file_id - без файла в запросе
+            'file_id': params.get('photo') or params.get('document'),
+            'time': time.perf_counter(),
+        }
+        self.sent.append(record)
+        for listener in self.listeners:
+            listener(record)
+
+    async def _get_updates(self, params):
+        offset = int(params.get('offset') or 0)
+        timeout = float(params.get('timeout') or 0)
+        if offset:
+            self._updates = [u for u in self._updates if u['update_id'] >= offset]
+        if not self._updates and timeout:
+            self._update_event.clear()
+            try:
+                await asyncio.wait_for(self._update_event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        limit = int(params.get('limit') or 100)
+        return self._updates[:limit]
+
+    async def _handle(self, request):
+        prefix = f"/bot{self.token}/"
+        if not request.path.startswith(prefix):
+            raise HttpError(404, "Not Found")
+        method = request.path[len(prefix):]
+        params, files = parse_params(request)
+        self.calls[method] = self.calls.get(method, 0) + 1
+
+        if method == 'getMe':
+            result = {'id': BOT_ID, 'is_bot': True, 'first_name': 'TaxiBot', 'username': 'taxi_test_bot',
+                      'can_join_groups': False, 'can_read_all_group_messages': False,
+                      'supports_inline_queries': False}
+        elif method == 'getUpdates':
+            result = await self._get_updates(params)
+        elif method == 'setWebhook':
+            self.webhook_url = params.get('url') or None
+            self.webhook_secret = params.get('secret_token') or None
+            result = True
+        elif method == 'deleteWebhook':
+            self.webhook_url = self.webhook_secret = None
+            result = True
+        elif method == 'getWebhookInfo':
+            result = {'url': self.webhook_url or '', 'has_custom_certificate': False, 'pending_update_count': 0}
+        elif method == 'sendMessage':
+            self._record(method, params, files)
+            result = self._message(params['chat_id'], text=params.get('text', ''))
+        elif method == 'sendPhoto':
+            self._record(method, params, files)
+            file_id = params.get('photo') if 'photo' not in files else f"photo-{next(self._file_ids)}"
+            result = self._message(params['chat_id'], caption=params.get('caption'), photo=[{
+                'file_id': file_id, 'file_unique_id': file_id, 'width': 1654, 'height': 2339,
+                'file_size': files.get('photo', 0),
+            }])
+        elif method == 'sendDocument':
+            self._record(method, params, files)
+            file_id = params.get('document') if 'document' not in files else f"doc-{next(self._file_ids)}"
+            result = self._message(params['chat_id'], caption=params.get('caption'), document={
+                'file_id': file_id, 'file_unique_id': file_id, 'file_size': files.get('document', 0),
+            })
+        elif method in ('close', 'logOut', 'setMyCommands'):
+            result = True
+        else:
+            return 404, {'ok': False, 'error_code': 404, 'description': f"Not Found: method {method}"}
+
+        return 200, {'ok': True, 'result': result}
@@ -0,0 +1,113 @@
+"""
+Шрифты для впечатывания значений полей
+
+Документ, все значения которого стандартный шрифт PDF показывает сам (STANDARD_FONT_CHARS -
+даты, время, пробег, номер), пишется стандартным шрифтом: его не нужно встраивать, и PDF
+не больше, чем без шрифта. Шрифт нужен документу с кириллицей и другими символами вне Latin-1.
+
+TTF/OTF-шрифт загружается один раз на процесс и переиспользуется всеми документами.
+Если установлен fontTools, в PDF встраивается не файл шрифта целиком, а подмножество глифов
+ровно для символов значений документа (плюс цифры и знаки дат и номеров - COMMON_CHARS).
+Подмножества кэшируются по набору символов: набор зависит от водителя (ФИО, марка),
+а не от задания, и строится заново только для нового набора (десятки мс).
+"""
+import io
+import logging
+import os
+from cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+try:
+    import fitz  # PyMuPDF
+    HAS_FITZ = True
+except ImportError:
+    HAS_FITZ = False
+
+try:
+    from fontTools import subset as ft_subset
+    from fontTools.ttLib import TTFont
+    HAS_FONTTOOLS = True
+except ImportError:
+    HAS_FONTTOOLS = False
+
+# Символы, которые стандартный шрифт PDF (base-14, кодировка Latin) показывает без встраивания
+STANDARD_FONT_CHARS = frozenset(
+    [chr(code) for code in range(0x20, 0x7f)]
+    + [chr(code) for code in range(0xa0, 0x100)]
+)
+
+# Символы, которые всегда входят в подмножество: цифры и знаки дат, времени и номеров -
+# так набор символов не меняется от задания к заданию одного водителя
+COMMON_CHARS = frozenset('0123456789 .,:;-/№')
+
+
+def subset_font(buffer, chars):
+    """Байты шрифта только с глифами для chars (fontTools)"""
+    options = ft_subset.Options()
+    options.notdef_outline = True
+    # TextWriter не применяет ни хинтинг, ни кернинг и лигатуры - эти таблицы в PDF только занимают место
+    options.hinting = False
+    options.layout_features = []
+    # Служебная таблица FontForge: fontTools ее не подмножит, а PDF она не нужна
+    options.drop_tables = list(options.drop_tables) + ['FFTM', 'GSUB', 'GPOS', 'GDEF', 'kern']
+    font = TTFont(io.BytesIO(buffer))
+    subsetter = ft_subset.Subsetter(options)
+    subsetter.populate(unicodes=[ord(char) for char in chars])
+    subsetter.subset(font)
+    output = io.BytesIO()
+    font.save(output)
+    return output.getvalue()
+
+
+class FieldFont:
+    def __init__(self, path, max_subsets=64):
+        """
+        Шрифт значений полей: полный и подмножества глифов по наборам символов
+
+        Args:
+            path: Путь к файлу TTF/OTF
+            max_subsets: Сколько подмножеств держать в кэше процесса
+        """
+        with open(path, 'rb') as f:
+            buffer = f.read()
+        self.path = path
+        self.full = fitz.Font(fontbuffer=buffer)
+        # Без fontTools (или после ошибки подмножества) встраивается полный шрифт
+        self._buffer = buffer if HAS_FONTTOOLS else None
+        self._subsets = LRUCache(max_items=max_subsets, sizeof=lambda font: 1)
+        if not HAS_FONTTOOLS:
+            logger.warning(f"fontTools не установлен: шрифт {path} встраивается целиком. Установите: pip install fonttools")
+
+    def for_chars(self, chars):
+        """Шрифт для символов chars: подмножество глифов (chars и COMMON_CHARS) или полный шрифт"""
+        if self._buffer is None:
+            return self.full
+        key = COMMON_CHARS.union(chars)
+        font = self._subsets.get(key)
+        if font is None:
+            try:
+                subset_buffer = subset_font(self._buffer, key)
+            except Exception as e:
+                logger.warning(f"Не удалось построить подмножество шрифта {self.path}, встраивается целиком: {e}")
+                self._buffer = None
+                return self.full
+            font = fitz.Font(fontbuffer=subset_buffer)
+            self._subsets.put(key, font)
+            logger.debug("Шрифт %s: подмножество %d символов, %d байт", self.path, len(key), len(subset_buffer))
+        return font
+
+
+# Шрифты процесса: абсолютный путь → FieldFont
+_field_fonts = {}
+
+
+def get_field_font(path):
+    """FieldFont для файла шрифта - загружается один раз на процесс"""
+    key = os.path.abspath(path)
+    font = _field_fonts.get(key)
+    if font is None:
+        if not HAS_FITZ:
+            raise ImportError("PyMuPDF не установлен. Установите его: pip install PyMuPDF")
+        font = _field_fonts[key] = FieldFont(path)
+    return font
@@ -0,0 +1,199 @@
+"""
+Профили кодирования изображения путевого листа
+
+Профиль задает DPI рендера, цвет (RGB или оттенки серого), формат и параметры сжатия.
+Адаптивный профиль перебирает кандидатов от дешевого к дорогому и выбирает первый,
+который укладывается в целевой размер и не теряет читаемость из-за сжатия (по PSNR
+относительно рендера). Минимальное разрешение задается самими кандидатами.
+"""
+import io
+import logging
+import math
+import time
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+try:
+    from PIL import Image, ImageChops
+    HAS_PIL = True
+except ImportError:
+    HAS_PIL = False
+
+EncodingProfile = namedtuple(
+    'EncodingProfile',
+    ['name', 'format', 'dpi', 'grayscale', 'quality', 'progressive', 'optimize'],
+    defaults=('JPEG', 200, False, 95, False, True)
+)
+
+AdaptiveProfile = namedtuple(
+    'AdaptiveProfile',
+    ['name', 'candidates', 'target_bytes', 'min_psnr'],
+    defaults=(300 * 1024, 30.0)
+)
+
+# Результат кодирования для отчетов
+EncodeStats = namedtuple('EncodeStats', ['profile', 'format', 'dpi', 'size', 'encode_ms', 'psnr'],
+                         defaults=(None,))
+
+DEFAULT_PROFILES = {
+    # Как раньше: 200 DPI, RGB, JPEG 95 с оптимизацией Хаффмана
+    'default': EncodingProfile('default', 'JPEG', 200, False, 95, False, True),
+    'fast': EncodingProfile('fast', 'JPEG', 150, False, 80, False, False),
+    'compact': EncodingProfile('compact', 'JPEG', 150, True, 75, True, True),
+    'gray': EncodingProfile('gray', 'JPEG', 200, True, 85, False, False),
+    'webp': EncodingProfile('webp', 'WEBP', 150, False, 80, False, False),
+    'png': EncodingProfile('png', 'PNG', 150, True, None, False, False),
+}
+
+# Кандидаты адаптивного режима - от самого дешевого к самому дорогому
+DEFAULT_PROFILES['adaptive'] = AdaptiveProfile('adaptive', (
+    EncodingProfile('adaptive-gray-150', 'JPEG', 150, True, 75, False, False),
+    EncodingProfile('adaptive-rgb-150', 'JPEG', 150, False, 80, False, False),
+    EncodingProfile('adaptive-gray-200', 'JPEG', 200, True, 80, False, False),
+    EncodingProfile('adaptive-rgb-200', 'JPEG', 200, False, 85, False, False),
+    DEFAULT_PROFILES['default'],
+))
+
+MIME_TYPES = {'JPEG': 'image/jpeg', 'WEBP': 'image/webp', 'PNG': 'image/png'}
+EXTENSIONS = {'JPEG': 'jpg', 'WEBP': 'webp', 'PNG': 'png'}
+
+
+def detect_format(data):
+    """Формат закодированного изображения по сигнатуре: 'JPEG', 'PNG', 'WEBP' или None"""
+    if data[:3] == b'\xff\xd8\xff':
+        return 'JPEG'
+    if data[:8] == b'\x89PNG\r\n\x1a\n':
+        return 'PNG'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'WEBP'
+    return None
+
+
+def get_profile(name, custom_profiles=None):
+    """
+    Возвращает профиль по имени
+
+    Args:
+        name: Имя профиля
+        custom_profiles: Профили из config: {имя: EncodingProfile, AdaptiveProfile или dict полей}
+    """
+    profiles = dict(DEFAULT_PROFILES)
+    custom_profiles = custom_profiles or {}
+    # Сначала обычные профили, затем адаптивные: кандидат может ссылаться на свой профиль по имени
+    adaptive = []
+    for profile_name, profile in custom_profiles.items():
+        if isinstance(profile, dict) and 'candidates' in profile:
+            adaptive.append((profile_name, profile))
+        elif isinstance(profile, dict):
+            profiles[profile_name] = EncodingProfile(name=profile_name, **profile)
+        else:
+            profiles[profile_name] = profile
+    for profile_name, profile in adaptive:
+        profile = dict(profile)
+        candidates = []
+        for index, candidate in enumerate(profile['candidates']):
+            if isinstance(candidate, str):
+                if not isinstance(profiles.get(candidate), EncodingProfile):
+                    raise ValueError(f"Кандидат {candidate} профиля {profile_name} не найден")
+                candidate = profiles[candidate]
+            elif isinstance(candidate, dict):
+                # Кандидат без имени получает уникальное: по имени выбирается его результат
+                candidate = EncodingProfile(**{'name': f"{profile_name}[{index}]", **candidate})
+            candidates.append(candidate)
+        profile['candidates'] = tuple(candidates)
+        profiles[profile_name] = AdaptiveProfile(name=profile_name, **profile)
+    if name not in profiles:
+        raise ValueError(f"Неизвестный профиль изображения: {name}")
+    return profiles[name]
+
+
+def render_dpi(profile):
+    """DPI, с которым нужно рендерить страницу для профиля"""
+    if isinstance(profile, AdaptiveProfile):
+        return max(candidate.dpi for candidate in profile.candidates)
+    return profile.dpi
+
+
+def encode_image(image, profile, source_dpi=None):
+    """
+    Кодирует изображение по профилю
+
+    Args:
+        image: PIL изображение, отрендеренное с source_dpi
+        profile: EncodingProfile
+        source_dpi: DPI рендера (если отличается от profile.dpi - изображение масштабируется)
+
+    Returns:
+        tuple: (байты, EncodeStats)
+    """
+    started = time.perf_counter()
+    if source_dpi and source_dpi != profile.dpi:
+        scale = profile.dpi / source_dpi
+        size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+        image = image.resize(size, Image.BILINEAR, reducing_gap=2.0)
+    if profile.grayscale and image.mode != 'L':
+        image = image.convert('L')
+    elif not profile.grayscale and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+
+    buffer = io.BytesIO()
+    if profile.format == 'JPEG':
+        image.save(buffer, 'JPEG', quality=profile.quality, progressive=profile.progressive,
+                   optimize=profile.optimize)
+    elif profile.format == 'WEBP':
+        image.save(buffer, 'WEBP', quality=profile.quality, method=6 if profile.optimize else 2)
+    elif profile.format == 'PNG':
+        image.save(buffer, 'PNG', optimize=profile.optimize, compress_level=9 if profile.optimize else 1)
+    else:
+        raise ValueError(f"Неподдерживаемый формат: {profile.format}")
+
+    data = buffer.getvalue()
+    stats = EncodeStats(profile.name, profile.format, profile.dpi, len(data),
+                        round((time.perf_counter() - started) * 1000, 2))
+    return data, stats
+
+
+def measure_psnr(reference, data):
+    """
+    PSNR (дБ) закодированного изображения относительно эталона в оттенках серого
+
+    Эталон приводится к размеру изображения, поэтому PSNR отражает только потери сжатия;
+    разрешение (а значит, размер текста в пикселях) задается DPI кандидата.
+    """
+    decoded = Image.open(io.BytesIO(data)).convert('L')
+    if decoded.size != reference.size:
+        reference = reference.resize(decoded.size, Image.BILINEAR, reducing_gap=2.0)
+    histogram = ImageChops.difference(reference, decoded).histogram()
+    pixels = decoded.width * decoded.height
+    mse = sum(count * value * value for value, count in enumerate(histogram)) / pixels
+    if mse == 0:
+        return float('inf')
+    return 10 * math.log10(255 * 255 / mse)
+
+
+def choose_adaptive(image, profile, source_dpi):
+    """
+    Подбирает самого дешевого кандидата, который укладывается в размер и читаемость
+
+    Returns:
+        tuple: (выбранный EncodingProfile, байты, список EncodeStats всех попыток)
+    """
+    reference = image.convert('L')
+    attempts = []
+    best = None
+    for candidate in profile.candidates:
+        data, stats = encode_image(image, candidate, source_dpi)
+        stats = stats._replace(psnr=round(measure_psnr(reference, data), 2))
+        attempts.append(stats)
+        if stats.size <= profile.target_bytes and stats.psnr >= profile.min_psnr:
+            return candidate, data, attempts
+        # Если никто не уложился - берем самый маленький из читаемых, иначе самый читаемый
+        key = (stats.psnr >= profile.min_psnr, -stats.size if stats.psnr >= profile.min_psnr else stats.psnr)
+        if best is None or key > best[0]:
+            best = (key, candidate, data)
+    logger.warning(
+        f"Адаптивный профиль '{profile.name}': ни один кандидат не уложился в "
+        f"{profile.target_bytes} байт при PSNR >= {profile.min_psnr}, выбран '{best[1].name}'"
+    )
+    return best[1], best[2], attempts
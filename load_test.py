@@ -0,0 +1,394 @@
+"""
+Нагрузочный прогон бота против локальной заглушки Telegram Bot API
+
+N водителей одновременно проходят диалог /start → время → пробег. Бот работает в этом же
+процессе на настоящем Application, все запросы к Bot API уходят в FakeBotApi. Водители -
+синтетические telegram_id, закрепленные по кругу за шаблонами из templates/ через временный
+файл записей водителей; состояние диалогов и архив - тоже во временной папке.
+
+Режимы доставки обновлений:
+    polling - бот забирает обновления через getUpdates (как run_polling)
+    webhook - заглушка отправляет POST на вебхук, обновления ставятся в update_queue
+              (как у воркера webhook_server)
+
+Отчет: перцентили задержки ответа на каждом шаге и всего диалога, пропускная способность,
+ошибки по видам и задержка event loop (бот, заглушка и водители работают в одном loop).
+
+Примеры:
+    python load_test.py --drivers 200
+    python load_test.py --drivers 500 --ramp 10 --mode webhook --json load.json
+    python load_test.py --drivers 100 --rounds 3 --think 0.5 --delivery pdf
+"""
+import argparse
+import asyncio
+import glob
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+from benchmark import percentile, summarize, git_commit
+from fake_bot_api import FakeBotApi
+from metrics import REGISTRY
+from pdf_handler import PDFFiller
+from simple_http import SimpleHttpServer, HttpError
+
+logger = logging.getLogger(__name__)
+
+FIRST_DRIVER_ID = 9000000001
+STEPS = ('start', 'time', 'odometer')
+
+# Ответы бота: по первому символу - вид ответа
+REPLY_KINDS = {'⏳': 'busy', '❌': 'error'}
+
+
+def usable_templates(paths):
+    """Шаблоны, в которых есть поля для заполнения (остальные водителю не подойдут)"""
+    filler = PDFFiller()
+    usable = []
+    for path in paths:
+        try:
+            if filler.load_template(path).plan:
+                usable.append(path)
+        except Exception as e:
+            logger.warning(f"Шаблон {path} пропущен: {type(e).__name__}: {e}")
+    return usable
+
+
+def write_driver_records(path, driver_ids, template_paths):
+    """Записи водителей для прогона: водитель i - шаблон i по кругу"""
+    records = {
+        str(driver_id): {'base': os.path.abspath(template_paths[index % len(template_paths)]), 'fields': {}}
+        for index, driver_id in enumerate(driver_ids)
+    }
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(records, f)
+
+
+def configure_bot(bot_module, work_dir, records_path, delivery):
+    """
+    Настройки бота для прогона: записи водителей, состояние и архив во временной папке
+
+    Меняются значения модуля bot (как если бы они были заданы в config.py), поэтому
+    вызывать до создания TaxiBot.
+    """
+    bot_module.DRIVER_RECORDS_BACKEND = 'json'
+    bot_module.DRIVER_RECORDS_PATH = records_path
+    bot_module.BASE_TEMPLATES_DIR = ''  # в записях абсолютные пути
+    bot_module.STATE_DB_PATH = os.path.join(work_dir, 'bot_state.sqlite3')
+    if bot_module.WAYBILL_ARCHIVE_PATH:
+        bot_module.WAYBILL_ARCHIVE_PATH = os.path.join(work_dir, 'waybills.sqlite3')
+    bot_module.WAYBILL_DELIVERY = delivery
+    bot_module.WAYBILL_DELIVERY_DRIVERS = {}
+
+
+class LoopLagMonitor:
+    def __init__(self, interval=0.01):
+        """
+        Задержка event loop: насколько позже запланированного просыпается sleep(interval)
+
+        Args:
+            interval: Период замера в секундах
+        """
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, loop.time() - started - self.interval))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    def summary(self):
+        if not self.samples:
+            return {}
+        result = summarize(self.samples)
+        result['max_ms'] = round(max(self.samples) * 1000, 3)
+        result['p99_9_ms'] = round(percentile(self.samples, 99.9) * 1000, 3)
+        return result
+
+
+class LoadTest:
+    def __init__(self, api, drivers, rounds=1, think=0.0, ramp=0.0, timeout=60.0, busy_retries=5,
+                 busy_delay=1.0):
+        """
+        Args:
+            api: Запущенная FakeBotApi
+            drivers: Список telegram_id водителей
+            rounds: Сколько путевых листов получает каждый водитель (время → пробег после одного /start)
+            think: Пауза водителя между шагами в секундах (случайная, до think)
+            ramp: За сколько секунд стартуют все водители (0 - одновременно)
+            timeout: Сколько секунд ждать ответа бота на шаг
+            busy_retries: Сколько раз водитель повторяет пробег после ответа "перегружен"
+            busy_delay: Пауза перед повтором в секундах
+        """
+        self.api = api
+        self.drivers = drivers
+        self.rounds = rounds
+        self.think = think
+        self.ramp = ramp
+        self.timeout = timeout
+        self.busy_retries = busy_retries
+        self.busy_delay = busy_delay
+        self.latencies = {step: [] for step in STEPS}
+        self.dialog_latencies = []
+        self.errors = {}
+        self.waybills = 0
+        self.upload_bytes = 0
+        self._waiters = {}
+        api.listeners.append(self._on_sent)
+
+    def _on_sent(self, record):
+        waiter = self._waiters.pop(record['chat_id'], None)
+        if waiter is not None and not waiter.done():
+            waiter.set_result(record)
+
+    def _error(self, step, kind):
+        key = f"{step}:{kind}"
+        self.errors[key] = self.errors.get(key, 0) + 1
+
+    async def _ask(self, driver_id, step, text):
+        """
+        Отправляет сообщение водителя и ждет ответ бота
+
+        Returns:
+            tuple: (вид ответа: 'ok', 'busy', 'error', 'timeout' или 'rejected', запись ответа)
+        """
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters[driver_id] = waiter
+        sent_at = time.perf_counter()
+        status = await self.api.deliver_update(self.api.make_text_update(driver_id, text))
+        if status != 200:
+            self._waiters.pop(driver_id, None)
+            self._error(step, f"http_{status}")
+            return 'rejected', None
+        try:
+            record = await asyncio.wait_for(waiter, self.timeout)
+        except asyncio.TimeoutError:
+            self._waiters.pop(driver_id, None)
+            self._error(step, 'timeout')
+            return 'timeout', None
+        kind = REPLY_KINDS.get((record['text'] or '')[:1], 'ok')
+        if kind == 'ok':
+            self.latencies[step].append(record['time'] - sent_at)
+        else:
+            self._error(step, kind)
+        return kind, record
+
+    async def _pause(self):
+        if self.think:
+            await asyncio.sleep(random.uniform(0, self.think))
+
+    async def _drive(self, index, driver_id):
+        if self.ramp:
+            await asyncio.sleep(self.ramp * index / len(self.drivers))
+        kind, _ = await self._ask(driver_id, 'start', '/start')
+        if kind != 'ok':
+            return
+        for _ in range(self.rounds):
+            started = time.perf_counter()
+            await self._pause()
+            start_time = f"{random.randint(0, 23):02d}:{random.randint(0, 59):02d}"
+            kind, _ = await self._ask(driver_id, 'time', start_time)
+            if kind != 'ok':
+                return
+            await self._pause()
+            odometer = str(random.randint(1000, 999999))
+            for _ in range(self.busy_retries + 1):
+                kind, record = await self._ask(driver_id, 'odometer', odometer)
+                if kind != 'busy':
+                    break
+                await asyncio.sleep(self.busy_delay)
+            if kind != 'ok':
+                return
+            if record['method'] not in ('sendPhoto', 'sendDocument'):
+                self._error('odometer', 'unexpected')
+                return
+            self.waybills += 1
+            self.upload_bytes += record['file_size']
+            self.dialog_latencies.append(time.perf_counter() - started)
+
+    async def run(self):
+        """Прогоняет всех водителей; возвращает время прогона в секундах"""
+        started = time.perf_counter()
+        await asyncio.gather(*[self._drive(index, driver_id) for index, driver_id in enumerate(self.drivers)])
+        return time.perf_counter() - started
+
+
+async def start_webhook_endpoint(application, api):
+    """Эндпоинт вебхука в этом процессе: обновления идут в update_queue, как у воркера webhook_server"""
+    from telegram import Update
+
+    async def handle(request):
+        if request.method != 'POST':
+            raise HttpError(405)
+        await application.update_queue.put(Update.de_json(json.loads(request.body), application.bot))
+        return 200, {}
+
+    server = await SimpleHttpServer(handle).start()
+    await application.bot.set_webhook(f"{server.url}/webhook")
+    logger.info(f"Вебхук прогона: {api.webhook_url}")
+    return server
+
+
+async def run_load_test(args, template_paths, work_dir):
+    import bot as bot_module
+
+    driver_ids = [FIRST_DRIVER_ID + index for index in range(args.drivers)]
+    records_path = os.path.join(work_dir, 'drivers.json')
+    write_driver_records(records_path, driver_ids, template_paths)
+    configure_bot(bot_module, work_dir, records_path, args.delivery)
+
+    api = await FakeBotApi().start()
+    taxi_bot = bot_module.TaxiBot(api.token, base_url=api.base_url, updater=args.mode == 'polling',
+                                  metrics_port=None)
+    application = taxi_bot.application
+    webhook_server = None
+    await application.initialize()
+    # post_init: прогрев шаблонов и воркеров - до начала замеров
+    await application.post_init(application)
+    await application.start()
+    if args.mode == 'polling':
+        await application.updater.start_polling(poll_interval=0.0, timeout=10)
+    else:
+        webhook_server = await start_webhook_endpoint(application, api)
+
+    REGISTRY.reset()
+    lag = LoopLagMonitor(args.lag_interval)
+    test = LoadTest(api, driver_ids, rounds=args.rounds, think=args.think, ramp=args.ramp,
+                    timeout=args.timeout, busy_retries=args.busy_retries)
+    lag.start()
+    try:
+        elapsed = await test.run()
+    finally:
+        await lag.stop()
+        if application.updater is not None and application.updater.running:
+            await application.updater.stop()
+        await application.stop()
+        await application.shutdown()
+        await application.post_shutdown(application)
+        if webhook_server is not None:
+            await webhook_server.stop()
+        await api.stop()
+
+    return {
+        'elapsed_s': round(elapsed, 3),
+        'waybills': test.waybills,
+        'expected_waybills': args.drivers * args.rounds,
+        'throughput_per_s': round(test.waybills / elapsed, 2) if elapsed else None,
+        'upload_mb': round(test.upload_bytes / 1024 / 1024, 2),
+        'steps': {step: summarize(samples) for step, samples in test.latencies.items() if samples},
+        'dialog': summarize(test.dialog_latencies) if test.dialog_latencies else {},
+        'errors': dict(sorted(test.errors.items())),
+        'error_rate': round(1 - test.waybills / (args.drivers * args.rounds), 4),
+        'loop_lag': lag.summary(),
+        'scheduler': {
+            'coalesced': taxi_bot.render_scheduler.coalesced,
+            'rejected': taxi_bot.render_scheduler.rejected,
+        },
+        'speculative': {
+            result: REGISTRY.get_counter('waybill_speculative_total', result=result)
+            for result in ('hit', 'miss', 'skipped', 'evicted', 'expired')
+        },
+    }
+
+
+def print_report(result, out):
+    print(f"{'шаг':<10} {'n':>6} {'p50':>9} {'p95':>9} {'p99':>9} {'среднее':>9}", file=out)
+    rows = list(result['steps'].items())
+    if result['dialog']:
+        rows.append(('диалог', result['dialog']))
+    for name, summary in rows:
+        print(f"{name:<10} {summary['n']:>6} {summary['p50_ms']:>9.1f} {summary['p95_ms']:>9.1f} "
+              f"{summary['p99_ms']:>9.1f} {summary['mean_ms']:>9.1f}", file=out)
+    print(f"\nПутевых листов: {result['waybills']} из {result['expected_waybills']} за {result['elapsed_s']} с "
+          f"({result['throughput_per_s']} в секунду, загружено {result['upload_mb']} МБ)", file=out)
+    print(f"Ошибки: {result['error_rate']:.2%} " + (
+        ', '.join(f"{key} {count}" for key, count in result['errors'].items()) or 'нет'), file=out)
+    lag = result['loop_lag']
+    if lag:
+        print(f"Задержка event loop: p50 {lag['p50_ms']:.1f} мс, p99 {lag['p99_ms']:.1f} мс, "
+              f"p99.9 {lag['p99_9_ms']:.1f} мс, максимум {lag['max_ms']:.1f} мс", file=out)
+    speculative = result['speculative']
+    print(f"Планировщик: объединено {result['scheduler']['coalesced']}, отклонено {result['scheduler']['rejected']}; "
+          f"заготовки: попаданий {speculative['hit']}, промахов {speculative['miss']}, "
+          f"пропущено {speculative['skipped']}", file=out)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон бота против заглушки Bot API")
+    parser.add_argument('--drivers', type=int, default=100, help="Водителей одновременно")
+    parser.add_argument('--rounds', type=int, default=1, help="Путевых листов на водителя")
+    parser.add_argument('--mode', choices=('polling', 'webhook'), default='polling')
+    parser.add_argument('--delivery', choices=('photo', 'pdf'), default='photo')
+    parser.add_argument('--templates', nargs='+', default=None,
+                        help="Шаблоны PDF (по умолчанию все templates/*.pdf с полями)")
+    parser.add_argument('--ramp', type=float, default=0.0, help="За сколько секунд стартуют все водители")
+    parser.add_argument('--think', type=float, default=0.0, help="Пауза водителя между шагами, до N секунд")
+    parser.add_argument('--timeout', type=float, default=60.0, help="Ожидание ответа на шаг, секунд")
+    parser.add_argument('--busy-retries', type=int, default=5, help="Повторов пробега после ответа 'перегружен'")
+    parser.add_argument('--lag-interval', type=float, default=0.01, help="Период замера задержки event loop")
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--json', metavar='PATH', help="Сохранить результаты в JSON ('-' - в stdout)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    random.seed(args.seed)
+
+    template_paths = usable_templates(args.templates or sorted(glob.glob(os.path.join('templates', '*.pdf'))))
+    if not template_paths:
+        print("Шаблоны не найдены")
+        return 1
+
+    out = sys.stderr if args.json == '-' else sys.stdout
+    print(f"Водителей: {args.drivers}, шаблонов: {len(template_paths)}, режим: {args.mode}, "
+          f"отправка: {args.delivery}", file=out)
+    work_dir = tempfile.mkdtemp(prefix='load_test_')
+    try:
+        result = asyncio.run(run_load_test(args, template_paths, work_dir))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    print_report(result, out)
+
+    if args.json:
+        report = {
+            'meta': {
+                'commit': git_commit(),
+                'timestamp': datetime.now().isoformat(timespec='seconds'),
+                'cpu_count': os.cpu_count(),
+                'drivers': args.drivers,
+                'rounds': args.rounds,
+                'mode': args.mode,
+                'delivery': args.delivery,
+                'templates': template_paths,
+            },
+            'result': result,
+        }
+        if args.json == '-':
+            json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+        else:
+            with open(args.json, 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+            print(f"Результаты сохранены: {args.json}", file=out)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,103 @@
+import logging
+import os
+import resource
+import sys
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+
+def _read_status_kb(field):
+    """Читает поле из /proc/self/status в байтах (None, если недоступно)"""
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def current_rss_bytes():
+    """Текущий RSS процесса в байтах"""
+    rss = _read_status_kb('VmRSS')
+    if rss is None:
+        rss = peak_rss_bytes()
+    return rss
+
+
+def peak_rss_bytes():
+    """Пиковый RSS процесса в байтах (с момента запуска или последнего reset_peak_rss)"""
+    peak = _read_status_kb('VmHWM')
+    if peak is None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss: килобайты в Linux, байты в macOS
+        if sys.platform != 'darwin':
+            peak *= 1024
+    return peak
+
+
+def reset_peak_rss():
+    """
+    Сбрасывает пиковый RSS до текущего значения (Linux 4.0+)
+
+    Returns:
+        bool: True если сброс поддерживается
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def children_peak_rss_bytes():
+    """Максимальный пиковый RSS среди завершенных дочерних процессов в байтах"""
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    if sys.platform != 'darwin':
+        peak *= 1024
+    return peak
+
+
+# Память отображенных в процесс файлов (по /proc/<pid>/smaps): rss - страницы в памяти процесса,
+# pss - его доля с учетом общих страниц, private - страницы только этого процесса
+MappedMemory = namedtuple('MappedMemory', ['files', 'rss', 'pss', 'private'])
+
+
+def mapped_files_memory(directory, pid='self'):
+    """
+    Сколько памяти процесса занимают отображенные (mmap) файлы из каталога
+
+    Returns:
+        MappedMemory в байтах или None, если smaps недоступен (не Linux, нет прав)
+    """
+    prefix = os.path.join(os.path.abspath(directory), '')
+    files, rss, pss, private = set(), 0, 0, 0
+    current = None
+    try:
+        with open(f'/proc/{pid}/smaps') as smaps:
+            for line in smaps:
+                fields = line.split()
+                if not fields[0].endswith(':'):
+                    # Заголовок отображения: "адреса права смещение устройство inode [путь]"
+                    header = line.split(None, 5)
+                    path = header[5].rstrip('\n') if len(header) > 5 else ''
+                    current = path if path.startswith(prefix) else None
+                    if current is not None:
+                        files.add(current)
+                    continue
+                name = fields[0][:-1]
+                if current is None or name not in ('Rss', 'Pss', 'Private_Clean', 'Private_Dirty'):
+                    continue
+                size = int(fields[1]) * 1024
+                if name == 'Rss':
+                    rss += size
+                elif name == 'Pss':
+                    pss += size
+                elif name in ('Private_Clean', 'Private_Dirty'):
+                    private += size
+    except (OSError, ValueError):
+        return None
+    return MappedMemory(len(files), rss, pss, private)
@@ -0,0 +1,246 @@
+"""
+Метрики генерации путевых листов в формате Prometheus
+
+Длительности этапов собираются через stage(): в основном процессе они сразу попадают в REGISTRY,
+а внутри collect_stages() (в воркерах пула) копятся в словарь, который возвращается вместе
+с результатом задания и записывается в REGISTRY через record_stages().
+
+Эндпоинт: MetricsServer(REGISTRY, port=9108) → GET /metrics, GET /ready (готовность после прогрева)
+"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from simple_http import SimpleHttpServer, HttpError
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+MEMORY_BUCKETS = tuple(mb * 1024 * 1024 for mb in (32, 64, 128, 192, 256, 384, 512, 768, 1024, 2048))
+
+# Гистограммы не в секундах - свои границы корзин
+HISTOGRAM_BUCKETS = {
+    'waybill_job_peak_rss_bytes': MEMORY_BUCKETS,
+}
+
+# Описание метрик: имя → (тип, справка)
+METRICS = {
+    'waybill_stage_duration_seconds': ('histogram', "Длительность этапа генерации путевого листа"),
+    'waybill_queue_wait_seconds': ('histogram', "Ожидание задания в очереди перед выполнением"),
+    'waybill_render_duration_seconds': ('histogram', "Генерация путевого листа целиком, включая очереди"),
+    'waybill_requests_total': ('counter', "Запросы на генерацию путевого листа по результату"),
+    'waybill_errors_total': ('counter', "Ошибки генерации по этапу и типу исключения"),
+    'waybill_speculative_total': ('counter', "Заготовки путевых листов по результату"),
+    'waybill_result_cache_total': ('counter', "Повторные запросы: найден ли готовый путевой лист"),
+    'waybill_job_peak_rss_bytes': ('histogram', "Пиковый RSS воркера за время задания"),
+}
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    pairs = ','.join(f'{name}="{str(value)}"'.replace('\n', ' ') for name, value in labels)
+    return '{' + pairs + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class MetricsRegistry:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """
+        Счетчики, гистограммы и вычисляемые показатели процесса
+
+        Args:
+            buckets: Границы корзин гистограмм в секундах (кроме HISTOGRAM_BUCKETS)
+        """
+        self.buckets = tuple(buckets)
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        """Увеличивает счетчик"""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """Добавляет наблюдение в гистограмму"""
+        key = (name, tuple(sorted(labels.items())))
+        buckets = self._buckets(name)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(buckets), 0.0, 0]
+            counts = histogram[0]
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            histogram[1] += value
+            histogram[2] += 1
+
+    def _buckets(self, name):
+        return HISTOGRAM_BUCKETS.get(name, self.buckets)
+
+    def register_gauge(self, name, func, help_text=''):
+        """Показатель, который вычисляется при каждом запросе метрик: func() → число"""
+        self._gauges[name] = (func, help_text)
+
+    def get_counter(self, name, **labels):
+        return self._counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def get_histogram(self, name, **labels):
+        """(количество, сумма) наблюдений гистограммы"""
+        histogram = self._histograms.get((name, tuple(sorted(labels.items()))))
+        return (histogram[2], histogram[1]) if histogram else (0, 0.0)
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def render(self):
+        """Текст в формате Prometheus exposition 0.0.4"""
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, (list(h[0]), h[1], h[2])) for key, h in self._histograms.items())
+
+        lines = []
+        described = set()
+
+        def describe(name, kind, help_text):
+            if name not in described:
+                described.add(name)
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in counters:
+            describe(name, 'counter', METRICS.get(name, ('', ''))[1])
+            lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+
+        for (name, labels), (counts, total, count) in histograms:
+            describe(name, 'histogram', METRICS.get(name, ('', ''))[1])
+            cumulative = 0
+            for bound, bucket_count in zip(self._buckets(name), counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', _format_value(bound)),))} {cumulative}")
+            lines.append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {count}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(total)}")
+            lines.append(f"{name}_count{_format_labels(labels)} {count}")
+
+        for name, (func, help_text) in sorted(self._gauges.items()):
+            try:
+                value = func()
+            except Exception as e:
+                logger.warning(f"Не удалось вычислить метрику {name}: {e}")
+                continue
+            describe(name, 'gauge', help_text)
+            lines.append(f"{name} {_format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+_local = threading.local()
+
+
+@contextmanager
+def collect_stages():
+    """Собирает длительности этапов текущего потока в словарь вместо REGISTRY"""
+    previous = getattr(_local, 'timings', None)
+    timings = _local.timings = {}
+    try:
+        yield timings
+    finally:
+        _local.timings = previous
+
+
+@contextmanager
+def stage(name):
+    """Замеряет длительность этапа"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        timings = getattr(_local, 'timings', None)
+        if timings is None:
+            REGISTRY.observe('waybill_stage_duration_seconds', elapsed, stage=name)
+        else:
+            timings[name] = timings.get(name, 0.0) + elapsed
+
+
+def record_stages(timings, registry=None):
+    """Записывает длительности этапов, полученные из воркера"""
+    registry = registry or REGISTRY
+    for name, elapsed in timings.items():
+        registry.observe('waybill_stage_duration_seconds', elapsed, stage=name)
+
+
+class SampledLogger:
+    def __init__(self, logger, every=100):
+        """
+        DEBUG-записи для горячего пути: форматируются лениво и пишется только каждая every-я
+
+        Args:
+            logger: logging.Logger
+            every: Писать одну запись из every
+        """
+        self.logger = logger
+        self.every = max(1, every)
+        self._count = 0
+
+    def debug(self, msg, *args):
+        if not self.logger.isEnabledFor(logging.DEBUG):
+            return
+        self._count += 1
+        if (self._count - 1) % self.every == 0:
+            self.logger.debug(msg, *args)
+
+
+class MetricsServer:
+    def __init__(self, registry=None, host='127.0.0.1', port=9108, path='/metrics', ready=None,
+                 ready_path='/ready'):
+        """
+        Локальный HTTP-эндпоинт метрик для Prometheus
+
+        Args:
+            registry: MetricsRegistry (None - REGISTRY)
+            host: Адрес для прослушивания
+            port: Порт
+            path: Путь эндпоинта
+            ready: Функция () → bool для проверки готовности (None - готов всегда)
+            ready_path: Путь проверки готовности: 200 - готов, 503 - еще нет
+        """
+        self.registry = registry or REGISTRY
+        self.path = path
+        self.ready = ready
+        self.ready_path = ready_path
+        self.server = SimpleHttpServer(self._handle, host=host, port=port)
+
+    async def _handle(self, request):
+        if request.path not in (self.path, self.ready_path):
+            raise HttpError(404)
+        if request.method != 'GET':
+            raise HttpError(405)
+        if request.path == self.ready_path:
+            if self.ready is not None and not self.ready():
+                return 503, {'ready': False}
+            return 200, {'ready': True}
+        return 200, self.registry.render(), 'text/plain; version=0.0.4; charset=utf-8'
+
+    async def start(self):
+        await self.server.start()
+        logger.info(f"Метрики доступны на {self.server.url}{self.path}")
+        return self
+
+    async def stop(self):
+        await self.server.stop()
@@ -0,0 +1,255 @@
+"""
+Перенос водителей с отдельных driver_*.pdf на общие базовые шаблоны
+
+Каждый driver_*.pdf сравнивается с базовыми шаблонами: содержимое страниц (текст, изображения,
+графика - без полей формы) и поля формы. Если содержимое совпадает с базой, отличия в значениях
+полей (например telegram_id) сохраняются как запись водителя. Файлы, которые не сводятся ни к одной
+базе, остаются как есть - в отчете перечислены отличия.
+
+Примеры:
+    python migrate_templates.py --init-base templates/driver_665996290.pdf --base-name put_kia.pdf
+    python migrate_templates.py --dry-run --report migration.csv
+    python migrate_templates.py --records templates/drivers.json
+"""
+import argparse
+import csv
+import glob
+import json
+import logging
+import os
+import sys
+from collections import namedtuple
+from pdf_handler import HAS_FITZ, match_field_key
+from template_registry import TemplateRegistry
+from driver_records import DriverRecord, create_driver_records
+
+if HAS_FITZ:
+    import fitz
+
+logger = logging.getLogger(__name__)
+
+# Поле формы: страница, прямоугольник (округленный до пункта) и значение
+FieldInfo = namedtuple('FieldInfo', ['page', 'rect', 'value'])
+
+# Отпечаток шаблона: поля формы и содержимое страниц без полей
+TemplateSignature = namedtuple('TemplateSignature', ['path', 'fields', 'page_sizes', 'texts', 'images', 'drawings'])
+
+# Результат сравнения водителя с базой
+MigrationResult = namedtuple('MigrationResult', ['telegram_id', 'path', 'base', 'status', 'fields', 'differences'])
+
+REPORT_COLUMNS = MigrationResult._fields
+
+RECT_TOLERANCE = 1.0  # пунктов
+MAX_EXAMPLES = 3
+
+
+def _round_rect(rect):
+    return tuple(round(value) for value in rect)
+
+
+def template_signature(path):
+    """Снимает отпечаток шаблона (поля формы удаляются из копии в памяти перед разбором содержимого)"""
+    doc = fitz.open(path)
+    try:
+        fields = {}
+        texts, images, drawings = set(), set(), set()
+        for page in doc:
+            widgets = list(page.widgets())
+            for widget in widgets:
+                if widget.field_name:
+                    fields[widget.field_name] = FieldInfo(page.number, tuple(widget.rect), widget.field_value or '')
+            # Внешний вид полей попадает в get_text - убираем их, чтобы сравнивать только страницу
+            for widget in widgets:
+                page.delete_widget(widget)
+
+            for block in page.get_text('dict')['blocks']:
+                for line in block.get('lines', ()):
+                    for span in line['spans']:
+                        if span['text'].strip():
+                            texts.add((page.number, span['text'].strip(), _round_rect(span['bbox'])))
+            for info in page.get_image_info(hashes=True):
+                images.add((page.number, info['digest'].hex(), _round_rect(info['bbox'])))
+            for drawing in page.get_drawings():
+                drawings.add((page.number, drawing['type'], _round_rect(drawing['rect'])))
+        page_sizes = tuple(_round_rect(page.rect) for page in doc)
+    finally:
+        doc.close()
+    return TemplateSignature(path, fields, page_sizes, frozenset(texts), frozenset(images), frozenset(drawings))
+
+
+def _rects_match(rect_a, rect_b):
+    return all(abs(a - b) <= RECT_TOLERANCE for a, b in zip(rect_a, rect_b))
+
+
+def _describe(items, sign):
+    examples = ', '.join(repr(item[1])[:40] for item in sorted(items)[:MAX_EXAMPLES])
+    return f"{sign}{len(items)} ({examples})"
+
+
+def compare_with_base(driver, base):
+    """
+    Сравнивает отпечатки водителя и базы
+
+    Returns:
+        tuple: (поля водителя для записи, список отличий, которые запись выразить не может)
+    """
+    differences = []
+    if driver.page_sizes != base.page_sizes:
+        differences.append("другой размер или число страниц")
+
+    for kind in ('texts', 'images', 'drawings'):
+        driver_items, base_items = getattr(driver, kind), getattr(base, kind)
+        if driver_items != base_items:
+            differences.append(f"{kind}: {_describe(driver_items - base_items, '+')} "
+                               f"{_describe(base_items - driver_items, '-')}")
+
+    record_fields = {}
+    for name, field in driver.fields.items():
+        base_field = base.fields.get(name)
+        if base_field is None:
+            # Пустое лишнее поле ничего не печатает - его можно не переносить
+            if field.value or match_field_key(name):
+                differences.append(f"поле '{name}' отсутствует в базе")
+            continue
+        if base_field.page != field.page or not _rects_match(base_field.rect, field.rect):
+            differences.append(f"поле '{name}' в базе в другом месте")
+        elif field.value != base_field.value:
+            if base_field.value or match_field_key(name):
+                differences.append(f"поле '{name}': в базе другое постоянное значение")
+            else:
+                record_fields[name] = field.value
+    for name in base.fields:
+        if name not in driver.fields and (match_field_key(name) or base.fields[name].value):
+            differences.append(f"поле '{name}' есть только в базе")
+    return record_fields, differences
+
+
+def migrate(driver_paths, base_paths, base_dir):
+    """
+    Подбирает базу для каждого водителя
+
+    Args:
+        driver_paths: {telegram_id: путь к driver_*.pdf}
+        base_paths: Пути к базовым шаблонам
+        base_dir: Папка базовых шаблонов (имя базы в записи - относительно нее)
+
+    Yields:
+        MigrationResult
+    """
+    bases = [template_signature(path) for path in base_paths]
+    for telegram_id, path in sorted(driver_paths.items()):
+        try:
+            driver = template_signature(path)
+        except Exception as e:
+            yield MigrationResult(telegram_id, path, '', 'error', {}, [f"{type(e).__name__}: {e}"])
+            continue
+
+        best = None
+        for base in bases:
+            record_fields, differences = compare_with_base(driver, base)
+            if best is None or len(differences) < len(best[2]):
+                best = (base, record_fields, differences)
+            if not differences:
+                break
+        if best is None:
+            yield MigrationResult(telegram_id, path, '', 'differs', {}, ["нет базовых шаблонов"])
+            continue
+
+        base, record_fields, differences = best
+        base_name = os.path.relpath(base.path, base_dir)
+        status = 'migrated' if not differences else 'differs'
+        yield MigrationResult(telegram_id, path, base_name, status, record_fields, differences)
+
+
+def init_base(driver_path, output_path):
+    """
+    Создает базовый шаблон из driver_*.pdf: значения полей водителя (например telegram_id)
+    очищаются, поля остаются - их заполнит запись водителя
+
+    Встроенные шрифты не урезаются: Document.subset_fonts теряет соответствие глифов тексту,
+    после чего текст базы не извлекается и ни один водитель с ней не совпадает (см. compare_with_base).
+    """
+    doc = fitz.open(driver_path)
+    try:
+        cleared = []
+        for page in doc:
+            for widget in page.widgets():
+                if widget.field_name and widget.field_value and not match_field_key(widget.field_name):
+                    widget.field_value = ''
+                    widget.update()
+                    cleared.append(widget.field_name)
+        os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+        doc.save(output_path, garbage=3, deflate=True)
+    finally:
+        doc.close()
+    logger.info(f"Базовый шаблон {output_path} создан из {driver_path}, очищены поля: {', '.join(cleared) or 'нет'}")
+    return cleared
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Перенос driver_*.pdf на базовые шаблоны + записи водителей")
+    parser.add_argument('--templates', default='templates', help="Папка с driver_*.pdf")
+    parser.add_argument('--base-dir', default='templates/base', help="Папка с базовыми шаблонами")
+    parser.add_argument('--base', nargs='+', default=None,
+                        help="Базовые шаблоны (по умолчанию все *.pdf в --base-dir)")
+    parser.add_argument('--records', default='templates/drivers.json',
+                        help="Куда сохранить записи (.json или .sqlite3)")
+    parser.add_argument('--report', help="Отчет CSV по водителям")
+    parser.add_argument('--dry-run', action='store_true', help="Только сравнить, записи не сохранять")
+    parser.add_argument('--init-base', metavar='DRIVER_PDF', help="Создать базовый шаблон из файла водителя")
+    parser.add_argument('--base-name', help="Имя файла базы для --init-base (по умолчанию base_<имя файла>)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    if not HAS_FITZ:
+        print("Для переноса нужен PyMuPDF")
+        return 1
+
+    if args.init_base:
+        base_name = args.base_name or f"base_{os.path.basename(args.init_base)}"
+        init_base(args.init_base, os.path.join(args.base_dir, base_name))
+        return 0
+
+    base_paths = args.base or sorted(glob.glob(os.path.join(args.base_dir, '*.pdf')))
+    if not base_paths:
+        print(f"Базовые шаблоны не найдены в {args.base_dir} (создайте их через --init-base)")
+        return 1
+
+    registry = TemplateRegistry(args.templates, watch='off')
+    registry.scan()
+    driver_paths = {info.telegram_id: info.path for info in registry}
+
+    results = list(migrate(driver_paths, base_paths, args.base_dir))
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8', newline='') as f:
+            report = csv.writer(f)
+            report.writerow(REPORT_COLUMNS)
+            for result in results:
+                report.writerow(result._replace(
+                    fields=json.dumps(result.fields, ensure_ascii=False),
+                    differences='; '.join(result.differences)
+                ))
+
+    for result in results:
+        if result.status == 'migrated':
+            print(f"{result.telegram_id}: {result.base} + {result.fields}")
+        else:
+            print(f"{result.telegram_id}: не переносится ({result.base or '-'}): {'; '.join(result.differences)}")
+
+    migrated = [result for result in results if result.status == 'migrated']
+    if migrated and not args.dry_run:
+        backend = 'json' if args.records.endswith('.json') else 'sqlite'
+        records = create_driver_records(backend, path=args.records, base_dir=args.base_dir)
+        try:
+            records.put_many(DriverRecord(result.telegram_id, result.base, result.fields) for result in migrated)
+        finally:
+            records.close()
+        print(f"Записи сохранены: {args.records}. Перенесенные driver_*.pdf больше не используются "
+              f"и могут быть удалены")
+
+    print(f"Перенесено {len(migrated)} из {len(results)} водителей")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
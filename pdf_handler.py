@@ -4,8 +4,19 @@ from datetime import datetime, timedelta
 import pytz
 import logging
 import os
+import tempfile
+from collections import namedtuple
+from cache import LRUCache
+from driver_records import DriverTemplate
+from image_profiles import (EncodingProfile, AdaptiveProfile, EXTENSIONS, get_profile,
+                            render_dpi, encode_image, choose_adaptive)
+from metrics import stage, SampledLogger
+from field_fonts import STANDARD_FONT_CHARS, get_field_font
+from shared_templates import SharedTemplateStore
 
 logger = logging.getLogger(__name__)
+# Подробности по полям и времени - в DEBUG, и то выборочно: это горячий путь
+sampled_log = SampledLogger(logger, every=100)
 
 try:
     import fitz  # PyMuPDF
@@ -21,8 +32,210 @@ except ImportError:
     HAS_PIL = False
     logger.error("Pillow не установлен. Конвертация PDF в JPG недоступна. Установите: pip install Pillow")
 
+# Ключи данных путевого листа в порядке сопоставления с полями формы
+WAYBILL_FIELD_KEYS = (
+    'start_date', 'start_time', 'med_time', 'tech_time', 'departure_time', 'end_time',
+    'end_date', 'med_date', 'tech_date', 'departure_date', 'odometr', 'serial_number'
+)
+
+# Поле формы из плана заполнения: куда и каким размером шрифта вписать значение data_key
+PlannedField = namedtuple('PlannedField', ['field_name', 'data_key', 'page', 'rect', 'font_size'])
+
+# Текст значений со шрифтом font_file: chars - символы, которые покрывает font (None - документу
+# шрифт не нужен, см. _text_writers), pages - TextWriter по страницам
+TextWriters = namedtuple('TextWriters', ['chars', 'font', 'pages'])
+
+# Путевой лист для отправки документом: PDF и превью первой страницы (JPEG или None)
+WaybillPdf = namedtuple('WaybillPdf', ['pdf_bytes', 'thumbnail'])
+
+# Сохранение заполненного PDF для отправки: без неиспользуемых объектов, потоки сжаты
+PDF_SAVE_OPTIONS = {'garbage': 3, 'deflate': True}
+
+
+class TemplateEntry:
+    def __init__(self, path, mtime, data, plan, page_sizes=None, content_rects=None, file_path=None):
+        """
+        Скомпилированный шаблон
+        
+        Args:
+            path: Путь к файлу шаблона
+            mtime: Время изменения файла (st_mtime_ns) на момент компиляции
+            data: Байты PDF без виджетов формы, постоянные значения уже впечатаны
+                  (без PyMuPDF - исходные байты шаблона)
+            plan: Кортеж PlannedField для полей, которые заполняются при каждом запросе
+            page_sizes: Кортеж (ширина, высота) страниц в пунктах
+            content_rects: Кортеж прямоугольников с содержимым страниц в пунктах, включая поля
+                           (для обрезки пустых полей страницы, см. crop_to_content)
+            file_path: Файл общего шаблона (см. shared_templates) - тогда data его отображение (mmap)
+        """
+        self.path = path
+        self.mtime = mtime
+        self.data = data
+        self.plan = plan
+        self.page_sizes = page_sizes
+        self.content_rects = content_rects
+        self.file_path = file_path
+    
+    def open_document(self):
+        """Открывает шаблон в PyMuPDF; общий шаблон - по пути к файлу, без копии байтов в процессе"""
+        if self.file_path is not None:
+            return fitz.open(self.file_path)
+        return fitz.open(stream=self.data, filetype='pdf')
+    
+    @property
+    def size(self):
+        """Примерный объем памяти записи в байтах"""
+        return len(self.data) + 256 * len(self.plan)
+
+
+def get_field_name(field):
+    """Извлекает имя поля из объекта pdfrw"""
+    if hasattr(field, 'T') and field.T:
+        field_name_raw = str(field.T)
+        # Убираем скобки если есть
+        if field_name_raw.startswith('(') and field_name_raw.endswith(')'):
+            return field_name_raw[1:-1]
+        return field_name_raw
+    return None
+
+
+def iter_pdfrw_fields(template):
+    """Возвращает (имя поля, объект поля, номер страницы) для всех полей шаблона pdfrw"""
+    seen = set()
+    for page_num, page in enumerate(template.pages):
+        if page.Annots:
+            for field in page.Annots:
+                field_name = get_field_name(field)
+                if field_name and field_name not in seen:
+                    seen.add(field_name)
+                    yield field_name, field, page_num
+    
+    # Также проверяем поля формы через AcroForm (если есть)
+    acro_form = template.Root.AcroForm if hasattr(template.Root, 'AcroForm') else None
+    if not acro_form or not getattr(acro_form, 'Fields', None):
+        return
+    
+    def process_form_fields(fields, parent_name=''):
+        """Рекурсивно обходит поля формы"""
+        for field in fields:
+            field_name = get_field_name(field)
+            if field_name:
+                full_name = f"{parent_name}.{field_name}" if parent_name else field_name
+                if full_name not in seen:
+                    seen.add(full_name)
+                    yield full_name, field, None
+            # Обрабатываем вложенные поля
+            if hasattr(field, 'Kids') and field.Kids:
+                yield from process_form_fields(field.Kids, parent_name=field_name if field_name else parent_name)
+    
+    yield from process_form_fields(acro_form.Fields)
+
+
+def match_field_key(field_name, keys=WAYBILL_FIELD_KEYS):
+    """Находит ключ данных для поля формы (точное, нормализованное или частичное совпадение)"""
+    field_name_normalized = field_name.strip().lower()
+    for key in keys:
+        key_normalized = key.lower()
+        if (field_name == key or
+            field_name_normalized == key_normalized or
+            field_name_normalized.endswith('.' + key_normalized) or
+            field_name_normalized.startswith(key_normalized + '.')):
+            return key
+    return None
+
+
+def merge_rects(rects):
+    """Объединяет пересекающиеся прямоугольники fitz.Rect"""
+    merged = []
+    for rect in rects:
+        rect = fitz.Rect(rect)
+        changed = True
+        while changed:
+            changed = False
+            for other in merged:
+                if other.intersects(rect):
+                    merged.remove(other)
+                    rect |= other
+                    changed = True
+                    break
+        merged.append(rect)
+    return merged
+
+
+def content_rect(page, extra_rects=()):
+    """Область страницы с видимым содержимым в пунктах (пустой fitz.Rect - страница пустая)"""
+    rect = fitz.Rect()
+    for kind, bbox in page.get_bboxlog():
+        # ignore-* - невидимый текст (например, слой распознавания)
+        if not kind.startswith('ignore'):
+            rect |= bbox
+    for extra in extra_rects:
+        rect |= extra
+    return rect & page.rect
+
+
+class Background:
+    def __init__(self, image, page_offsets):
+        """
+        Растровый фон шаблона: страницы без полей формы, объединенные вертикально
+        
+        Args:
+            image: PIL изображение RGB
+            page_offsets: Смещение по вертикали (в пикселях) начала каждой страницы
+        """
+        self.image = image
+        self.page_offsets = page_offsets
+    
+    @property
+    def size(self):
+        """Объем памяти растра в байтах"""
+        return self.image.width * self.image.height * len(self.image.getbands())
+
+
+class Prerender:
+    def __init__(self, image, page_offsets, page_sizes, values, dpi, profile, adaptive_key, pending_fields,
+                 crop_box=None):
+        """
+        Заранее отрендеренный путевой лист без показаний одометра (см. PDFFiller.prerender_waybill)
+        
+        Args:
+            image: PIL изображение со всеми полями, кроме pending_fields
+            page_offsets: Смещение по вертикали начала каждой страницы
+            page_sizes: Размеры страниц шаблона в пунктах
+            values: Значения полей (без одометра)
+            dpi: Разрешение растра
+            profile: Профиль кодирования
+            adaptive_key: Ключ выбора адаптивного профиля (None - профиль не адаптивный)
+            pending_fields: PlannedField, которые впечатываются в finish_waybill
+            crop_box: Область обрезки в пикселях (None - без обрезки)
+        """
+        self.image = image
+        self.page_offsets = page_offsets
+        self.page_sizes = page_sizes
+        self.values = values
+        self.dpi = dpi
+        self.profile = profile
+        self.adaptive_key = adaptive_key
+        self.pending_fields = pending_fields
+        self.crop_box = crop_box
+    
+    @property
+    def size(self):
+        """Объем памяти растра в байтах"""
+        return self.image.width * self.image.height * len(self.image.getbands())
+
+
 class PDFFiller:
-    def __init__(self, font_name="Helvetica", font_size=10, field_font_sizes=None):
+    # Режимы рендера: 'full' - полный рендер страницы на каждый запрос,
+    # 'overlay' - кэшированный растр фона + отрисовка только значений полей
+    RENDER_MODES = ('full', 'overlay')
+    
+    def __init__(self, font_name="Helvetica", font_size=10, field_font_sizes=None,
+                 cache_size=256, cache_max_bytes=256 * 1024 * 1024,
+                 render_mode='full', background_cache_max_bytes=256 * 1024 * 1024,
+                 template_registry=None, image_profile='default', driver_records=None,
+                 crop_to_content=False, crop_margin=12, pdf_thumbnail_size=320, font_file=None,
+                 shared_templates_dir=None):
         """
         Инициализация PDFFiller с настройками шрифта
         
@@ -31,21 +244,83 @@ class PDFFiller:
             font_size: Размер шрифта по умолчанию (по умолчанию 10)
             field_font_sizes: Словарь с индивидуальными размерами для каждого поля
                              Например: {'start_date': 12, 'serial_number': 10}
+            cache_size: Сколько скомпилированных шаблонов держать в памяти
+            cache_max_bytes: Ограничение памяти кэша шаблонов в байтах
+            render_mode: 'full' или 'overlay' (см. RENDER_MODES)
+            background_cache_max_bytes: Ограничение памяти кэша растров фона в байтах
+            template_registry: TemplateRegistry для поиска шаблонов в памяти
+                               (если None, find_driver_template ищет файл на диске)
+            image_profile: Профиль кодирования изображения - имя из DEFAULT_PROFILES,
+                           EncodingProfile или AdaptiveProfile (см. image_profiles)
+            driver_records: Записи водителей (см. driver_records) - базовый шаблон + поля водителя;
+                            проверяются раньше, чем файлы driver_*.pdf
+            crop_to_content: Обрезать пустые поля страниц вокруг содержимого
+            crop_margin: Отступ от содержимого при обрезке в пунктах
+            pdf_thumbnail_size: Длинная сторона превью PDF-документа в пикселях (None или 0 - без превью;
+                                Telegram принимает превью не больше 320 пикселей)
+            font_file: Файл TTF/OTF для значений полей вне Latin-1 (например DejaVuSans.ttf - с кириллицей);
+                       документ с такими значениями пишется этим шрифтом целиком, остальные -
+                       шрифтом font_name (см. field_fonts)
+            shared_templates_dir: Общий для процессов хоста каталог скомпилированных шаблонов
+                                  (см. shared_templates); None - каждый процесс держит свои копии
         """
+        if render_mode not in self.RENDER_MODES:
+            raise ValueError(f"Неизвестный режим рендера: {render_mode}")
+        
         self.template_path = None
+        self.template_registry = template_registry
+        self.driver_records = driver_records
         self.font_name = font_name
+        self.font_file = font_file
         self.font_size = font_size
         self.field_font_sizes = field_font_sizes or {}
+        self.template_cache = LRUCache(
+            max_items=cache_size,
+            max_bytes=cache_max_bytes,
+            sizeof=lambda entry: entry.size
+        )
+        self.render_mode = render_mode
+        self.background_cache = LRUCache(
+            max_bytes=background_cache_max_bytes,
+            sizeof=lambda background: background.size
+        )
+        self.image_profile = get_profile(image_profile) if isinstance(image_profile, str) else image_profile
+        # Выбор адаптивного профиля: (шаблон, mtime, профиль) -> EncodingProfile
+        self.adaptive_choices = LRUCache(max_items=cache_size)
+        self.crop_to_content = crop_to_content
+        self.crop_margin = crop_margin
+        self.pdf_thumbnail_size = pdf_thumbnail_size
+        self.shared_templates = (SharedTemplateStore(shared_templates_dir)
+                                 if shared_templates_dir and HAS_FITZ else None)
+    
+    def get_options(self):
+        """Параметры конструктора - чтобы создать такой же PDFFiller в другом процессе"""
+        return {
+            'font_name': self.font_name,
+            'font_file': self.font_file,
+            'font_size': self.font_size,
+            'field_font_sizes': dict(self.field_font_sizes),
+            'cache_size': self.template_cache.max_items,
+            'cache_max_bytes': self.template_cache.max_bytes,
+            'render_mode': self.render_mode,
+            'background_cache_max_bytes': self.background_cache.max_bytes,
+            'image_profile': self.image_profile,
+            'crop_to_content': self.crop_to_content,
+            'crop_margin': self.crop_margin,
+            'pdf_thumbnail_size': self.pdf_thumbnail_size,
+            'shared_templates_dir': self.shared_templates.directory if self.shared_templates else None,
+        }
     
-    def set_font(self, font_name, font_size=None):
+    def set_font(self, font_name, font_size=None, font_file=None):
         """
         Устанавливает шрифт для заполнения полей
         
         Args:
             font_name: Название шрифта (Helvetica, Times-Roman, Courier, Arial, DejaVuSans и т.д.)
             font_size: Размер шрифта (если None, остается текущий)
+            font_file: Файл TTF/OTF (если None, используется стандартный шрифт font_name)
         
-        Доступные стандартные шрифты PDF:
+        Доступные стандартные шрифты PDF (только латиница):
         - Helvetica (без засечек, самый популярный)
         - Times-Roman (с засечками)
         - Courier (моноширинный)
@@ -53,12 +328,41 @@ class PDFFiller:
         - ZapfDingbats (символы)
         """
         self.font_name = font_name
+        self.font_file = font_file
         if font_size is not None:
             self.font_size = font_size
+        # Впечатанные в шаблоны значения и размеры полей зависят от шрифта
+        self.template_cache.clear()
+        self.background_cache.clear()
+        self.adaptive_choices.clear()
         logger.info(f"Шрифт установлен: {font_name}, размер: {self.font_size}")
     
+    def find_driver(self, telegram_id, templates_dir="templates"):
+        """
+        Находит шаблон водителя: запись водителя (базовый шаблон + поля) или driver_<id>.pdf
+        
+        Returns:
+            DriverTemplate(path, fields) или None
+        """
+        if self.driver_records is not None:
+            driver = self.driver_records.resolve(telegram_id)
+            if driver is not None:
+                return driver
+        template_path = self.find_driver_template(telegram_id, templates_dir)
+        if template_path is None:
+            return None
+        return DriverTemplate(template_path, {})
+    
     def find_driver_template(self, telegram_id, templates_dir="templates"):
         """Находит файл водителя по Telegram ID в имени файла"""
+        if self.template_registry is not None:
+            # Индекс в памяти - без обращения к диску
+            info = self.template_registry.get(telegram_id)
+            if info is None:
+                logger.warning(f"Шаблон для ID {telegram_id} не найден")
+                return None
+            return info.path
+        
         if not os.path.exists(templates_dir):
             logger.error(f"Папка {templates_dir} не существует")
             return None
@@ -68,7 +372,7 @@ class PDFFiller:
         file_path = os.path.join(templates_dir, expected_filename)
         
         if os.path.exists(file_path):
-            logger.info(f"Найден шаблон для ID {telegram_id}: {expected_filename}")
+            logger.debug("Найден шаблон для ID %s: %s", telegram_id, expected_filename)
             return file_path
         else:
             logger.warning(f"Шаблон для ID {telegram_id} не найден")
@@ -79,9 +383,26 @@ class PDFFiller:
         series = str(random.randint(100000, 999999))
         number = str(random.randint(1000000, 9999999))
         serial_number = f"{series} - {number}"
-        logger.info(f"Сгенерирован номер путевого листа: {serial_number}")
+        sampled_log.debug("Сгенерирован номер путевого листа: %s", serial_number)
         return serial_number
     
+    def validate_time_format(self, time_str):
+        """Проверяет формат времени ЧЧ:MM"""
+        try:
+            time_str = time_str.strip()
+            if ':' not in time_str:
+                return False
+            
+            parts = time_str.split(':')
+            if len(parts) != 2:
+                return False
+            
+            hours, minutes = map(int, parts)
+            return 0 <= hours <= 23 and 0 <= minutes <= 59
+            
+        except (AttributeError, ValueError):
+            return False
+    
     def format_time(self, time_str):
         """Форматирует время в стандартный вид ЧЧ:MM"""
         hours, minutes = map(int, time_str.split(':'))
@@ -91,8 +412,6 @@ class PDFFiller:
         """Рассчитывает все времена на основе времени начала смены"""
         try:
             formatted_start_time = self.format_time(start_time_str)
-            logger.info(f"Расчет времен для: {start_time_str} → {formatted_start_time}")
-            
             now = datetime.now(pytz.timezone('Europe/Moscow'))
             current_date = now.date()
             
@@ -115,215 +434,725 @@ class PDFFiller:
             times['tech_date'] = (start_time + timedelta(minutes=15)).strftime('%d.%m.%Y') 
             times['departure_date'] = (start_time + timedelta(minutes=21)).strftime('%d.%m.%Y')
             
-            logger.info(f"Рассчитанные времена: {times}")
+            sampled_log.debug("Рассчитанные времена для %s: %s", start_time_str, times)
             return times
             
         except Exception as e:
             logger.error(f"Ошибка в calculate_times: {e}")
             raise
     
-    def fill_pdf(self, start_time_str, odometer_value, output_path):
-        """Заполняет PDF шаблон данными"""
-        try:
-            if not self.template_path:
-                raise ValueError("Шаблон не установлен")
-            
-            logger.info(f"Начало заполнения PDF: время={start_time_str}, одометр={odometer_value}")
-            
-            serial_number = self.generate_serial_number()
-            times = self.calculate_times(start_time_str)
-            
-            times['odometr'] = str(odometer_value)
-            times['serial_number'] = serial_number
-            
-            logger.info(f"Все данные для заполнения: {times}")
-            
-            if not os.path.exists(self.template_path):
-                raise FileNotFoundError(f"Шаблон не найден: {self.template_path}")
-            
-            template = pdfrw.PdfReader(self.template_path)
-            
-            # Функция для извлечения имени поля
-            def get_field_name(field):
-                """Извлекает имя поля из объекта pdfrw"""
-                if hasattr(field, 'T') and field.T:
-                    field_name_raw = str(field.T)
-                    # Убираем скобки если есть
-                    if field_name_raw.startswith('(') and field_name_raw.endswith(')'):
-                        return field_name_raw[1:-1]
-                    return field_name_raw
-                return None
-            
-            # Собираем все поля из всех страниц
-            all_fields = {}
-            for page_num, page in enumerate(template.pages):
-                if page.Annots:
-                    for field in page.Annots:
-                        field_name = get_field_name(field)
-                        if field_name:
-                            field_name_normalized = field_name.strip().lower()
-                            all_fields[field_name] = {
-                                'field': field,
-                                'normalized': field_name_normalized,
-                                'page': page_num
-                            }
-                            logger.info(f"Найдено поле на странице {page_num + 1}: '{field_name}' (нормализовано: '{field_name_normalized}')")
-            
-            # Также проверяем поля формы через AcroForm (если есть)
-            if hasattr(template.Root, 'AcroForm') and template.Root.AcroForm:
-                if hasattr(template.Root.AcroForm, 'Fields') and template.Root.AcroForm.Fields:
-                    def process_form_fields(fields, parent_name=''):
-                        """Рекурсивно обрабатывает поля формы"""
-                        for field in fields:
-                            field_name = get_field_name(field)
-                            if field_name:
-                                full_name = f"{parent_name}.{field_name}" if parent_name else field_name
-                                field_name_normalized = full_name.strip().lower()
-                                if full_name not in all_fields:
-                                    all_fields[full_name] = {
-                                        'field': field,
-                                        'normalized': field_name_normalized,
-                                        'page': None
-                                    }
-                                    logger.info(f"Найдено поле формы: '{full_name}' (нормализовано: '{field_name_normalized}')")
-                            # Обрабатываем вложенные поля
-                            if hasattr(field, 'Kids') and field.Kids:
-                                process_form_fields(field.Kids, parent_name=field_name if field_name else parent_name)
-                    
-                    process_form_fields(template.Root.AcroForm.Fields)
+    def build_field_values(self, start_time_str, odometer_value, driver_fields=None, serial_number=None):
+        """
+        Собирает все значения для заполнения полей путевого листа (и поля водителя, если есть)
+        
+        serial_number - номер, выделенный архивом (None - случайный номер без проверки на повтор)
+        """
+        serial_number = serial_number or self.generate_serial_number()
+        values = dict(driver_fields or {})
+        values.update(self.calculate_times(start_time_str))
+        values['odometr'] = str(odometer_value)
+        values['serial_number'] = serial_number
+        return values
+    
+    def load_template(self, template_path):
+        """
+        Возвращает скомпилированный шаблон из кэша
+        
+        Шаблон перекомпилируется, если файл изменился (по mtime)
+        """
+        with stage('template_load'):
+            try:
+                mtime = os.stat(template_path).st_mtime_ns
+            except FileNotFoundError:
+                raise FileNotFoundError(f"Шаблон не найден: {template_path}")
             
-            logger.info(f"Всего найдено полей: {len(all_fields)}")
-            logger.info(f"Доступные данные для заполнения: {list(times.keys())}")
+            entry = self.template_cache.get(template_path)
+            if entry is not None and entry.mtime == mtime:
+                return entry
             
-            # Заполняем поля
-            filled_count = 0
-            for field_name, field_info in all_fields.items():
-                field = field_info['field']
-                field_name_normalized = field_info['normalized']
-                
-                # Ищем соответствие в данных (проверяем точное совпадение и нормализованное)
-                matched_key = None
-                for key in times.keys():
-                    key_normalized = key.lower()
-                    # Проверяем точное совпадение, нормализованное совпадение и частичное совпадение
-                    if (field_name == key or 
-                        field_name_normalized == key_normalized or
-                        field_name_normalized.endswith('.' + key_normalized) or
-                        field_name_normalized.startswith(key_normalized + '.')):
-                        matched_key = key
-                        break
+            if self.shared_templates is not None:
+                entry = self._shared_template(template_path, mtime)
+            else:
+                entry = self._compile_template(template_path, mtime)
+            self.template_cache.put(template_path, entry)
+            return entry
+    
+    def _template_identity(self, template_path):
+        """Шаблон и параметры, от которых зависит результат компиляции"""
+        font_file = os.path.abspath(self.font_file) if self.font_file else None
+        return repr((os.path.abspath(template_path), self.font_name, font_file, self.font_size,
+                     sorted(self.field_font_sizes.items())))
+    
+    def _shared_template(self, template_path, mtime):
+        """
+        Скомпилированный шаблон из общего каталога; если его там нет - компилирует и публикует
+        
+        Байты шаблона - отображение общего файла, а не копия в памяти процесса
+        """
+        identity = self._template_identity(template_path)
+        shared = self.shared_templates.load(identity, mtime)
+        if shared is None:
+            entry = self._compile_template(template_path, mtime)
+            meta = {
+                'plan': [list(field) for field in entry.plan],
+                'page_sizes': entry.page_sizes,
+                'content_rects': entry.content_rects,
+            }
+            shared = self.shared_templates.publish(identity, mtime, entry.data, meta)
+            logger.info(f"Шаблон {template_path} опубликован для других процессов: {shared.path}")
+        meta = shared.meta
+        plan = tuple(PlannedField(name, key, page, tuple(rect), font_size)
+                     for name, key, page, rect, font_size in meta['plan'])
+        return TemplateEntry(template_path, mtime, shared.data, plan,
+                             tuple(tuple(size) for size in meta['page_sizes']),
+                             tuple(tuple(rect) for rect in meta['content_rects']), shared.path)
+    
+    def _compile_template(self, template_path, mtime):
+        """Разбирает шаблон один раз: находит поля, сопоставляет их с данными и убирает виджеты"""
+        with open(template_path, 'rb') as f:
+            raw_data = f.read()
+        
+        if not HAS_FITZ:
+            # Без PyMuPDF flatten невозможен - сохраняем только сопоставление полей
+            template = pdfrw.PdfReader(fdata=raw_data)
+            plan = []
+            for field_name, field, page_num in iter_pdfrw_fields(template):
+                # Поля без ключа путевого листа заполняются из записи водителя по имени поля
+                data_key = match_field_key(field_name) or field_name
+                font_size = self._field_font_size(field_name, data_key)
+                plan.append(PlannedField(field_name, data_key, page_num, None, font_size))
+            logger.info(f"Шаблон {template_path} скомпилирован без PyMuPDF: {len(plan)} полей")
+            return TemplateEntry(template_path, mtime, raw_data, tuple(plan))
+        
+        doc = fitz.open(stream=raw_data, filetype='pdf')
+        try:
+            plan = []
+            static_count = 0
+            writers = self._text_writers()
+            for page in doc:
+                # Изолируем графическое состояние шаблона (q/Q): иначе, например, оставленный
+                # в потоке "3 Tr" делает вставленный текст невидимым
+                if not page.is_wrapped:
+                    page.wrap_contents()
+                with stage('field_discovery'):
+                    widgets = list(page.widgets())
+                for widget in widgets:
+                    field_name = widget.field_name
+                    if not field_name:
+                        continue
+                    data_key = match_field_key(field_name)
+                    font_size = self._field_font_size(field_name, data_key)
+                    rect = tuple(widget.rect)
+                    if data_key:
+                        plan.append(PlannedField(field_name, data_key, page.number, rect, font_size))
+                        sampled_log.debug("Поле '%s' на странице %d → '%s'", field_name, page.number + 1, data_key)
+                    elif widget.field_value:
+                        # Постоянное значение (например, telegram_id) впечатываем один раз
+                        self._insert_field_text(page, rect, widget.field_value, font_size, writers)
+                        static_count += 1
+                    else:
+                        # Пустое поле базового шаблона - значение берется из записи водителя
+                        plan.append(PlannedField(field_name, field_name, page.number, rect, font_size))
+                        sampled_log.debug("Поле '%s' на странице %d → запись водителя", field_name, page.number + 1)
                 
-                if matched_key:
-                    field_value = str(times[matched_key])
-                    
-                    # Обновляем значение поля
-                    field.update(pdfrw.PdfDict(V=field_value))
-                    
-                    # Определяем размер шрифта для этого поля
-                    field_font_size = self.field_font_sizes.get(matched_key, self.font_size)
-                    
-                    # Устанавливаем шрифт через DA (Default Appearance)
-                    da_string = f"/{self.font_name} {field_font_size} Tf 0 g"
-                    field.update(pdfrw.PdfDict(DA=da_string))
-                    
-                    # Устанавливаем выравнивание текста
-                    if not hasattr(field, 'Q') or field.Q is None:
-                        field.update(pdfrw.PdfDict(Q=0))
-                    
-                    # Убеждаемся, что поле не только для чтения
-                    if hasattr(field, 'Ff'):
-                        # Снимаем флаг ReadOnly если он установлен
-                        ff_value = field.Ff if field.Ff else 0
-                        field.update(pdfrw.PdfDict(Ff=ff_value & ~1))  # Убираем бит ReadOnly
-                    
+                # Удаляем виджеты - значения будут впечатаны в содержимое страницы
+                with stage('flatten'):
+                    for widget in widgets:
+                        page.delete_widget(widget)
+            self._write_text(doc, writers)
+            
+            page_sizes = tuple((page.rect.width, page.rect.height) for page in doc)
+            content_rects = tuple(
+                tuple(content_rect(page, [field.rect for field in plan if field.page == page.number]))
+                for page in doc
+            )
+            with stage('flatten'):
+                data = doc.tobytes(garbage=3)
+        finally:
+            doc.close()
+        
+        logger.info(
+            f"Шаблон {template_path} скомпилирован: {len(plan)} полей для заполнения, "
+            f"{static_count} постоянных значений"
+        )
+        return TemplateEntry(template_path, mtime, data, tuple(plan), page_sizes, content_rects)
+    
+    def _field_font_size(self, field_name, data_key=None):
+        """Размер шрифта поля: по имени поля, затем по ключу данных, затем по умолчанию"""
+        if field_name in self.field_font_sizes:
+            return self.field_font_sizes[field_name]
+        return self.field_font_sizes.get(data_key, self.font_size)
+    
+    def _text_writers(self, texts=()):
+        """
+        TextWriter по страницам для шрифта font_file (None - стандартный шрифт PDF)
+        
+        Шрифт - подмножество глифов ровно для символов texts (значений документа) из кэша
+        процесса, а все значения страницы записываются одним write_text - шрифт встраивается
+        в документ один раз и не больше, чем нужно. Если все texts показывает стандартный шрифт,
+        документ пишется им, без встраивания.
+        """
+        if not self.font_file:
+            return None
+        chars = frozenset(''.join(texts))
+        if STANDARD_FONT_CHARS.issuperset(chars):
+            return TextWriters(chars, None, {})
+        return TextWriters(chars, get_field_font(self.font_file).for_chars(chars), {})
+    
+    @staticmethod
+    def _plan_texts(plan, values):
+        """Строки, которые будут впечатаны по плану полей (для подмножества шрифта)"""
+        return [str(values[field.data_key]) for field in plan if values.get(field.data_key)]
+    
+    @staticmethod
+    def _write_text(doc, writers):
+        """Записывает накопленный текст в страницы (см. _text_writers)"""
+        if writers is None:
+            return
+        for page_num, writer in writers.pages.items():
+            writer.write_text(doc[page_num])
+    
+    def _insert_field_text(self, page, rect, value, font_size, writers=None):
+        """
+        Вставляет текст в позицию поля (нижний левый угол с небольшим отступом)
+        
+        writers - из _text_writers: со шрифтом font_file текст копится в TextWriter страницы
+        и попадает в нее только после _write_text
+        """
+        text_point = fitz.Point(rect[0] + 2, rect[3] - 3)
+        text = str(value)
+        if writers is not None and (writers.font is not None or not STANDARD_FONT_CHARS.issuperset(text)):
+            font = writers.font
+            if font is None or not writers.chars.issuperset(text):
+                # Значение, не известное заранее (постоянные значения шаблона), - свое подмножество
+                font = get_field_font(self.font_file).for_chars(text)
+            writer = writers.pages.get(page.number)
+            if writer is None:
+                writer = writers.pages[page.number] = fitz.TextWriter(page.rect, color=(0, 0, 0))
+            writer.append(text_point, text, font=font, fontsize=font_size)
+            return
+        page.insert_text(
+            text_point,
+            text,
+            fontsize=font_size,
+            fontname=self.font_name,
+            color=(0, 0, 0),  # Черный цвет
+            render_mode=0  # Заполнение (fill)
+        )
+    
+    def stamp_fields(self, doc, plan, values):
+        """
+        Впечатывает значения в открытый документ по плану полей
+        
+        Returns:
+            int: Количество заполненных полей
+        """
+        filled_count = 0
+        with stage('fill'):
+            writers = self._text_writers(self._plan_texts(plan, values))
+            for field in plan:
+                field_value = values.get(field.data_key)
+                if not field_value:
+                    continue
+                try:
+                    self._insert_field_text(doc[field.page], field.rect, field_value, field.font_size, writers)
                     filled_count += 1
-                    logger.info(f"✓ Заполнено поле '{field_name}' → '{matched_key}' = '{field_value}'")
-                else:
-                    logger.warning(f"⚠ Поле '{field_name}' не найдено в данных для заполнения")
+                except Exception as e:
+                    logger.warning(f"Не удалось вставить текст в поле '{field.field_name}': {e}")
+            self._write_text(doc, writers)
+        return filled_count
+    
+    def fill_pdf(self, start_time_str, odometer_value, output_path, template_path=None, driver_fields=None):
+        """
+        Заполняет PDF шаблон данными
+        
+        Args:
+            start_time_str: Время начала смены ЧЧ:MM
+            odometer_value: Показания одометра
+            output_path: Путь для сохранения заполненного PDF
+            template_path: Шаблон (если None, используется self.template_path)
+            driver_fields: Поля водителя для базового шаблона (DriverTemplate.fields)
+        """
+        try:
+            template_path = template_path or self.template_path
+            if not template_path:
+                raise ValueError("Шаблон не установлен")
             
-            logger.info(f"Заполнено полей: {filled_count} из {len(all_fields)}")
+            logger.debug("Начало заполнения PDF: время=%s, одометр=%s", start_time_str, odometer_value)
             
-            # Сохраняем PDF с заполненными полями
-            pdfrw.PdfWriter().write(output_path, template)
-            logger.info("PDF успешно сохранен")
+            values = self.build_field_values(start_time_str, odometer_value, driver_fields)
+            entry = self.load_template(template_path)
             
-            # 🔥 ВАЖНО: Flatten полей формы - встраиваем значения в визуальное содержимое страницы
-            # Без этого поля формы не будут видны при конвертации в JPG
             if HAS_FITZ:
+                # Виджеты уже убраны при компиляции: значения сразу впечатываются в страницу
+                pdf_doc = entry.open_document()
                 try:
-                    logger.info("Выполняем flatten полей формы...")
-                    pdf_doc = fitz.open(output_path)
-                    
-                    for page_num in range(len(pdf_doc)):
-                        page = pdf_doc[page_num]
-                        widgets = page.widgets()
-                        
-                        if widgets:
-                            logger.info(f"Найдено {len(widgets)} виджетов на странице {page_num + 1}")
-                            
-                            for widget in widgets:
-                                field_name = widget.field_name
-                                field_value = widget.field_value
-                                
-                                if field_value:
-                                    logger.debug(f"Обрабатываем поле '{field_name}' = '{field_value}'")
-                                    
-                                    # Получаем координаты и параметры поля
-                                    rect = widget.rect
-                                    
-                                    # Определяем размер шрифта
-                                    font_size = self.font_size
-                                    if field_name in self.field_font_sizes:
-                                        font_size = self.field_font_sizes[field_name]
-                                    
-                                    # Вставляем текст на страницу в позицию поля
-                                    # Используем нижний левый угол с небольшим отступом
-                                    text_point = fitz.Point(rect.x0 + 2, rect.y1 - 3)
-                                    
-                                    try:
-                                        page.insert_text(
-                                            text_point,
-                                            str(field_value),
-                                            fontsize=font_size,
-                                            fontname=self.font_name,
-                                            color=(0, 0, 0),  # Черный цвет
-                                            render_mode=0  # Заполнение (fill)
-                                        )
-                                        logger.debug(f"Текст '{field_value}' вставлен в поле '{field_name}'")
-                                    except Exception as e:
-                                        logger.warning(f"Не удалось вставить текст в поле '{field_name}': {e}")
-                            
-                            # Удаляем виджеты после вставки текста
-                            page.delete_widgets()
-                            logger.info(f"Виджеты удалены со страницы {page_num + 1}")
-                    
-                    # Сохраняем обновленный PDF
-                    pdf_doc.save(output_path, incremental=False, encryption=fitz.PDF_ENCRYPT_KEEP)
+                    filled_count = self.stamp_fields(pdf_doc, entry.plan, values)
+                    with stage('write'):
+                        pdf_doc.save(output_path, **PDF_SAVE_OPTIONS)
+                finally:
                     pdf_doc.close()
-                    logger.info("Flatten выполнен успешно - поля формы встроены в визуальное содержимое")
-                except Exception as e:
-                    logger.error(f"Ошибка при flatten PDF: {e}", exc_info=True)
-                    logger.warning("Продолжаем без flatten - поля формы могут не отображаться в JPG")
             else:
                 logger.warning("PyMuPDF не доступен, flatten пропущен. Поля формы могут не отображаться в JPG.")
+                filled_count = self._fill_with_pdfrw(entry, values, output_path)
             
+            logger.debug("Заполнено полей: %d из %d", filled_count, len(entry.plan))
             return output_path
             
         except Exception as e:
             logger.error(f"Ошибка в fill_pdf: {e}")
             raise
     
-    def pdf_to_jpg(self, pdf_path, jpg_path=None, dpi=200):
+    def _fill_with_pdfrw(self, entry, values, output_path):
+        """Заполняет значения полей формы через pdfrw (без flatten)"""
+        template = pdfrw.PdfReader(fdata=bytes(entry.data))
+        planned = {field.field_name: field for field in entry.plan}
+        filled_count = 0
+        for field_name, field, _ in iter_pdfrw_fields(template):
+            planned_field = planned.get(field_name)
+            if planned_field is None:
+                continue
+            field_value = values.get(planned_field.data_key)
+            if not field_value:
+                continue
+            field.update(pdfrw.PdfDict(V=str(field_value)))
+            field.update(pdfrw.PdfDict(DA=f"/{self.font_name} {planned_field.font_size} Tf 0 g"))
+            if not hasattr(field, 'Q') or field.Q is None:
+                field.update(pdfrw.PdfDict(Q=0))
+            if hasattr(field, 'Ff'):
+                # Снимаем флаг ReadOnly если он установлен
+                ff_value = field.Ff if field.Ff else 0
+                field.update(pdfrw.PdfDict(Ff=int(ff_value) & ~1))
+            filled_count += 1
+        with stage('write'):
+            pdfrw.PdfWriter().write(output_path, template)
+        return filled_count
+    
+    def build_pdf_update(self, values, template_path=None):
+        """
+        Заполненный PDF (без полей формы) как скомпилированный шаблон + инкрементальное обновление
+        
+        PDF целиком - base + update. Шаблон общий для всех листов водителя, а обновление
+        с впечатанными значениями занимает несколько килобайт - так архив хранит шаблон один раз.
+        
+        Args:
+            values: Значения полей (см. build_field_values)
+            template_path: Шаблон (если None, используется self.template_path)
+        
+        Returns:
+            tuple: (байты шаблона - bytes или mmap общего шаблона, байты обновления)
+        """
+        entry = self.load_template(template_path or self.template_path)
+        # Инкрементальное сохранение PyMuPDF работает только с файлом
+        fd, tmp_path = tempfile.mkstemp(suffix='.pdf')
+        try:
+            with os.fdopen(fd, 'wb') as tmp_file:
+                tmp_file.write(entry.data)
+            pdf_doc = fitz.open(tmp_path)
+            try:
+                self.stamp_fields(pdf_doc, entry.plan, values)
+                with stage('write'):
+                    pdf_doc.save(tmp_path, incremental=True, encryption=fitz.PDF_ENCRYPT_KEEP)
+            finally:
+                pdf_doc.close()
+            with open(tmp_path, 'rb') as tmp_file:
+                tmp_file.seek(len(entry.data))
+                return entry.data, tmp_file.read()
+        finally:
+            os.unlink(tmp_path)
+    
+    def render_waybill_pdf(self, start_time_str, odometer_value, template_path=None, driver_fields=None,
+                           serial_number=None):
+        """
+        Генерирует путевой лист как PDF для отправки документом - без растеризации и JPEG
+        
+        Значения впечатываются в скомпилированный шаблон (без полей формы), PDF сохраняется
+        со сборкой мусора и сжатием. Превью - первая страница в pdf_thumbnail_size пикселей.
+        
+        Returns:
+            WaybillPdf
+        """
+        if not HAS_FITZ:
+            raise ImportError("PyMuPDF не установлен. Установите его: pip install PyMuPDF")
+        
+        template_path = template_path or self.template_path
+        if not template_path:
+            raise ValueError("Шаблон не установлен")
+        
+        values = self.build_field_values(start_time_str, odometer_value, driver_fields, serial_number)
+        entry = self.load_template(template_path)
+        pdf_doc = entry.open_document()
+        try:
+            filled_count = self.stamp_fields(pdf_doc, entry.plan, values)
+            with stage('write'):
+                pdf_bytes = pdf_doc.tobytes(**PDF_SAVE_OPTIONS)
+            thumbnail = self._render_thumbnail(pdf_doc[0]) if self.pdf_thumbnail_size else None
+        finally:
+            pdf_doc.close()
+        logger.debug("PDF путевого листа сгенерирован: полей %d, размер %d байт, превью %d байт",
+                     filled_count, len(pdf_bytes), len(thumbnail or b''))
+        return WaybillPdf(pdf_bytes, thumbnail)
+    
+    def _render_thumbnail(self, page):
+        """Превью страницы в JPEG: длинная сторона - pdf_thumbnail_size пикселей"""
+        with stage('thumbnail'):
+            zoom = self.pdf_thumbnail_size / max(page.rect.width, page.rect.height)
+            pixmap = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+            return pixmap.tobytes('jpeg', jpg_quality=75)
+    
+    def render_waybill(self, start_time_str, odometer_value, template_path=None, dpi=None, render_mode=None,
+                       quality=None, profile=None, driver_fields=None, serial_number=None):
         """
-        Конвертирует PDF в JPG изображение
+        Генерирует путевой лист целиком в памяти: шаблон → заполнение → рендер → изображение
+        
+        Документ открывается один раз из кэша шаблонов, временные файлы не создаются.
+        
+        Args:
+            start_time_str: Время начала смены ЧЧ:MM
+            odometer_value: Показания одометра
+            template_path: Шаблон (если None, используется self.template_path)
+            dpi: Разрешение изображения (если None, берется из профиля)
+            render_mode: 'full' или 'overlay' (если None, используется self.render_mode)
+            quality: Качество JPEG/WebP (если None, берется из профиля)
+            profile: Профиль кодирования (если None, используется self.image_profile)
+            driver_fields: Поля водителя для базового шаблона (DriverTemplate.fields)
+            serial_number: Номер путевого листа (если None, генерируется случайный)
+        
+        Returns:
+            bytes: содержимое изображения в формате профиля
+        """
+        if not HAS_FITZ:
+            raise ImportError("PyMuPDF не установлен. Установите его: pip install PyMuPDF")
+        
+        if not HAS_PIL:
+            raise ImportError("Pillow не установлен. Установите его: pip install Pillow")
+        
+        template_path = template_path or self.template_path
+        if not template_path:
+            raise ValueError("Шаблон не установлен")
+        
+        values = self.build_field_values(start_time_str, odometer_value, driver_fields, serial_number)
+        entry = self.load_template(template_path)
+        profile = self.resolve_profile(profile, dpi, quality)
+        adaptive_key = None
+        if isinstance(profile, AdaptiveProfile):
+            # Подбор делается один раз на шаблон, дальше сразу кодируем выбранным кандидатом
+            adaptive_key = (entry.path, entry.mtime, profile)
+            profile = self.adaptive_choices.get(adaptive_key) or profile
+        dpi = render_dpi(profile)
+        
+        if (render_mode or self.render_mode) == 'overlay':
+            image, filled_count = self._compose_overlay(entry, values, dpi)
+            page_offsets = self.get_background(entry, dpi).page_offsets
+        else:
+            pdf_doc = entry.open_document()
+            try:
+                filled_count = self.stamp_fields(pdf_doc, entry.plan, values)
+                with stage('rasterize'):
+                    image, page_offsets = self._render_pages(pdf_doc, dpi)
+            finally:
+                pdf_doc.close()
+        
+        crop_box = self._crop_box(entry.content_rects, page_offsets, dpi, image.size)
+        if crop_box:
+            image = image.crop(crop_box)
+        image_bytes, stats = self.encode_image(image, profile, dpi, adaptive_key)
+        logger.debug(
+            "Путевой лист сгенерирован в памяти: полей %d, профиль '%s' (%s, %d DPI), размер %d байт, "
+            "кодирование %s мс", filled_count, stats.profile, stats.format, stats.dpi, stats.size, stats.encode_ms
+        )
+        return image_bytes
+    
+    # Поля, значение которых водитель вводит последним - их впечатывает finish_waybill
+    DEFERRED_FIELD_KEYS = ('odometr',)
+    
+    def prerender_waybill(self, start_time_str, template_path=None, dpi=None, render_mode=None,
+                          quality=None, profile=None, driver_fields=None, serial_number=None):
+        """
+        Рендерит путевой лист без показаний одометра, пока водитель их вводит
+        
+        Все остальные значения (даты, время, номер) известны сразу после ввода времени.
+        Результат дописывается finish_waybill - остаются только одно поле и кодирование.
+        
+        Returns:
+            Prerender
+        """
+        template_path = template_path or self.template_path
+        if not template_path:
+            raise ValueError("Шаблон не установлен")
+        
+        values = self.build_field_values(start_time_str, '', driver_fields, serial_number)
+        for data_key in self.DEFERRED_FIELD_KEYS:
+            values.pop(data_key, None)
+        entry = self.load_template(template_path)
+        profile = self.resolve_profile(profile, dpi, quality)
+        adaptive_key = None
+        if isinstance(profile, AdaptiveProfile):
+            adaptive_key = (entry.path, entry.mtime, profile)
+            profile = self.adaptive_choices.get(adaptive_key) or profile
+        dpi = render_dpi(profile)
+        
+        if (render_mode or self.render_mode) == 'overlay':
+            image, _ = self._compose_overlay(entry, values, dpi)
+            page_offsets = self.get_background(entry, dpi).page_offsets
+        else:
+            pdf_doc = entry.open_document()
+            try:
+                self.stamp_fields(pdf_doc, entry.plan, values)
+                with stage('rasterize'):
+                    image, page_offsets = self._render_pages(pdf_doc, dpi)
+            finally:
+                pdf_doc.close()
+        
+        pending_fields = tuple(field for field in entry.plan if field.data_key in self.DEFERRED_FIELD_KEYS)
+        crop_box = self._crop_box(entry.content_rects, page_offsets, dpi, image.size)
+        return Prerender(image, page_offsets, entry.page_sizes, values, dpi, profile, adaptive_key,
+                         pending_fields, crop_box)
+    
+    def is_prerender_current(self, prerender):
+        """Заготовка еще актуальна: даты не сменились (например, после полуночи)"""
+        times = self.calculate_times(prerender.values.get('start_time', ''))
+        return all(prerender.values.get(key) == value for key, value in times.items())
+    
+    def finish_waybill(self, prerender, odometer_value):
+        """
+        Впечатывает показания одометра в Prerender и кодирует изображение
+        
+        Растр Prerender изменяется на месте - один Prerender используется один раз.
+        
+        Returns:
+            bytes: содержимое изображения в формате профиля
+        """
+        values = {'odometr': str(odometer_value)}
+        self._paste_fields(prerender.image, prerender.page_sizes, prerender.page_offsets,
+                           prerender.pending_fields, values, prerender.dpi)
+        image = prerender.image.crop(prerender.crop_box) if prerender.crop_box else prerender.image
+        image_bytes, stats = self.encode_image(image, prerender.profile, prerender.dpi, prerender.adaptive_key)
+        logger.debug("Путевой лист дописан из заготовки: профиль '%s', размер %d байт", stats.profile, stats.size)
+        return image_bytes
+    
+    def resolve_profile(self, profile=None, dpi=None, quality=None):
+        """
+        Профиль кодирования с учетом явно переданных dpi и quality
+        
+        Args:
+            profile: Имя, EncodingProfile или AdaptiveProfile (если None, используется self.image_profile)
+            dpi: Разрешение вместо указанного в профиле
+            quality: Качество вместо указанного в профиле
+        """
+        profile = profile or self.image_profile
+        if isinstance(profile, str):
+            profile = get_profile(profile)
+        if isinstance(profile, EncodingProfile):
+            overrides = {name: value for name, value in (('dpi', dpi), ('quality', quality)) if value is not None}
+            if overrides:
+                profile = profile._replace(**overrides)
+        return profile
+    
+    def encode_image(self, image, profile, source_dpi, adaptive_key=None):
+        """
+        Кодирует изображение, отрендеренное с source_dpi, по профилю
+        
+        Для AdaptiveProfile перебирает кандидатов и, если передан adaptive_key,
+        запоминает выбор для следующих запросов.
+        
+        Returns:
+            tuple: (байты, EncodeStats)
+        """
+        if not isinstance(profile, AdaptiveProfile):
+            with stage('encode'):
+                return encode_image(image, profile, source_dpi)
+        
+        with stage('encode'):
+            chosen, image_bytes, attempts = choose_adaptive(image, profile, source_dpi)
+        for stats in attempts:
+            logger.info(
+                f"Адаптивный профиль '{profile.name}': кандидат '{stats.profile}' - {stats.size} байт, "
+                f"PSNR {stats.psnr} дБ, кодирование {stats.encode_ms} мс"
+            )
+        logger.info(f"Адаптивный профиль '{profile.name}': выбран '{chosen.name}'")
+        if adaptive_key is not None:
+            self.adaptive_choices.put(adaptive_key, chosen)
+        return image_bytes, next(stats for stats in attempts if stats.profile == chosen.name)
+    
+    def get_background(self, entry, dpi):
+        """Возвращает растр фона шаблона для заданного DPI (рендерится один раз и кэшируется)"""
+        key = (entry.path, entry.mtime, dpi)
+        background = self.background_cache.get(key)
+        if background is None:
+            pdf_doc = entry.open_document()
+            try:
+                with stage('rasterize'):
+                    image, page_offsets = self._render_pages(pdf_doc, dpi)
+            finally:
+                pdf_doc.close()
+            background = Background(image, page_offsets)
+            self.background_cache.put(key, background)
+            logger.info(f"Растр фона {entry.path} ({dpi} DPI) закэширован: {background.size} байт")
+        return background
+    
+    def _compose_overlay(self, entry, values, dpi):
+        """
+        Рисует значения полей поверх кэшированного растра фона
+        
+        Текст вставляется в пустой документ с размерами страниц шаблона, и рендерятся
+        только прямоугольники с текстом - шрифт и сглаживание как при полном рендере.
+        
+        Returns:
+            tuple: (PIL изображение, количество заполненных полей)
+        """
+        background = self.get_background(entry, dpi)
+        with stage('rasterize'):
+            image = background.image.copy()
+        filled_count = self._paste_fields(image, entry.page_sizes, background.page_offsets,
+                                          entry.plan, values, dpi)
+        return image, filled_count
+    
+    def _paste_fields(self, image, page_sizes, page_offsets, plan, values, dpi):
+        """
+        Рисует значения полей поверх растра (изменяет image на месте)
+        
+        Returns:
+            int: Количество заполненных полей
+        """
+        mat = fitz.Matrix(dpi / 72, dpi / 72)
+        
+        text_doc = fitz.open()
+        try:
+            for width, height in page_sizes:
+                text_doc.new_page(width=width, height=height)
+            
+            filled_count = 0
+            clips = [[] for _ in page_sizes]
+            with stage('fill'):
+                writers = self._text_writers(self._plan_texts(plan, values))
+                for field in plan:
+                    field_value = values.get(field.data_key)
+                    if not field_value:
+                        continue
+                    try:
+                        self._insert_field_text(text_doc[field.page], field.rect, field_value, field.font_size,
+                                                writers)
+                    except Exception as e:
+                        logger.warning(f"Не удалось вставить текст в поле '{field.field_name}': {e}")
+                        continue
+                    clips[field.page].append(self._text_clip(field, field_value))
+                    filled_count += 1
+                self._write_text(text_doc, writers)
+            
+            with stage('rasterize'):
+                for page_num, page_clips in enumerate(clips):
+                    page = text_doc[page_num]
+                    # Пересекающиеся области рендерим одним куском, чтобы не накладывать сглаживание дважды
+                    for clip in merge_rects(page_clips):
+                        pix = page.get_pixmap(matrix=mat, clip=clip, alpha=True)
+                        if pix.width and pix.height:
+                            text_img = Image.frombytes("RGBA", [pix.width, pix.height], pix.samples)
+                            offset = (pix.x, pix.y + page_offsets[page_num])
+                            image.paste(text_img, offset, text_img)
+        finally:
+            text_doc.close()
+        
+        return filled_count
+    
+    def _text_clip(self, field, value):
+        """Прямоугольник страницы, который занимает текст поля (см. _insert_field_text)"""
+        x0 = field.rect[0] + 2
+        baseline = field.rect[3] - 3
+        try:
+            text_width = fitz.get_text_length(str(value), fontname=self.font_name, fontsize=field.font_size)
+            if self.font_file:
+                # Документ может быть написан и font_file (ширины глифов подмножества - как у полного шрифта)
+                text_width = max(text_width, get_field_font(self.font_file).full.text_length(str(value),
+                                                                                            fontsize=field.font_size))
+        except Exception:
+            # Неизвестный get_text_length шрифт - берем ширину с запасом
+            text_width = len(str(value)) * field.font_size
+        return fitz.Rect(
+            x0 - 1,
+            baseline - field.font_size * 1.2,
+            x0 + text_width + 1,
+            baseline + field.font_size * 0.4
+        )
+    
+    def _render_document(self, pdf_document, dpi):
+        """
+        Рендерит документ в одно PIL изображение
+        
+        Для многостраничного PDF страницы объединяются вертикально
+        """
+        image, _ = self._render_pages(pdf_document, dpi)
+        return image
+    
+    def _render_pages(self, pdf_document, dpi):
+        """
+        Рендерит все страницы документа в одно PIL изображение
+        
+        Returns:
+            tuple: (PIL изображение, смещения страниц по вертикали в пикселях)
+        """
+        mat = fitz.Matrix(dpi / 72, dpi / 72)  # 72 - стандартный DPI PDF
+        # Размеры растров страниц известны заранее: холст выделяется один раз, страницы
+        # рендерятся в него по одной - в памяти не больше холста и одной страницы
+        page_rects = [page.rect.transform(mat).irect for page in pdf_document]
+        page_offsets = []
+        y_offset = 0
+        for rect in page_rects:
+            page_offsets.append(y_offset)
+            y_offset += rect.height
+        
+        combined_image = None
+        for page, offset in zip(pdf_document, page_offsets):
+            pix = page.get_pixmap(matrix=mat)
+            if len(page_offsets) == 1:
+                return Image.frombytes("RGB", (pix.width, pix.height), pix.samples_mv, 'raw', 'RGB', pix.stride), (0,)
+            if combined_image is None:
+                combined_image = Image.new('RGB', (max(rect.width for rect in page_rects), y_offset), 'white')
+            # RGB Pillow не отображает на чужой буфер: копия страницы есть всегда, но живет только до вставки
+            page_image = Image.frombytes("RGB", (pix.width, pix.height), pix.samples_mv, 'raw', 'RGB', pix.stride)
+            combined_image.paste(page_image, (0, offset))
+            del page_image, pix
+        return combined_image, tuple(page_offsets)
+    
+    def _crop_box(self, content_rects, page_offsets, dpi, image_size):
+        """
+        Область растра с содержимым страниц в пикселях (None - обрезка выключена или не нужна)
+        
+        Args:
+            content_rects: Прямоугольники содержимого страниц в пунктах (см. content_rect)
+            page_offsets: Смещения страниц в растре
+            dpi: Разрешение растра
+            image_size: (ширина, высота) растра
+        """
+        if not self.crop_to_content or not content_rects:
+            return None
+        mat = fitz.Matrix(dpi / 72, dpi / 72)
+        margin = self.crop_margin
+        box = fitz.Rect()
+        for rect, offset in zip(content_rects, page_offsets):
+            rect = fitz.Rect(rect)
+            if rect.is_empty:
+                continue
+            rect = (rect + (-margin, -margin, margin, margin)).transform(mat)
+            box |= rect + (0, offset, 0, offset)
+        box = (box & fitz.Rect(0, 0, *image_size)).irect
+        if box.is_empty or tuple(box) == (0, 0, *image_size):
+            return None
+        return tuple(box)
+    
+    def pdf_to_jpg(self, pdf_path, jpg_path=None, dpi=None, profile=None):
+        """
+        Конвертирует PDF в изображение (JPG или формат профиля)
         
         Args:
             pdf_path: Путь к PDF файлу
-            jpg_path: Путь для сохранения JPG (если None, создается автоматически)
-            dpi: Разрешение изображения (по умолчанию 200)
+            jpg_path: Путь для сохранения изображения (если None, создается автоматически
+                      с расширением формата профиля)
+            dpi: Разрешение изображения (если None, берется из профиля)
+            profile: Профиль кодирования (если None, используется self.image_profile)
         
         Returns:
-            str: Путь к созданному JPG файлу
+            str: Путь к созданному файлу изображения
         """
         if not HAS_FITZ:
             raise ImportError("PyMuPDF не установлен. Установите его: pip install PyMuPDF")
@@ -338,46 +1167,33 @@ class PDFFiller:
             # Открываем PDF
             pdf_document = fitz.open(pdf_path)
             
-            # Если JPG путь не указан, создаем автоматически
-            if jpg_path is None:
-                jpg_path = pdf_path.replace('.pdf', '.jpg')
+            profile = self.resolve_profile(profile, dpi)
+            dpi = render_dpi(profile)
             
-            # Конвертируем первую страницу (или все страницы, если их несколько)
-            # Для многостраничного PDF создаем одно изображение со всеми страницами
-            images = []
-            for page_num in range(len(pdf_document)):
-                page = pdf_document[page_num]
-                # Рендерим страницу как изображение с заданным DPI
-                mat = fitz.Matrix(dpi / 72, dpi / 72)  # 72 - стандартный DPI PDF
-                pix = page.get_pixmap(matrix=mat)
-                images.append(pix)
+            try:
+                page_count = len(pdf_document)
+                with stage('rasterize'):
+                    image, page_offsets = self._render_pages(pdf_document, dpi)
+                if self.crop_to_content:
+                    content_rects = tuple(tuple(content_rect(page)) for page in pdf_document)
+                    crop_box = self._crop_box(content_rects, page_offsets, dpi, image.size)
+                    if crop_box:
+                        image = image.crop(crop_box)
+            finally:
+                pdf_document.close()
             
-            pdf_document.close()
+            image_bytes, stats = self.encode_image(image, profile, dpi)
             
-            # Используем PIL для надежного сохранения в JPG
-            # (уже импортирован в начале файла)
+            # Если путь не указан, создаем автоматически
+            if jpg_path is None:
+                jpg_path = pdf_path.replace('.pdf', f".{EXTENSIONS[stats.format]}")
             
-            if len(images) == 1:
-                # Конвертируем одну страницу в PIL Image и сохраняем как JPG
-                pix = images[0]
-                pil_img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-                pil_img.save(jpg_path, 'JPEG', quality=95, optimize=True)
-                logger.info(f"PDF конвертирован в JPG: {jpg_path} (размер: {os.path.getsize(jpg_path)} байт)")
-            else:
-                # Если несколько страниц - объединяем вертикально
-                total_height = sum(img.height for img in images)
-                max_width = max(img.width for img in images)
-                
-                # Создаем новое изображение для всех страниц
-                combined_image = Image.new('RGB', (max_width, total_height), 'white')
-                y_offset = 0
-                for img in images:
-                    pil_img = Image.frombytes("RGB", [img.width, img.height], img.samples)
-                    combined_image.paste(pil_img, (0, y_offset))
-                    y_offset += img.height
-                
-                combined_image.save(jpg_path, 'JPEG', quality=95, optimize=True)
-                logger.info(f"PDF ({len(images)} страниц) конвертирован в JPG: {jpg_path} (размер: {os.path.getsize(jpg_path)} байт)")
+            with open(jpg_path, 'wb') as jpg_file:
+                jpg_file.write(image_bytes)
+            logger.info(
+                f"PDF ({page_count} стр.) конвертирован в {stats.format}: {jpg_path} "
+                f"(размер: {stats.size} байт, профиль '{stats.profile}', кодирование {stats.encode_ms} мс)"
+            )
             
             return jpg_path
             
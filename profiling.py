@@ -0,0 +1,199 @@
+"""
+Профилирование генерации путевых листов по запросу
+
+Выключено по умолчанию. Включается переменными окружения при запуске или командой
+администратора /profile на ходу:
+    WAYBILL_PROFILE_JOBS=20        - профилировать 20 следующих заданий
+    WAYBILL_PROFILE_SLOW_MS=800    - профилировать все, сохранять задания дольше 800 мс
+    WAYBILL_PROFILE_MEMORY=1       - вместе с cProfile снимать tracemalloc (число - глубина стека)
+    WAYBILL_PROFILE_DIR=profiles   - куда сохранять
+
+Решение принимает основной процесс (ProfilingControl.request) и передает в воркер вместе
+с заданием ProfileRequest; воркер выполняет задание под cProfile (и tracemalloc) и сохраняет:
+    <имя>.prof        - статистика cProfile (python -m pstats, snakeviz)
+    <имя>.txt         - задание, шаблон, длительности этапов, топ функций и выделений памяти
+    <имя>.tracemalloc - снимок tracemalloc (tracemalloc.Snapshot.load)
+
+Без профилирования задание выполняется как обычно - проверка стоит одного сравнения.
+tracemalloc видит только память Python: буферы MuPDF и Pillow в нем не учитываются.
+В режиме вебхука с несколькими процессами /profile включает профилирование в одном процессе,
+переменные окружения - во всех.
+"""
+import cProfile
+import io
+import logging
+import os
+import pstats
+import time
+import tracemalloc
+from collections import namedtuple
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# Профилирование одного задания: slow_threshold - сохранять, только если задание
+# дольше стольких секунд (None - сохранять всегда), memory_frames - глубина стека tracemalloc (0 - без него)
+ProfileRequest = namedtuple('ProfileRequest', ['output_dir', 'slow_threshold', 'memory_frames'])
+
+TOP_FUNCTIONS = 40
+TOP_ALLOCATIONS = 25
+
+
+class ProfilingControl:
+    def __init__(self, output_dir='profiles', memory_frames=0):
+        """
+        Что профилировать - состояние основного процесса
+
+        Args:
+            output_dir: Каталог для сохранения профилей
+            memory_frames: Глубина стека tracemalloc (0 - только cProfile)
+        """
+        self.output_dir = output_dir
+        self.memory_frames = memory_frames
+        self.remaining = 0
+        self.slow_threshold = None
+
+    @classmethod
+    def from_environ(cls, output_dir='profiles', environ=os.environ):
+        """Настройки из WAYBILL_PROFILE_* (см. описание модуля)"""
+        control = cls(environ.get('WAYBILL_PROFILE_DIR') or output_dir)
+        try:
+            control.memory_frames = int(environ.get('WAYBILL_PROFILE_MEMORY') or 0)
+            if environ.get('WAYBILL_PROFILE_JOBS'):
+                control.enable_next(int(environ['WAYBILL_PROFILE_JOBS']))
+            if environ.get('WAYBILL_PROFILE_SLOW_MS'):
+                control.enable_slow(float(environ['WAYBILL_PROFILE_SLOW_MS']) / 1000)
+        except ValueError as e:
+            logger.error(f"Неверные настройки профилирования в окружении: {e}")
+        return control
+
+    @property
+    def enabled(self):
+        return self.remaining > 0 or self.slow_threshold is not None
+
+    def enable_next(self, count, memory_frames=None):
+        """Профилировать count следующих заданий"""
+        self.remaining = max(0, count)
+        if memory_frames is not None:
+            self.memory_frames = memory_frames
+        logger.info(f"Профилирование: {self.describe()}")
+
+    def enable_slow(self, threshold, memory_frames=None):
+        """Профилировать все задания и сохранять те, что дольше threshold секунд"""
+        self.slow_threshold = threshold
+        if memory_frames is not None:
+            self.memory_frames = memory_frames
+        logger.info(f"Профилирование: {self.describe()}")
+
+    def disable(self):
+        self.remaining = 0
+        self.slow_threshold = None
+        logger.info("Профилирование выключено")
+
+    def request(self):
+        """ProfileRequest для очередного задания или None, если профилирование выключено"""
+        if self.remaining > 0:
+            self.remaining -= 1
+            return ProfileRequest(self.output_dir, None, self.memory_frames)
+        if self.slow_threshold is not None:
+            return ProfileRequest(self.output_dir, self.slow_threshold, self.memory_frames)
+        return None
+
+    def describe(self):
+        """Текущее состояние для логов и ответа администратору"""
+        parts = []
+        if self.remaining > 0:
+            parts.append(f"следующие задания: {self.remaining}")
+        if self.slow_threshold is not None:
+            parts.append(f"задания дольше {self.slow_threshold * 1000:.0f} мс")
+        if not parts:
+            return "выключено"
+        memory = f", tracemalloc ({self.memory_frames} кадров)" if self.memory_frames else ""
+        return ", ".join(parts) + memory + f" → {self.output_dir}"
+
+    def recent_dumps(self, limit=5):
+        """Последние сохраненные профили (.txt), новые первыми"""
+        try:
+            names = [name for name in os.listdir(self.output_dir) if name.endswith('.txt')]
+        except OSError:
+            return []
+        paths = [os.path.join(self.output_dir, name) for name in names]
+        return sorted(paths, key=os.path.getmtime, reverse=True)[:limit]
+
+
+def _format_stats(profiler):
+    output = io.StringIO()
+    stats = pstats.Stats(profiler, stream=output)
+    stats.sort_stats('cumulative').print_stats(TOP_FUNCTIONS)
+    return output.getvalue()
+
+
+def _format_allocations(snapshot, peak):
+    lines = [f"Пик памяти Python за задание: {peak / 1024 / 1024:.1f} МБ",
+             f"Топ {TOP_ALLOCATIONS} мест выделения памяти, оставшейся к концу задания:"]
+    for statistic in snapshot.statistics('lineno')[:TOP_ALLOCATIONS]:
+        lines.append(f"  {statistic}")
+    return '\n'.join(lines)
+
+
+def profile_call(request, description, timings, func, *args):
+    """
+    Выполняет func(*args) под cProfile (и tracemalloc) и сохраняет профиль по request
+
+    Args:
+        request: ProfileRequest
+        description: Строки о задании для заголовка (пользователь, шаблон, способ отправки...)
+        timings: Словарь этапов задания (collect_stages) - к моменту сохранения уже заполнен
+
+    Returns:
+        Результат func
+    """
+    # tracemalloc общий на процесс: в пуле потоков его мог уже запустить другой профиль
+    start_tracing = request.memory_frames and not tracemalloc.is_tracing()
+    if start_tracing:
+        tracemalloc.start(request.memory_frames)
+    profiler = cProfile.Profile()
+    started = time.perf_counter()
+    try:
+        profiler.enable()
+        try:
+            return func(*args)
+        finally:
+            profiler.disable()
+    finally:
+        elapsed = time.perf_counter() - started
+        save = request.slow_threshold is None or elapsed >= request.slow_threshold
+        snapshot = peak = None
+        if save and request.memory_frames and tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot()
+            peak = tracemalloc.get_traced_memory()[1]
+        if start_tracing:
+            tracemalloc.stop()
+        if save:
+            try:
+                _save_profile(request, description, timings, elapsed, profiler, snapshot, peak)
+            except Exception as e:
+                logger.error(f"Не удалось сохранить профиль задания: {e}")
+
+
+def _save_profile(request, description, timings, elapsed, profiler, snapshot, peak):
+    os.makedirs(request.output_dir, exist_ok=True)
+    name = f"{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}-{os.getpid()}"
+    base = os.path.join(request.output_dir, name)
+    profiler.dump_stats(base + '.prof')
+
+    threshold = (f" (порог {request.slow_threshold * 1000:.0f} мс)"
+                 if request.slow_threshold is not None else "")
+    lines = list(description)
+    lines.append(f"Процесс: {os.getpid()}, длительность: {elapsed * 1000:.1f} мс{threshold}")
+    lines.append("Этапы:")
+    for stage_name, seconds in sorted(timings.items(), key=lambda item: -item[1]):
+        lines.append(f"  {stage_name:<20} {seconds * 1000:>9.1f} мс")
+    lines.append("")
+    lines.append(_format_stats(profiler))
+    if snapshot is not None:
+        snapshot.dump(base + '.tracemalloc')
+        lines.append(_format_allocations(snapshot, peak))
+    with open(base + '.txt', 'w', encoding='utf-8') as f:
+        f.write('\n'.join(lines) + '\n')
+    logger.info(f"Профиль задания сохранен: {base}.txt ({elapsed * 1000:.0f} мс)")
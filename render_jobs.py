@@ -0,0 +1,348 @@
+import asyncio
+import logging
+import time
+from collections import namedtuple
+from render_pool import (RenderPoolBusy, render_waybill_job, render_waybill_pdf_job, prerender_waybill_job,
+                         archive_pdf_job, build_archive_pdf)
+from metrics import REGISTRY, collect_stages, record_stages, stage
+from memory_stats import peak_rss_bytes, reset_peak_rss
+from profiling import profile_call
+
+logger = logging.getLogger(__name__)
+
+
+class SchedulerBusy(Exception):
+    """Планировщик перегружен - задание отклонено сразу, без ожидания в очереди"""
+
+
+def _freeze(value):
+    """Превращает словари (в том числе вложенные) в отсортированные кортежи пар"""
+    if isinstance(value, dict):
+        return tuple(sorted((key, _freeze(item)) for key, item in value.items()))
+    return value
+
+
+# Способы отправки путевого листа: 'photo' - изображение, 'pdf' - документ без растеризации
+DELIVERY_MODES = ('photo', 'pdf')
+
+
+class WaybillJob(namedtuple('WaybillJob', ['user_id', 'template_path', 'start_time', 'odometer',
+                                           'filler_options', 'dpi', 'driver_fields', 'serial_number',
+                                           'delivery'])):
+    """
+    Неизменяемое задание на генерацию путевого листа
+
+    Несет все, что нужно для рендера: шаблон и поля водителя, введенные данные, выделенный номер,
+    настройки шрифта, профиль изображения и способ отправки, поэтому не зависит от общего состояния PDFFiller.
+    Одинаковые задания равны.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def create(cls, user_id, template_path, start_time, odometer, filler_options=None, dpi=None,
+               driver_fields=None, serial_number=None, delivery='photo'):
+        """
+        Создает задание; filler_options - словарь PDFFiller.get_options(), dpi=None - из профиля изображения,
+        serial_number=None - случайный номер без архива, delivery - один из DELIVERY_MODES
+        """
+        if delivery not in DELIVERY_MODES:
+            raise ValueError(f"Неизвестный способ отправки: {delivery}")
+        return cls(str(user_id), template_path, start_time, str(odometer),
+                   _freeze(filler_options or {}), dpi, _freeze(driver_fields or {}), serial_number, delivery)
+
+    def filler_options_dict(self):
+        """Параметры PDFFiller задания в виде словаря"""
+        options = dict(self.filler_options)
+        if 'field_font_sizes' in options:
+            options['field_font_sizes'] = dict(options['field_font_sizes'])
+        return options
+
+
+def _job_peak_rss(func, *args):
+    """
+    Выполняет func и замеряет пиковый RSS процесса за время выполнения
+
+    В пуле процессов воркер выполняет одно задание за раз, и пик относится к заданию;
+    в пуле потоков это пик всего процесса. Без сброса пика (не Linux) - пик с запуска воркера.
+
+    Returns:
+        tuple: (результат, пиковый RSS в байтах)
+    """
+    reset_peak_rss()
+    result = func(*args)
+    return result, peak_rss_bytes()
+
+
+def _describe_job(job, kind):
+    """Заголовок профиля задания (см. profiling)"""
+    return [
+        f"Задание: {kind}, пользователь {job.user_id}, номер {job.serial_number}, способ отправки {job.delivery}",
+        f"Шаблон: {job.template_path}",
+        f"Время начала смены: {job.start_time}, пробег: {job.odometer}, DPI: {job.dpi}",
+    ]
+
+
+def _render(job):
+    if job.delivery == 'pdf':
+        return _job_peak_rss(render_waybill_pdf_job, job.template_path, job.start_time, job.odometer,
+                             job.filler_options_dict(), dict(job.driver_fields), job.serial_number)
+    return _job_peak_rss(render_waybill_job, job.template_path, job.start_time, job.odometer,
+                         job.filler_options_dict(), job.dpi, dict(job.driver_fields), job.serial_number)
+
+
+def _prerender(job):
+    return _job_peak_rss(prerender_waybill_job, job.template_path, job.start_time, job.filler_options_dict(),
+                         job.dpi, dict(job.driver_fields), job.serial_number)
+
+
+def execute_archive(job, known_base=None, filler=None):
+    """
+    PDF листа задания для архива (ArchivePdf, см. render_pool.archive_pdf_job)
+
+    Args:
+        known_base: SHA-256 шаблона, который уже есть в архиве
+        filler: PDFFiller основного процесса - собрать без пула (None - PDFFiller воркера)
+    """
+    if filler is not None:
+        return build_archive_pdf(filler, job.template_path, job.start_time, job.odometer,
+                                 dict(job.driver_fields), job.serial_number, known_base)
+    return archive_pdf_job(job.template_path, job.start_time, job.odometer, job.filler_options_dict(),
+                           dict(job.driver_fields), job.serial_number, known_base)
+
+
+def execute_job(job, profile=None, archive=False, known_base=None):
+    """
+    Выполняет задание в воркере пула
+
+    Args:
+        profile: ProfileRequest - выполнить под профилировщиком (см. profiling), None - как обычно
+        archive: Собрать и PDF листа для архива (execute_archive) - основному процессу остается
+                 только записать его
+        known_base: SHA-256 шаблона, который уже есть в архиве
+
+    Returns:
+        tuple: (байты изображения или WaybillPdf для delivery='pdf', {этап: секунды}, пиковый RSS,
+               ArchivePdf или None) - метрики воркера передаются вместе с результатом
+    """
+    with collect_stages() as timings:
+        if profile is None:
+            result, peak_rss = _render(job)
+        else:
+            result, peak_rss = profile_call(profile, _describe_job(job, 'рендер'), timings, _render, job)
+        archive_pdf = None
+        if archive:
+            # Этапы архива не смешиваем с этапами рендера - в метрики попадает только общее время
+            with stage('archive'), collect_stages():
+                archive_pdf = execute_archive(job, known_base)
+    return result, timings, peak_rss, archive_pdf
+
+
+def execute_prerender(job, profile=None):
+    """
+    Выполняет заготовку задания в воркере пула (показания одометра задания не используются)
+
+    Returns:
+        tuple: (Prerender, {этап: секунды}, пиковый RSS)
+    """
+    with collect_stages() as timings:
+        if profile is None:
+            prerender, peak_rss = _prerender(job)
+        else:
+            prerender, peak_rss = profile_call(profile, _describe_job(job, 'заготовка'), timings, _prerender, job)
+    return prerender, timings, peak_rss
+
+
+class RenderScheduler:
+    def __init__(self, pool, max_concurrency=None, max_waiting=32, profiling=None):
+        """
+        Планировщик заданий рендера поверх RenderPool
+
+        Args:
+            pool: RenderPool
+            max_concurrency: Сколько заданий выполняется одновременно (None - по числу воркеров пула)
+            max_waiting: Сколько заданий может ждать своей очереди; сверх этого - SchedulerBusy
+            profiling: ProfilingControl - какие задания профилировать (None - никакие)
+        """
+        self.pool = pool
+        self.profiling = profiling
+        self.max_concurrency = max_concurrency or pool.max_workers
+        self.max_waiting = max_waiting
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._inflight = {}
+        self._admitted = 0
+        self.coalesced = 0
+        self.rejected = 0
+
+    @property
+    def admitted(self):
+        """Количество выполняющихся и ожидающих заданий"""
+        return self._admitted
+
+    async def submit(self, job, archive=False, known_base=None):
+        """
+        Выполняет задание и возвращает результат
+
+        Повторное такое же задание пользователя, пока первое выполняется, не запускает
+        второй рендер, а ждет результат первого.
+
+        Args:
+            archive, known_base: Собрать и PDF листа для архива (см. execute_job)
+
+        Returns:
+            tuple: (результат рендера, ArchivePdf или None)
+
+        Raises:
+            SchedulerBusy: если превышен лимит выполняющихся и ожидающих заданий
+        """
+        inflight = self._inflight.get(job.user_id)
+        if inflight is not None and inflight[0] == job:
+            self.coalesced += 1
+            logger.info(f"Повторное задание пользователя {job.user_id} объединено с выполняющимся")
+            return await asyncio.shield(inflight[1])
+
+        if self._admitted >= self.max_concurrency + self.max_waiting:
+            self.rejected += 1
+            raise SchedulerBusy(f"Планировщик перегружен ({self._admitted} заданий)")
+
+        self._admitted += 1
+        task = asyncio.ensure_future(self._run(job, archive, known_base))
+        self._inflight[job.user_id] = (job, task)
+        task.add_done_callback(lambda _, user_id=job.user_id: self._forget(user_id, task))
+        # shield: отмена одного ожидающего не отменяет рендер для объединенных с ним
+        return await asyncio.shield(task)
+
+    def _forget(self, user_id, task):
+        self._admitted -= 1
+        inflight = self._inflight.get(user_id)
+        if inflight is not None and inflight[1] is task:
+            del self._inflight[user_id]
+        if not task.cancelled():
+            # Исключение получают ожидающие; помечаем его извлеченным, чтобы asyncio не ругался
+            task.exception()
+
+    async def _run(self, job, archive, known_base):
+        started = time.perf_counter()
+        async with self._semaphore:
+            REGISTRY.observe('waybill_queue_wait_seconds', time.perf_counter() - started, queue='scheduler')
+            try:
+                profile = self.profiling.request() if self.profiling is not None else None
+                result, timings, peak_rss, archive_pdf = await self.pool.run(execute_job, job, profile,
+                                                                             archive, known_base)
+            except RenderPoolBusy as e:
+                raise SchedulerBusy(str(e)) from e
+            except Exception as e:
+                REGISTRY.inc('waybill_errors_total', stage='render', error=type(e).__name__)
+                raise
+        record_stages(timings)
+        REGISTRY.observe('waybill_job_peak_rss_bytes', peak_rss, job='render')
+        REGISTRY.observe('waybill_render_duration_seconds', time.perf_counter() - started)
+        return result, archive_pdf
+
+
+class SpeculativeRenders:
+    def __init__(self, pool, ttl=300, max_items=32, profiling=None):
+        """
+        Заготовки путевых листов, которые рендерятся, пока водитель вводит пробег
+
+        Заготовка запускается, только если в пуле есть свободный воркер (RenderPool.idle_workers):
+        она не должна отнимать время у настоящих заданий. Поэтому при нагрузке, когда все воркеры
+        заняты, заготовки не запускаются вовсе и выигрыша не дают - это видно по
+        waybill_speculative_total{result="skipped"}.
+
+        Args:
+            pool: RenderPool
+            ttl: Сколько секунд заготовка ждет пробега, потом выбрасывается
+            max_items: Сколько заготовок держать одновременно (растр 200 DPI - около 12 МБ)
+            profiling: ProfilingControl - какие заготовки профилировать (None - никакие)
+        """
+        self.pool = pool
+        self.profiling = profiling
+        self.ttl = ttl
+        self.max_items = max_items
+        self._entries = {}  # user_id → (задание без пробега, задача, время запуска)
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def _key(job):
+        return job._replace(odometer='')
+
+    def start(self, job):
+        """
+        Запускает заготовку для задания (показания одометра не важны)
+
+        Returns:
+            bool: False, если пул занят и заготовка не запущена
+        """
+        self.discard(job.user_id, reason=None)
+        if not self.pool.idle_workers:
+            REGISTRY.inc('waybill_speculative_total', result='skipped')
+            return False
+        while len(self._entries) >= self.max_items:
+            oldest = min(self._entries, key=lambda user_id: self._entries[user_id][2])
+            self.discard(oldest, reason='evicted')
+        task = asyncio.ensure_future(self._run(job))
+        # Если заготовку так и не заберут, ошибка не должна попасть в лог как необработанная
+        task.add_done_callback(lambda done: done.cancelled() or done.exception())
+        self._entries[job.user_id] = (self._key(job), task, time.monotonic())
+        # Водитель так и не ввел пробег - освобождаем память, не дожидаясь следующих заготовок
+        asyncio.get_running_loop().call_later(self.ttl, self._expire, job.user_id, task)
+        return True
+
+    async def _run(self, job):
+        profile = self.profiling.request() if self.profiling is not None else None
+        prerender, timings, peak_rss = await self.pool.run(execute_prerender, job, profile)
+        record_stages(timings)
+        REGISTRY.observe('waybill_job_peak_rss_bytes', peak_rss, job='prerender')
+        return prerender
+
+    async def take(self, job):
+        """
+        Забирает заготовку для задания
+
+        Returns:
+            Prerender или None, если заготовки нет, она устарела, не подходит к заданию или не удалась
+        """
+        entry = self._entries.pop(job.user_id, None)
+        if entry is None:
+            REGISTRY.inc('waybill_speculative_total', result='miss')
+            return None
+        key, task, started_at = entry
+        if key != self._key(job) or time.monotonic() - started_at > self.ttl:
+            task.cancel()
+            REGISTRY.inc('waybill_speculative_total', result='miss')
+            return None
+        try:
+            prerender = await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not task.cancelled():
+                task.cancel()
+                raise  # отменено само ожидание, а не заготовка
+            # Заготовку отменили (истек срок или пул заменен) - лист рендерится планировщиком
+            REGISTRY.inc('waybill_speculative_total', result='miss')
+            return None
+        except Exception as e:
+            logger.warning(f"Заготовка для пользователя {job.user_id} не удалась: {type(e).__name__}: {e}")
+            REGISTRY.inc('waybill_speculative_total', result='miss')
+            return None
+        REGISTRY.inc('waybill_speculative_total', result='hit')
+        return prerender
+
+    def discard(self, user_id, reason='discarded'):
+        """Выбрасывает заготовку пользователя (например, после /start)"""
+        entry = self._entries.pop(str(user_id), None)
+        if entry is None:
+            return
+        entry[1].cancel()
+        if reason:
+            REGISTRY.inc('waybill_speculative_total', result=reason)
+
+    def _expire(self, user_id, task):
+        entry = self._entries.get(user_id)
+        if entry is not None and entry[1] is task:
+            self.discard(user_id, reason='expired')
+
+    def clear(self):
+        for user_id in list(self._entries):
+            self.discard(user_id, reason=None)
@@ -0,0 +1,255 @@
+import asyncio
+import hashlib
+import logging
+import os
+import time
+from concurrent.futures import BrokenExecutor, ProcessPoolExecutor, ThreadPoolExecutor
+from pdf_handler import PDFFiller
+from metrics import REGISTRY
+from waybill_archive import ArchivePdf
+
+logger = logging.getLogger(__name__)
+
+
+class RenderPoolBusy(Exception):
+    """Очередь пула переполнена - задание не принято"""
+
+
+class RenderTimeout(Exception):
+    """Задание не уложилось в отведенное время"""
+
+
+class RenderInterrupted(Exception):
+    """Задание прервано заменой пула из-за чужого зависшего задания - его можно повторить"""
+
+
+# PDFFiller воркера: создается один раз на процесс и переиспользуется,
+# вместе с ним переиспользуется и кэш скомпилированных шаблонов
+_worker_fillers = {}
+
+
+def get_worker_filler(filler_options=None):
+    """Возвращает PDFFiller текущего процесса с заданными параметрами PDFFiller.get_options()"""
+    filler_options = filler_options or {}
+    key = (os.getpid(), repr(sorted(filler_options.items())))
+    filler = _worker_fillers.get(key)
+    if filler is None:
+        filler = PDFFiller(**filler_options)
+        _worker_fillers[key] = filler
+    return filler
+
+
+def render_waybill_job(template_path, start_time, odometer, filler_options=None, dpi=None, driver_fields=None,
+                       serial_number=None):
+    """
+    Полный цикл генерации путевого листа внутри воркера:
+    заполнение + flatten + рендер + кодирование по профилю изображения, целиком в памяти
+
+    Args:
+        dpi: Разрешение (None - из профиля image_profile в filler_options)
+        driver_fields: Поля водителя для базового шаблона
+        serial_number: Номер путевого листа (None - случайный)
+
+    Returns:
+        bytes: содержимое изображения
+    """
+    filler = get_worker_filler(filler_options)
+    return filler.render_waybill(start_time, odometer, template_path=template_path, dpi=dpi,
+                                 driver_fields=driver_fields, serial_number=serial_number)
+
+
+def render_waybill_pdf_job(template_path, start_time, odometer, filler_options=None, driver_fields=None,
+                           serial_number=None):
+    """
+    Путевой лист в PDF для отправки документом - без рендера в изображение (см. PDFFiller.render_waybill_pdf)
+
+    Returns:
+        WaybillPdf
+    """
+    filler = get_worker_filler(filler_options)
+    return filler.render_waybill_pdf(start_time, odometer, template_path=template_path,
+                                     driver_fields=driver_fields, serial_number=serial_number)
+
+
+def prerender_waybill_job(template_path, start_time, filler_options=None, dpi=None, driver_fields=None,
+                          serial_number=None):
+    """
+    Заготовка путевого листа без показаний одометра (см. PDFFiller.prerender_waybill)
+
+    Returns:
+        Prerender: растр передается обратно в основной процесс, где дописывается finish_waybill
+    """
+    filler = get_worker_filler(filler_options)
+    return filler.prerender_waybill(start_time, template_path=template_path, dpi=dpi,
+                                    driver_fields=driver_fields, serial_number=serial_number)
+
+
+def archive_pdf_job(template_path, start_time, odometer, filler_options=None, driver_fields=None,
+                    serial_number=None, known_base=None):
+    """
+    PDF выданного листа для архива: шаблон + инкрементальное обновление (PDFFiller.build_pdf_update)
+
+    Собирается в воркере, чтобы основной процесс только записывал его в SQLite.
+
+    Args:
+        known_base: SHA-256 шаблона, который архив уже хранит - тогда байты шаблона не пересылаются
+
+    Returns:
+        ArchivePdf
+    """
+    return build_archive_pdf(get_worker_filler(filler_options), template_path, start_time, odometer,
+                             driver_fields, serial_number, known_base)
+
+
+def build_archive_pdf(filler, template_path, start_time, odometer, driver_fields=None, serial_number=None,
+                      known_base=None):
+    """ArchivePdf, собранный заданным PDFFiller (см. archive_pdf_job)"""
+    values = filler.build_field_values(start_time, odometer, driver_fields, serial_number)
+    base_pdf, pdf_update = filler.build_pdf_update(values, template_path)
+    digest = hashlib.sha256(base_pdf).hexdigest()
+    # bytes(): общий шаблон - отображение файла (mmap), его не передать в другой процесс
+    return ArchivePdf(values, digest, None if digest == known_base else bytes(base_pdf), pdf_update)
+
+
+def _call_with_start_time(func, *args):
+    """Выполняет func в воркере и сообщает, когда выполнение началось (для времени ожидания в очереди)"""
+    started_at = time.time()
+    return started_at, func(*args)
+
+
+class RenderPool:
+    def __init__(self, kind='process', max_workers=None, max_queue=32, job_timeout=30,
+                 max_jobs_per_worker=200):
+        """
+        Пул воркеров для тяжелых CPU-задач (заполнение и рендер PDF)
+
+        Args:
+            kind: 'process' (по умолчанию) или 'thread'
+            max_workers: Количество воркеров (None - по числу ядер)
+            max_queue: Сколько заданий может ждать свободного воркера сверх занятых
+            job_timeout: Таймаут одного задания в секундах (None - без таймаута)
+            max_jobs_per_worker: После скольких заданий процесс-воркер заменяется новым, остальные
+                                 воркеры продолжают работать (None или 0 - без замены; только 'process')
+        """
+        if kind not in ('process', 'thread'):
+            raise ValueError(f"Неизвестный тип пула: {kind}")
+
+        self.kind = kind
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.max_queue = max_queue
+        self.job_timeout = job_timeout
+        self.max_jobs_per_worker = max_jobs_per_worker
+
+        self._executor = None
+        self._pending = 0
+        self._closed = False
+
+    @property
+    def pending(self):
+        """
+        Количество заданий в работе и в очереди
+
+        Задание перестает учитываться, только когда действительно завершилось в воркере:
+        зависшее задание после таймаута учитывается, пока старый пул не остановлен.
+        """
+        return self._pending
+
+    @property
+    def idle_workers(self):
+        """Сколько воркеров сейчас свободно (задания в очереди занимают воркеры наперед)"""
+        return max(0, self.max_workers - self._pending)
+
+    def _job_finished(self, loop):
+        """Вызывается из потока executor, когда задание завершилось, отменено или воркер убит"""
+        try:
+            loop.call_soon_threadsafe(self._release)
+        except RuntimeError:
+            # Цикл событий уже закрыт - считать некому
+            pass
+
+    def _release(self):
+        self._pending -= 1
+
+    def _create_executor(self):
+        if self.kind == 'process':
+            # Воркер заменяется по одному после max_jobs_per_worker заданий (Python 3.11+;
+            # с этим параметром воркеры запускаются через spawn)
+            return ProcessPoolExecutor(max_workers=self.max_workers,
+                                       max_tasks_per_child=self.max_jobs_per_worker or None)
+        return ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='render')
+
+    def _get_executor(self):
+        """Возвращает текущий executor (создается при первом задании)"""
+        if self._executor is None:
+            self._executor = self._create_executor()
+        return self._executor
+
+    def _replace_hung_executor(self):
+        """
+        Заменяет executor с зависшим заданием новым
+
+        Процессы старого пула завершаются: иначе зависший воркер продолжает работать и держать
+        память. Задания, которые выполнялись в других его воркерах или ждали в его очереди,
+        получают RenderInterrupted (их можно повторить). Зависший поток прервать нельзя -
+        он останется до конца задания.
+        """
+        old_executor = self._executor
+        self._executor = self._create_executor()
+        processes = list((getattr(old_executor, '_processes', None) or {}).values())
+        old_executor.shutdown(wait=False, cancel_futures=True)
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        logger.warning(f"Пул воркеров пересоздан после таймаута задания, завершено процессов: {len(processes)}")
+
+    async def run(self, func, *args):
+        """
+        Выполняет func(*args) в пуле и возвращает результат
+
+        Raises:
+            RenderPoolBusy: если очередь переполнена
+            RenderTimeout: если задание не уложилось в job_timeout
+            RenderInterrupted: если пул заменен из-за чужого зависшего задания
+        """
+        if self._closed:
+            raise RuntimeError("Пул воркеров остановлен")
+
+        if self._pending >= self.max_workers + self.max_queue:
+            raise RenderPoolBusy(f"Очередь пула переполнена ({self._pending} заданий)")
+
+        loop = asyncio.get_running_loop()
+        executor = self._get_executor()
+        submitted_at = time.time()
+        job = executor.submit(_call_with_start_time, func, *args)
+        self._pending += 1
+        # Счетчик уменьшается по завершении задания в executor, а не по возврату из run:
+        # после таймаута задание еще выполняется, пока его воркер не завершен
+        job.add_done_callback(lambda _: self._job_finished(loop))
+        future = asyncio.wrap_future(job)
+        # Результат брошенного после таймаута задания никто не заберет - это не ошибка
+        future.add_done_callback(lambda done: done.cancelled() or done.exception())
+        try:
+            started_at, result = await asyncio.wait_for(asyncio.shield(future), timeout=self.job_timeout)
+        except asyncio.TimeoutError:
+            # Какой воркер завис, неизвестно - заменяем пул целиком
+            if executor is self._executor:
+                self._replace_hung_executor()
+            raise RenderTimeout(f"Задание не выполнено за {self.job_timeout} с")
+        except asyncio.CancelledError:
+            if job.cancelled() and executor is not self._executor:
+                # Задание ждало в очереди пула, который заменили
+                raise RenderInterrupted("Задание снято с очереди при замене пула воркеров") from None
+            raise
+        except BrokenExecutor as e:
+            if executor is not self._executor:
+                raise RenderInterrupted("Воркер завершен при замене пула после чужого таймаута") from e
+            raise
+        REGISTRY.observe('waybill_queue_wait_seconds', max(0.0, started_at - submitted_at), queue='pool')
+        return result
+
+    def shutdown(self, wait=True):
+        """Останавливает пул"""
+        self._closed = True
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait, cancel_futures=True)
+            self._executor = None
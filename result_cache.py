@@ -0,0 +1,86 @@
+"""
+Кэш готовых путевых листов для повторных запросов
+
+Водитель, не дождавшись фото, часто отправляет те же время и пробег еще раз. Повтор не
+рендерится заново (и не получает новый номер): отправляется тот же результат, а после
+первой отправки - по file_id Telegram, без повторной загрузки. Способ отправки (фото или PDF)
+входит в задание, а значит и в ключ.
+"""
+import logging
+import os
+from cache import LRUCache
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+
+class CachedWaybill:
+    def __init__(self, content=None, file_id=None, serial_number=None):
+        """
+        Готовый путевой лист
+
+        Args:
+            content: Байты изображения или WaybillPdf (None - уже загружено, есть file_id)
+            file_id: file_id фото или документа в Telegram после первой отправки
+            serial_number: Номер листа в архиве (None - без архива)
+        """
+        self.content = content
+        self.file_id = file_id
+        self.serial_number = serial_number
+
+    @property
+    def size(self):
+        """Объем памяти записи в байтах"""
+        if isinstance(self.content, tuple):
+            # WaybillPdf: PDF и превью
+            return sum(len(part or b'') for part in self.content) + 256
+        return len(self.content or b'') + 256
+
+
+class ResultCache:
+    def __init__(self, ttl=600, max_items=1000, max_bytes=64 * 1024 * 1024):
+        """
+        Args:
+            ttl: Сколько секунд повтор считается тем же запросом
+            max_items: Максимальное количество записей
+            max_bytes: Ограничение памяти на изображения и PDF в байтах
+        """
+        self._cache = LRUCache(max_items=max_items, max_bytes=max_bytes, sizeof=lambda item: item.size, ttl=ttl)
+
+    def __len__(self):
+        return len(self._cache)
+
+    @property
+    def total_bytes(self):
+        return self._cache.total_bytes
+
+    @staticmethod
+    def make_key(job, start_date):
+        """
+        Ключ запроса: задание (водитель, шаблон и поля водителя, время, пробег, настройки),
+        версия шаблона и дата смены. Номер в ключ не входит: повтор получает лист с уже выданным номером
+
+        Returns:
+            tuple или None, если шаблон недоступен (такой запрос не кэшируется)
+        """
+        try:
+            template_version = os.stat(job.template_path).st_mtime_ns
+        except OSError:
+            return None
+        return job._replace(serial_number=None), template_version, start_date
+
+    def get(self, key):
+        """CachedWaybill или None"""
+        cached = self._cache.get(key) if key is not None else None
+        REGISTRY.inc('waybill_result_cache_total', result='hit' if cached is not None else 'miss')
+        return cached
+
+    def put(self, key, content=None, file_id=None, serial_number=None):
+        if key is None:
+            return
+        # После загрузки достаточно file_id - содержимое больше не держим
+        self._cache.put(key, CachedWaybill(None if file_id else content, file_id, serial_number))
+
+    def discard(self, key):
+        if key is not None:
+            self._cache.pop(key)
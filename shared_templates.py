@@ -0,0 +1,166 @@
+"""
+Скомпилированные шаблоны, общие для всех процессов хоста
+
+Каждый воркер и каждый процесс бота держал свою копию скомпилированного шаблона (около 1 МБ),
+и память росла как воркеры × шаблоны. Здесь шаблон компилируется один раз: первый процесс
+записывает PDF и план полей в общий каталог, остальные только отображают файл (mmap)
+и открывают его в PyMuPDF по пути. Страницы файла лежат в страничном кэше ОС в одном
+экземпляре на хост; в процессе остаются только затронутые страницы отображения, и они общие.
+
+Для каталога подходит /dev/shm (tmpfs) или любой локальный диск. Файлы называются по шаблону,
+параметрам шрифта и mtime; устаревшие версии удаляются при публикации новой. Каталог можно
+очистить целиком, когда бот остановлен.
+
+Отчет о памяти шаблонов по процессам хоста:
+    python shared_templates.py /dev/shm/taxi_templates
+"""
+import argparse
+import hashlib
+import json
+import logging
+import mmap
+import os
+import tempfile
+from collections import namedtuple
+from memory_stats import mapped_files_memory
+
+logger = logging.getLogger(__name__)
+
+# Опубликованный шаблон: path - файл PDF, data - его отображение (mmap, только чтение), meta - план полей
+SharedTemplate = namedtuple('SharedTemplate', ['path', 'data', 'meta'])
+
+
+def map_file(path):
+    """Отображает файл в память только для чтения (копии в памяти процесса не создается)"""
+    with open(path, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class SharedTemplateStore:
+    def __init__(self, directory):
+        """
+        Args:
+            directory: Общий каталог скомпилированных шаблонов (создается при необходимости)
+        """
+        self.directory = os.path.abspath(directory)
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _prefix(self, identity):
+        return hashlib.sha256(identity.encode('utf-8')).hexdigest()[:24] + '-'
+
+    def _paths(self, identity, version):
+        base = os.path.join(self.directory, f"{self._prefix(identity)}{version}")
+        return base + '.pdf', base + '.json'
+
+    def load(self, identity, version):
+        """
+        Опубликованный шаблон или None
+
+        Args:
+            identity: Строка, однозначно задающая шаблон и параметры компиляции
+            version: Версия исходного файла (mtime)
+        """
+        pdf_path, meta_path = self._paths(identity, version)
+        try:
+            # План публикуется после PDF: есть план - есть и PDF
+            with open(meta_path, encoding='utf-8') as f:
+                meta = json.load(f)
+            data = map_file(pdf_path)
+        except (OSError, ValueError):
+            return None
+        return SharedTemplate(pdf_path, data, meta)
+
+    def publish(self, identity, version, data, meta):
+        """
+        Публикует скомпилированный шаблон и возвращает его отображение
+
+        Если другой процесс успел опубликовать тот же шаблон раньше, используется его файл -
+        на хосте остается одна копия.
+        """
+        pdf_path, meta_path = self._paths(identity, version)
+        self._write_once(pdf_path, data)
+        self._write_once(meta_path, json.dumps(meta).encode('utf-8'))
+        self._remove_stale(identity, version)
+        return SharedTemplate(pdf_path, map_file(pdf_path), meta)
+
+    def _write_once(self, path, data):
+        """Атомарно создает файл; существующий файл не перезаписывается"""
+        if os.path.exists(path):
+            return
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            # mkstemp создает файл только для владельца, а читать его могут процессы других пользователей
+            os.chmod(tmp_path, 0o644)
+            try:
+                os.link(tmp_path, path)
+            except FileExistsError:
+                pass
+        finally:
+            os.unlink(tmp_path)
+
+    def _remove_stale(self, identity, version):
+        """Удаляет прежние версии шаблона (уже отображенные в процессы файлы остаются доступны им)"""
+        prefix = self._prefix(identity)
+        current = f"{prefix}{version}."
+        for name in os.listdir(self.directory):
+            if name.startswith(prefix) and not name.startswith(current):
+                try:
+                    os.unlink(os.path.join(self.directory, name))
+                except OSError as e:
+                    logger.warning(f"Не удалось удалить устаревший шаблон {name}: {e}")
+
+    def disk_bytes(self):
+        """Сколько занимают опубликованные шаблоны (одна копия на хост)"""
+        total = 0
+        for name in os.listdir(self.directory):
+            if name.endswith('.pdf'):
+                try:
+                    total += os.path.getsize(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+        return total
+
+    def memory(self, pid='self'):
+        """MappedMemory шаблонов в процессе (см. memory_stats.mapped_files_memory)"""
+        return mapped_files_memory(self.directory, pid)
+
+
+def host_report(directory):
+    """
+    Память шаблонов по процессам хоста, которые отображают файлы каталога
+
+    Returns:
+        list: (pid, команда, MappedMemory) - только процессы с отображенными шаблонами
+    """
+    report = []
+    for pid in sorted((name for name in os.listdir('/proc') if name.isdigit()), key=int):
+        memory = mapped_files_memory(directory, pid)
+        if not memory or not memory.files:
+            continue
+        try:
+            with open(f'/proc/{pid}/cmdline', 'rb') as f:
+                command = f.read().replace(b'\0', b' ').decode('utf-8', 'replace').strip()
+        except OSError:
+            command = ''
+        report.append((int(pid), command, memory))
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Память общих шаблонов по процессам хоста')
+    parser.add_argument('directory', help='Каталог общих шаблонов (SHARED_TEMPLATES_DIR)')
+    args = parser.parse_args()
+
+    store = SharedTemplateStore(args.directory)
+    mb = 1024 * 1024
+    print(f"Шаблоны на диске/в tmpfs (одна копия на хост): {store.disk_bytes() / mb:.1f} МБ")
+    print(f"{'PID':>7} {'файлов':>6} {'RSS МБ':>8} {'PSS МБ':>8} {'личн. МБ':>9}  команда")
+    for pid, command, memory in host_report(store.directory):
+        print(f"{pid:>7} {memory.files:>6} {memory.rss / mb:>8.2f} {memory.pss / mb:>8.2f} "
+              f"{memory.private / mb:>9.2f}  {command[:60]}")
+
+
+if __name__ == '__main__':
+    main()
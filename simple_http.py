@@ -0,0 +1,152 @@
+"""
+Минимальный HTTP/1.1 сервер на asyncio для служебных эндпоинтов
+
+Без внешних зависимостей: разбор запроса, ответ и keep-alive. Подходит для вебхука
+Telegram, локальной заглушки Bot API и эндпоинта метрик - не для публичного веб-сервера.
+"""
+import asyncio
+import json
+import logging
+from collections import namedtuple
+from urllib.parse import urlsplit, parse_qsl
+
+logger = logging.getLogger(__name__)
+
+HttpRequest = namedtuple('HttpRequest', ['method', 'path', 'query', 'headers', 'body'])
+
+STATUS_TEXT = {
+    200: 'OK', 204: 'No Content', 400: 'Bad Request', 401: 'Unauthorized', 403: 'Forbidden',
+    404: 'Not Found', 405: 'Method Not Allowed', 413: 'Payload Too Large',
+    500: 'Internal Server Error', 503: 'Service Unavailable',
+}
+
+MAX_HEADER_LINES = 100
+
+
+class HttpError(Exception):
+    def __init__(self, status, message=''):
+        super().__init__(message or STATUS_TEXT.get(status, ''))
+        self.status = status
+
+
+async def read_request(reader, max_body=10 * 1024 * 1024):
+    """
+    Читает один HTTP-запрос из потока
+
+    Returns:
+        HttpRequest или None, если клиент закрыл соединение
+    """
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    try:
+        method, target, _ = request_line.decode('latin-1').split(' ', 2)
+    except ValueError:
+        raise HttpError(400, "Некорректная строка запроса")
+
+    headers = {}
+    for _ in range(MAX_HEADER_LINES):
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    else:
+        raise HttpError(400, "Слишком много заголовков")
+
+    try:
+        length = int(headers.get('content-length') or 0)
+    except ValueError:
+        raise HttpError(400, "Некорректный Content-Length")
+    if length < 0:
+        raise HttpError(400, "Некорректный Content-Length")
+    if length > max_body:
+        raise HttpError(413)
+    body = await reader.readexactly(length) if length else b''
+
+    url = urlsplit(target)
+    return HttpRequest(method.upper(), url.path, dict(parse_qsl(url.query)), headers, body)
+
+
+def build_response(status, body=b'', content_type='application/json', keep_alive=True):
+    """Собирает байты HTTP-ответа; dict/list в body сериализуются в JSON"""
+    if isinstance(body, (dict, list)):
+        body = json.dumps(body, ensure_ascii=False).encode('utf-8')
+    elif isinstance(body, str):
+        body = body.encode('utf-8')
+    head = (
+        f"HTTP/1.1 {status} {STATUS_TEXT.get(status, '')}\r\n"
+        f"Content-Type: {content_type}\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+    )
+    return head.encode('latin-1') + body
+
+
+class SimpleHttpServer:
+    def __init__(self, handler, host='127.0.0.1', port=0, max_body=10 * 1024 * 1024):
+        """
+        Args:
+            handler: async функция (HttpRequest) -> (status, body[, content_type])
+            host: Адрес для прослушивания
+            port: Порт (0 - любой свободный)
+            max_body: Максимальный размер тела запроса
+        """
+        self.handler = handler
+        self.host = host
+        self.port = port
+        self.max_body = max_body
+        self._server = None
+        self._connections = set()
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        """Перестает принимать соединения и закрывает открытые"""
+        if self._server is None:
+            return
+        self._server.close()
+        for writer in list(self._connections):
+            writer.close()
+        await self._server.wait_closed()
+        self._server = None
+
+    async def _handle_connection(self, reader, writer):
+        self._connections.add(writer)
+        try:
+            while True:
+                try:
+                    request = await read_request(reader, self.max_body)
+                except HttpError as e:
+                    writer.write(build_response(e.status, {'ok': False, 'description': str(e)}, keep_alive=False))
+                    await writer.drain()
+                    break
+                if request is None:
+                    break
+
+                try:
+                    result = await self.handler(request)
+                except HttpError as e:
+                    result = (e.status, {'ok': False, 'description': str(e)})
+                except Exception as e:
+                    logger.error(f"Ошибка обработки {request.method} {request.path}: {e}", exc_info=True)
+                    result = (500, {'ok': False, 'description': 'internal error'})
+
+                keep_alive = request.headers.get('connection', '').lower() != 'close'
+                status, body, *content_type = result
+                writer.write(build_response(status, body, *content_type, keep_alive=keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._connections.discard(writer)
+            writer.close()
@@ -0,0 +1,256 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryStateStore:
+    def __init__(self, max_items=10000, ttl=3600):
+        """
+        Состояние диалогов в памяти: LRU с ограничением размера и истечением по TTL
+
+        Args:
+            max_items: Максимальное количество диалогов в памяти
+            ttl: Через сколько секунд без изменений диалог считается брошенным (None - без истечения)
+        """
+        self.max_items = max_items
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, user_id):
+        return self.get(user_id) is not None
+
+    def _is_expired(self, updated_at, now=None):
+        return self.ttl is not None and (now or time.time()) - updated_at > self.ttl
+
+    def get(self, user_id):
+        """Возвращает состояние диалога или None, если его нет или он истек"""
+        user_id = str(user_id)
+        with self._lock:
+            item = self._items.get(user_id)
+            if item is None:
+                return None
+            state, updated_at = item
+            if self._is_expired(updated_at):
+                del self._items[user_id]
+                return None
+            self._items.move_to_end(user_id)
+            return state
+
+    def put(self, user_id, state):
+        """Сохраняет состояние диалога (вызывать после каждого изменения состояния)"""
+        user_id = str(user_id)
+        with self._lock:
+            self._remember(user_id, state, time.time())
+
+    def delete(self, user_id):
+        """Удаляет состояние диалога"""
+        with self._lock:
+            self._items.pop(str(user_id), None)
+
+    def _remember(self, user_id, state, updated_at):
+        self._items[user_id] = (state, updated_at)
+        self._items.move_to_end(user_id)
+        while len(self._items) > self.max_items:
+            self._items.popitem(last=False)
+
+    def expire(self):
+        """Удаляет истекшие диалоги. Возвращает количество удаленных"""
+        if self.ttl is None:
+            return 0
+        now = time.time()
+        with self._lock:
+            expired = [user_id for user_id, (_, updated_at) in self._items.items()
+                       if self._is_expired(updated_at, now)]
+            for user_id in expired:
+                del self._items[user_id]
+        return len(expired)
+
+    def flush(self):
+        """Записывает отложенные изменения (в памяти - ничего не делает)"""
+
+    def close(self):
+        """Закрывает хранилище"""
+        self.flush()
+
+
+class SQLiteStateStore(MemoryStateStore):
+    def __init__(self, path='bot_state.sqlite3', max_items=10000, ttl=3600, flush_interval=1.0,
+                 flush_batch=100):
+        """
+        Состояние диалогов в SQLite (WAL) с LRU-кэшем в памяти и отложенной записью
+
+        Диалоги переживают перезапуск бота. Изменения копятся в памяти и пишутся одной
+        транзакцией раз в flush_interval секунд или при накоплении flush_batch изменений.
+
+        Args:
+            path: Путь к файлу базы SQLite
+            max_items: Сколько диалогов держать в памяти (в базе - без ограничения, кроме TTL)
+            ttl: Через сколько секунд без изменений диалог удаляется (None - без истечения)
+            flush_interval: Период фоновой записи в секундах
+            flush_batch: Количество изменений, после которого запись выполняется сразу
+        """
+        super().__init__(max_items=max_items, ttl=ttl)
+        self.path = path
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+
+        self._dirty = {}
+        self._db_lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS dialog_state ("
+            "user_id TEXT PRIMARY KEY, state TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS dialog_state_updated ON dialog_state(updated_at)")
+
+        self._stop_event = threading.Event()
+        self._flush_event = threading.Event()
+        self._thread = threading.Thread(target=self._flush_loop, name='state-store', daemon=True)
+        self._thread.start()
+        logger.info(f"Хранилище состояний диалогов: {path}")
+
+    def get(self, user_id):
+        user_id = str(user_id)
+        state = super().get(user_id)
+        if state is not None:
+            return state
+
+        with self._lock:
+            pending = self._dirty.get(user_id)
+        if pending is not None:
+            # Изменение еще не записано в базу: вытеснено из памяти до записи или удалено
+            state_json, updated_at = pending
+            if state_json is None or self._is_expired(updated_at):
+                return None
+            return json.loads(state_json)
+
+        with self._db_lock:
+            row = self._db.execute(
+                "SELECT state, updated_at FROM dialog_state WHERE user_id = ?", (user_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        state_json, updated_at = row
+        if self._is_expired(updated_at):
+            return None
+
+        state = json.loads(state_json)
+        with self._lock:
+            # Пока читали базу, состояние могли записать заново
+            if user_id not in self._items:
+                self._remember(user_id, state, updated_at)
+            else:
+                state = self._items[user_id][0]
+        return state
+
+    def put(self, user_id, state):
+        user_id = str(user_id)
+        now = time.time()
+        with self._lock:
+            self._remember(user_id, state, now)
+            self._dirty[user_id] = (json.dumps(state, ensure_ascii=False), now)
+            dirty_count = len(self._dirty)
+        if dirty_count >= self.flush_batch:
+            self._flush_event.set()
+
+    def delete(self, user_id):
+        user_id = str(user_id)
+        with self._lock:
+            self._items.pop(user_id, None)
+            # None в очереди записи - удаление
+            self._dirty[user_id] = (None, time.time())
+
+    def flush(self):
+        """Записывает накопленные изменения одной транзакцией"""
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+        if not dirty:
+            return 0
+
+        upserts = [(user_id, state_json, updated_at)
+                   for user_id, (state_json, updated_at) in dirty.items() if state_json is not None]
+        deletes = [(user_id,) for user_id, (state_json, _) in dirty.items() if state_json is None]
+        try:
+            with self._db_lock:
+                self._db.execute("BEGIN")
+                if upserts:
+                    self._db.executemany(
+                        "INSERT INTO dialog_state (user_id, state, updated_at) VALUES (?, ?, ?) "
+                        "ON CONFLICT(user_id) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at",
+                        upserts
+                    )
+                if deletes:
+                    self._db.executemany("DELETE FROM dialog_state WHERE user_id = ?", deletes)
+                self._db.execute("COMMIT")
+        except sqlite3.Error:
+            with self._db_lock:
+                if self._db.in_transaction:
+                    self._db.execute("ROLLBACK")
+            with self._lock:
+                # Возвращаем изменения в очередь, не затирая более новые
+                for user_id, item in dirty.items():
+                    self._dirty.setdefault(user_id, item)
+            raise
+        return len(dirty)
+
+    def expire(self):
+        """Удаляет истекшие диалоги из памяти и из базы"""
+        expired = super().expire()
+        if self.ttl is not None:
+            with self._db_lock:
+                cursor = self._db.execute(
+                    "DELETE FROM dialog_state WHERE updated_at < ?", (time.time() - self.ttl,)
+                )
+                expired = max(expired, cursor.rowcount)
+        return expired
+
+    def _flush_loop(self):
+        last_expire = time.monotonic()
+        while not self._stop_event.is_set():
+            self._flush_event.wait(self.flush_interval)
+            self._flush_event.clear()
+            try:
+                self.flush()
+                if self.ttl is not None and time.monotonic() - last_expire >= min(self.ttl, 60):
+                    self.expire()
+                    last_expire = time.monotonic()
+            except Exception as e:
+                logger.error(f"Ошибка записи состояний диалогов: {e}", exc_info=True)
+
+    def close(self):
+        """Останавливает фоновую запись, сохраняет изменения и закрывает базу"""
+        self._stop_event.set()
+        self._flush_event.set()
+        self._thread.join(timeout=5)
+        self.flush()
+        with self._db_lock:
+            self._db.close()
+
+
+def create_state_store(backend='sqlite', **options):
+    """
+    Создает хранилище состояний диалогов
+
+    Args:
+        backend: 'sqlite' или 'memory'
+        options: Параметры конструктора выбранного хранилища
+    """
+    if backend == 'sqlite':
+        return SQLiteStateStore(**options)
+    if backend == 'memory':
+        options.pop('path', None)
+        options.pop('flush_interval', None)
+        options.pop('flush_batch', None)
+        return MemoryStateStore(**options)
+    raise ValueError(f"Неизвестное хранилище состояний: {backend}")
@@ -0,0 +1,223 @@
+import logging
+import os
+import re
+import threading
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+try:
+    import inotify_simple
+    HAS_INOTIFY = True
+except ImportError:
+    HAS_INOTIFY = False
+
+# Запись индекса: шаблон водителя и его метаданные на момент сканирования
+TemplateInfo = namedtuple('TemplateInfo', ['telegram_id', 'path', 'mtime', 'size'])
+
+TEMPLATE_FILENAME_RE = re.compile(r'^driver_(\d+)\.pdf$')
+
+
+class TemplateRegistry:
+    def __init__(self, templates_dir="templates", max_depth=2, watch='auto', poll_interval=30,
+                 full_scan_every=10):
+        """
+        Индекс шаблонов водителей в памяти: telegram_id → TemplateInfo
+
+        Шаблоны ищутся в templates_dir и в подпапках-шардах (например templates/66/driver_665996290.pdf).
+        Поиск шаблона не обращается к диску - изменения подхватываются фоновым наблюдателем.
+
+        Args:
+            templates_dir: Папка с шаблонами
+            max_depth: Глубина вложенности шардов (0 - только сама папка)
+            watch: 'auto' (inotify, если доступен, иначе опрос), 'inotify', 'poll' или 'off'
+            poll_interval: Период опроса папок в секундах
+            full_scan_every: Через сколько опросов перепроверять все файлы
+                             (перезапись файла на месте не меняет mtime папки)
+        """
+        if watch not in ('auto', 'inotify', 'poll', 'off'):
+            raise ValueError(f"Неизвестный режим наблюдения: {watch}")
+        if watch == 'inotify' and not HAS_INOTIFY:
+            raise ImportError("inotify_simple не установлен. Установите его: pip install inotify_simple")
+
+        self.templates_dir = templates_dir
+        self.max_depth = max_depth
+        self.watch = watch
+        self.poll_interval = poll_interval
+        self.full_scan_every = full_scan_every
+
+        self._index = {}
+        self._dir_mtimes = {}
+        self._dir_entries = {}
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, telegram_id):
+        return str(telegram_id) in self._index
+
+    def get(self, telegram_id):
+        """Возвращает TemplateInfo водителя или None (без обращения к диску)"""
+        return self._index.get(str(telegram_id))
+
+    def __iter__(self):
+        """Снимок всех TemplateInfo индекса"""
+        return iter(list(self._index.values()))
+
+    def scan(self):
+        """Полное сканирование папки с шаблонами"""
+        if not os.path.isdir(self.templates_dir):
+            logger.error(f"Папка {self.templates_dir} не существует")
+            return 0
+        with self._lock:
+            self._dir_mtimes = {}
+            self._dir_entries = {}
+            for directory, depth in self._walk_dirs():
+                self._scan_dir(directory, depth)
+            self._rebuild_index()
+        logger.info(f"Найдено шаблонов водителей: {len(self._index)} в {self.templates_dir}")
+        return len(self._index)
+
+    def refresh(self, full=False):
+        """
+        Инкрементальное обновление индекса
+
+        Перечитываются только папки, у которых изменился mtime (добавление, удаление,
+        атомарная замена файла). При full=True перепроверяются все папки.
+
+        Returns:
+            bool: True если индекс изменился
+        """
+        with self._lock:
+            changed = False
+            seen_dirs = set()
+            for directory, depth in self._walk_dirs():
+                seen_dirs.add(directory)
+                try:
+                    mtime = os.stat(directory).st_mtime_ns
+                except OSError:
+                    continue
+                if full or self._dir_mtimes.get(directory) != mtime:
+                    changed |= self._scan_dir(directory, depth)
+
+            for directory in set(self._dir_entries) - seen_dirs:
+                # Папка-шард удалена целиком
+                self._dir_mtimes.pop(directory, None)
+                if self._dir_entries.pop(directory):
+                    changed = True
+
+            if changed:
+                self._rebuild_index()
+                logger.info(f"Индекс шаблонов обновлен: {len(self._index)} шаблонов")
+            return changed
+
+    def _walk_dirs(self):
+        """Обходит папку с шаблонами и шарды до max_depth"""
+        stack = [(self.templates_dir, 0)]
+        while stack:
+            directory, depth = stack.pop()
+            yield directory, depth
+            if depth >= self.max_depth:
+                continue
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append((entry.path, depth + 1))
+            except OSError as e:
+                logger.warning(f"Не удалось прочитать папку {directory}: {e}")
+
+    def _scan_dir(self, directory, depth):
+        """Перечитывает шаблоны одной папки. Возвращает True если ее содержимое изменилось"""
+        entries = {}
+        try:
+            self._dir_mtimes[directory] = os.stat(directory).st_mtime_ns
+            with os.scandir(directory) as dir_entries:
+                for entry in dir_entries:
+                    match = TEMPLATE_FILENAME_RE.match(entry.name)
+                    if not match or not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                    telegram_id = match.group(1)
+                    entries[telegram_id] = TemplateInfo(telegram_id, entry.path, stat.st_mtime_ns, stat.st_size)
+        except OSError as e:
+            logger.warning(f"Не удалось прочитать папку {directory}: {e}")
+            self._dir_mtimes.pop(directory, None)
+        changed = self._dir_entries.get(directory, {}) != entries
+        self._dir_entries[directory] = entries
+        return changed
+
+    def _rebuild_index(self):
+        """Собирает общий индекс из записей папок (при дубликатах побеждает более свежий файл)"""
+        index = {}
+        for entries in self._dir_entries.values():
+            for telegram_id, info in entries.items():
+                existing = index.get(telegram_id)
+                if existing is not None:
+                    logger.warning(f"Несколько шаблонов для ID {telegram_id}: {existing.path}, {info.path}")
+                    if existing.mtime >= info.mtime:
+                        continue
+                index[telegram_id] = info
+        # Атомарная замена: читатели без блокировки видят старый или новый индекс целиком
+        self._index = index
+
+    def start(self):
+        """Сканирует папку и запускает фоновое наблюдение за изменениями"""
+        self.scan()
+        if self.watch == 'off' or self._thread is not None:
+            return
+        use_inotify = self.watch == 'inotify' or (self.watch == 'auto' and HAS_INOTIFY)
+        target = self._watch_inotify if use_inotify else self._watch_poll
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=target, name='template-registry', daemon=True)
+        self._thread.start()
+        logger.info(f"Наблюдение за шаблонами: {'inotify' if use_inotify else 'опрос'}")
+
+    def stop(self):
+        """Останавливает фоновое наблюдение"""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def _watch_poll(self):
+        polls = 0
+        while not self._stop_event.wait(self.poll_interval):
+            polls += 1
+            try:
+                self.refresh(full=bool(self.full_scan_every) and polls % self.full_scan_every == 0)
+            except Exception as e:
+                logger.error(f"Ошибка обновления индекса шаблонов: {e}", exc_info=True)
+
+    def _watch_inotify(self):
+        flags = inotify_simple.flags
+        mask = (flags.CREATE | flags.DELETE | flags.CLOSE_WRITE | flags.MOVED_TO |
+                flags.MOVED_FROM | flags.DELETE_SELF)
+        inotify = inotify_simple.INotify()
+        watched = set()
+        try:
+            while not self._stop_event.is_set():
+                for directory, _ in self._walk_dirs():
+                    if directory not in watched:
+                        try:
+                            inotify.add_watch(directory, mask)
+                            watched.add(directory)
+                        except OSError:
+                            pass
+                events = inotify.read(timeout=int(self.poll_interval * 1000), read_delay=200)
+                if self._stop_event.is_set():
+                    break
+                # Перезапись файла на месте не меняет mtime папки - при событиях перепроверяем всё
+                if events:
+                    watched.difference_update(d for d in list(watched) if not os.path.isdir(d))
+                    self.refresh(full=True)
+                else:
+                    self.refresh()
+        except Exception as e:
+            logger.error(f"Ошибка наблюдения inotify, переключаемся на опрос: {e}", exc_info=True)
+            self._watch_poll()
+        finally:
+            inotify.close()
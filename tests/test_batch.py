@@ -0,0 +1,70 @@
+import csv
+import json
+import os
+import zipfile
+
+import pytest
+
+from batch import BatchRow, REPORT_COLUMNS, generate_batch, read_rows
+from conftest import ROOT
+
+DRIVER_ID = '665996290'
+
+
+def read_report(path):
+    with open(path, encoding='utf-8', newline='') as f:
+        return list(csv.DictReader(f))
+
+
+def test_read_rows_from_csv_with_bom(tmp_path):
+    path = tmp_path / 'shift.csv'
+    path.write_text('\ufefftelegram_id,start_time,odometer\n 1 ,08:00, 100\n2,,\n', encoding='utf-8')
+    assert list(read_rows(str(path))) == [BatchRow(1, '1', '08:00', '100'), BatchRow(2, '2', '', '')]
+
+
+def test_read_rows_from_jsonl_keeps_broken_lines(tmp_path):
+    path = tmp_path / 'shift.jsonl'
+    path.write_text(json.dumps({'telegram_id': 1, 'start_time': '08:00', 'odometer': 100}) + '\n\n{broken\n',
+                    encoding='utf-8')
+    assert list(read_rows(str(path))) == [BatchRow(1, '1', '08:00', '100'), BatchRow(3, '', '', '')]
+
+
+@pytest.fixture
+def rows():
+    return [
+        BatchRow(1, DRIVER_ID, '08:00', '12345'),
+        BatchRow(2, '', '08:00', '1'),
+        BatchRow(3, '42', '08:00', '1'),
+        BatchRow(4, DRIVER_ID, '8 утра', '1'),
+        BatchRow(5, DRIVER_ID, '08:00', 'много'),
+    ]
+
+
+def test_report_has_status_for_every_row(monkeypatch, tmp_path, rows):
+    monkeypatch.chdir(ROOT)
+    report_path = tmp_path / 'report.csv'
+    summary = generate_batch(rows, str(tmp_path / 'out'), report_path=str(report_path),
+                             workers=1, dpi=50, pool_kind='thread')
+    assert (summary['total'], summary['ok'], summary['error']) == (5, 1, 4)
+
+    report = read_report(report_path)
+    assert list(report[0]) == list(REPORT_COLUMNS)
+    by_row = {int(line['row_num']): line for line in report}
+    assert sorted(by_row) == [1, 2, 3, 4, 5]
+    assert by_row[1]['status'] == 'ok'
+    assert os.path.getsize(by_row[1]['output']) > 0
+    assert float(by_row[1]['duration_ms']) > 0
+    assert by_row[2]['error'] == 'не указан telegram_id'
+    assert by_row[3]['error'] == 'шаблон не найден'
+    assert by_row[4]['error'].startswith('неверный формат времени')
+    assert by_row[5]['error'].startswith('пробег должен быть числом')
+
+
+def test_results_are_written_to_zip(monkeypatch, tmp_path):
+    monkeypatch.chdir(ROOT)
+    output = tmp_path / 'shift.zip'
+    summary = generate_batch([BatchRow(7, DRIVER_ID, '08:00', '1')], str(output), workers=1, dpi=50,
+                             pool_kind='thread')
+    assert summary['ok'] == 1
+    with zipfile.ZipFile(output) as archive:
+        assert archive.namelist() == ['waybill_665996290_7.jpg']
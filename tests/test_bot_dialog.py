@@ -0,0 +1,208 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import bot as bot_module
+from conftest import ROOT
+
+DRIVER_ID = 665996290
+
+
+@pytest.fixture
+def taxi_bot(monkeypatch):
+    """TaxiBot без сети, архива и фоновых потоков (шаблоны - из templates/ репозитория)"""
+    monkeypatch.chdir(ROOT)
+    monkeypatch.setattr(bot_module, 'STATE_BACKEND', 'memory')
+    monkeypatch.setattr(bot_module, 'WAYBILL_ARCHIVE_PATH', None)
+    monkeypatch.setattr(bot_module, 'SPECULATIVE_RENDER', False)
+    monkeypatch.setattr(bot_module, 'TEMPLATES_WATCH', 'off')
+    monkeypatch.setattr(bot_module, 'DRIVER_RECORDS_BACKEND', None)
+    return bot_module.TaxiBot('123456:TEST', metrics_port=None)
+
+
+def make_update(text, replies, user_id=DRIVER_ID):
+    async def reply_text(reply):
+        replies.append(reply)
+    message = SimpleNamespace(text=text, reply_text=reply_text)
+    return SimpleNamespace(effective_user=SimpleNamespace(id=user_id), message=message)
+
+
+def test_time_typed_during_upload_is_not_read_as_odometer(taxi_bot):
+    replies = []
+    context = SimpleNamespace(args=[])
+    release = asyncio.Event()
+    generated = []
+
+    async def slow_generate_waybill(update, user_state):
+        # Рендер и загрузка фото еще идут, когда водитель вводит время следующей смены
+        generated.append(user_state['odometer'])
+        await release.wait()
+        return True
+
+    taxi_bot.generate_waybill = slow_generate_waybill
+
+    async def scenario():
+        await taxi_bot.start(make_update('/start', replies), context)
+        await taxi_bot.handle_message(make_update('08:00', replies), context)
+        odometer = asyncio.ensure_future(taxi_bot.handle_message(make_update('12345', replies), context))
+        await asyncio.sleep(0.01)
+        next_time = asyncio.ensure_future(taxi_bot.handle_message(make_update('09:00', replies), context))
+        await asyncio.sleep(0.01)
+        release.set()
+        await asyncio.gather(odometer, next_time)
+
+    asyncio.run(scenario())
+    assert generated == ['12345']
+    assert not any('Пробег должен быть числом' in reply for reply in replies)
+    assert replies[-1].startswith('⏱ Время принято: 09:00')
+    assert taxi_bot.user_data.get(str(DRIVER_ID))['step'] == 'waiting_odometer'
+
+
+def test_different_drivers_are_not_serialized(taxi_bot):
+    async def scenario():
+        lock = taxi_bot.user_lock(1)
+        async with lock:
+            # Блокировка одного водителя не мешает другому
+            assert not taxi_bot.user_lock(2).locked()
+            assert taxi_bot.user_lock('1') is lock
+
+    asyncio.run(scenario())
+
+
+@pytest.fixture
+def archived_bot(monkeypatch, tmp_path):
+    """TaxiBot с архивом номеров в tmp_path; рендер и отправка подменены"""
+    monkeypatch.chdir(ROOT)
+    monkeypatch.setattr(bot_module, 'STATE_BACKEND', 'memory')
+    monkeypatch.setattr(bot_module, 'WAYBILL_ARCHIVE_PATH', str(tmp_path / 'waybills.sqlite3'))
+    monkeypatch.setattr(bot_module, 'SPECULATIVE_RENDER', False)
+    monkeypatch.setattr(bot_module, 'TEMPLATES_WATCH', 'off')
+    monkeypatch.setattr(bot_module, 'DRIVER_RECORDS_BACKEND', None)
+    taxi_bot = bot_module.TaxiBot('123456:TEST', metrics_port=None)
+    taxi_bot.rendered = []
+    taxi_bot.render_failures = []
+
+    async def render_job(job, archive=False):
+        if taxi_bot.render_failures:
+            raise taxi_bot.render_failures.pop(0)
+        taxi_bot.rendered.append(job.serial_number)
+        return b'image', None
+
+    async def send_waybill(update, job, result, serial_number):
+        return SimpleNamespace(document=None, photo=[SimpleNamespace(file_id=f'photo-{serial_number}')])
+
+    async def archive_waybill(job, archive_pdf=None):
+        return None
+
+    taxi_bot.render_job = render_job
+    taxi_bot.send_waybill = send_waybill
+    taxi_bot.archive_waybill = archive_waybill
+    taxi_bot.run_in_background = lambda coro: coro.close()
+    yield taxi_bot
+    taxi_bot.waybill_archive.close()
+
+
+def reserved_serials(taxi_bot):
+    return [row[0] for row in taxi_bot.waybill_archive._db.execute("SELECT serial FROM serials")]
+
+
+def run_dialog(taxi_bot, *texts, replies=None):
+    replies = [] if replies is None else replies
+    context = SimpleNamespace(args=[])
+
+    async def scenario():
+        await taxi_bot.start(make_update('/start', replies), context)
+        for text in texts:
+            await taxi_bot.handle_message(make_update(text, replies), context)
+
+    asyncio.run(scenario())
+    return replies
+
+
+def test_serial_is_allocated_only_for_render(archived_bot):
+    run_dialog(archived_bot, '08:00')
+    assert reserved_serials(archived_bot) == []
+    run_dialog(archived_bot, '08:00', '12345')
+    assert archived_bot.rendered == reserved_serials(archived_bot)
+    assert len(archived_bot.rendered) == 1
+
+
+def test_overload_retry_reuses_serial(archived_bot):
+    archived_bot.render_failures.append(bot_module.SchedulerBusy('busy'))
+    replies = run_dialog(archived_bot, '08:00', '12345', '12345')
+    assert any('перегружен' in reply for reply in replies)
+    assert len(archived_bot.rendered) == 1
+    assert reserved_serials(archived_bot) == archived_bot.rendered
+
+
+def test_failed_render_releases_serial(archived_bot):
+    archived_bot.render_failures.append(RuntimeError('render failed'))
+    run_dialog(archived_bot, '08:00', '12345')
+    assert reserved_serials(archived_bot) == []
+
+
+def test_cache_hit_does_not_reserve_serial(archived_bot):
+    run_dialog(archived_bot, '08:00', '12345', '08:00', '12345')
+    assert len(archived_bot.rendered) == 1
+    assert reserved_serials(archived_bot) == archived_bot.rendered
+
+
+def test_unused_speculative_serial_is_released(archived_bot, monkeypatch):
+    monkeypatch.setattr(bot_module, 'SPECULATIVE_RENDER', True)
+    started = []
+    archived_bot.speculative_renders.start = lambda job: started.append(job.serial_number) or False
+    run_dialog(archived_bot, '08:00')
+    assert len(started) == 1 and started[0]
+    assert reserved_serials(archived_bot) == []
+
+    # Заготовка запущена, но водитель начал диалог заново
+    archived_bot.speculative_renders.start = lambda job: started.append(job.serial_number) or True
+    run_dialog(archived_bot, '08:00')
+    assert len(reserved_serials(archived_bot)) == 1
+    run_dialog(archived_bot)
+    assert reserved_serials(archived_bot) == []
+
+
+def test_odometer_resent_during_upload_gets_same_waybill(archived_bot):
+    sent = []
+
+    async def send_cached(update, job, file_id):
+        sent.append(file_id)
+        return True
+
+    archived_bot.send_cached = send_cached
+    release = asyncio.Event()
+    send_waybill = archived_bot.send_waybill
+
+    async def slow_send_waybill(update, job, result, serial_number):
+        await release.wait()
+        return await send_waybill(update, job, result, serial_number)
+
+    archived_bot.send_waybill = slow_send_waybill
+    replies = []
+    context = SimpleNamespace(args=[])
+
+    async def scenario():
+        await archived_bot.start(make_update('/start', replies), context)
+        await archived_bot.handle_message(make_update('08:00', replies), context)
+        first = asyncio.ensure_future(archived_bot.handle_message(make_update('12345', replies), context))
+        await asyncio.sleep(0.01)
+        # Водитель не дождался фото и отправил пробег еще раз
+        duplicate = asyncio.ensure_future(archived_bot.handle_message(make_update('12345', replies), context))
+        await asyncio.sleep(0.01)
+        release.set()
+        await asyncio.gather(first, duplicate)
+
+    asyncio.run(scenario())
+    serial = archived_bot.rendered[0]
+    assert archived_bot.rendered == [serial]
+    assert sent == [f'photo-{serial}']
+    assert reserved_serials(archived_bot) == [serial]
+    assert not any('Неверный формат времени' in reply for reply in replies)
+
+
+def test_other_number_at_time_step_is_rejected(archived_bot):
+    replies = run_dialog(archived_bot, '08:00', '12345', '54321')
+    assert 'Неверный формат времени' in replies[-1]
+    assert len(archived_bot.rendered) == 1
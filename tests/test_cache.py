@@ -0,0 +1,82 @@
+from types import SimpleNamespace
+
+import pytest
+
+import cache
+from cache import LRUCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Управляемое время для TTL: clock.now сдвигается тестом"""
+    clock = SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(cache, 'time', SimpleNamespace(monotonic=lambda: clock.now))
+    return clock
+
+
+def test_evicts_least_recently_used_by_count():
+    lru = LRUCache(max_items=2)
+    lru.put('a', b'1')
+    lru.put('b', b'2')
+    assert lru.get('a') == b'1'
+    lru.put('c', b'3')
+    assert 'b' not in lru
+    assert lru.get('a') == b'1'
+    assert lru.get('c') == b'3'
+
+
+def test_evicts_oldest_until_under_byte_limit():
+    lru = LRUCache(max_bytes=10)
+    lru.put('a', b'x' * 4)
+    lru.put('b', b'x' * 4)
+    lru.put('c', b'x' * 4)
+    assert 'a' not in lru
+    assert lru.total_bytes == 8
+    assert len(lru) == 2
+
+
+def test_value_larger_than_cache_is_not_stored():
+    lru = LRUCache(max_bytes=10)
+    lru.put('a', b'x' * 4)
+    lru.put('big', b'x' * 11)
+    assert 'big' not in lru
+    assert lru.get('a') == b'x' * 4
+    assert lru.total_bytes == 4
+
+
+def test_replacing_value_updates_byte_total():
+    lru = LRUCache(max_bytes=100, sizeof=len)
+    lru.put('a', b'x' * 30)
+    lru.put('a', b'x' * 10)
+    assert lru.total_bytes == 10
+    assert lru.pop('a') == b'x' * 10
+    assert lru.total_bytes == 0
+
+
+def test_entry_expires_after_ttl(clock):
+    lru = LRUCache(ttl=60)
+    lru.put('a', b'1')
+    clock.now += 59
+    assert lru.get('a') == b'1'
+    clock.now += 1
+    assert lru.get('a') is None
+    assert lru.total_bytes == 0
+    assert lru.misses == 1
+
+
+def test_ttl_counts_from_put_not_from_get(clock):
+    lru = LRUCache(ttl=60)
+    lru.put('a', b'1')
+    clock.now += 50
+    lru.get('a')
+    clock.now += 20
+    assert 'a' not in lru
+
+
+def test_put_purges_expired_entries(clock):
+    lru = LRUCache(ttl=60)
+    lru.put('old', b'x' * 5)
+    clock.now += 61
+    lru.put('new', b'x' * 3)
+    assert len(lru) == 1
+    assert lru.total_bytes == 3
@@ -0,0 +1,71 @@
+import json
+
+import pytest
+
+from driver_records import (DriverRecord, DriverTemplate, JsonDriverRecords, SQLiteDriverRecords,
+                            create_driver_records)
+
+
+@pytest.fixture(params=['json', 'sqlite'])
+def records(request, tmp_path):
+    if request.param == 'json':
+        store = create_driver_records('json', path=str(tmp_path / 'drivers.json'), base_dir='base',
+                                      check_interval=0)
+    else:
+        store = create_driver_records('sqlite', path=str(tmp_path / 'drivers.sqlite3'), base_dir='base',
+                                      check_interval=0)
+    yield store
+    store.close()
+
+
+def test_put_get_and_resolve(records):
+    records.put_many([DriverRecord(1, 'put.pdf', {'telegram_id': '1'}), DriverRecord('2', 'put.pdf', {})])
+    assert len(records) == 2
+    assert records.get('1') == DriverRecord('1', 'put.pdf', {'telegram_id': '1'})
+    assert 2 in records and 3 not in records
+    assert records.resolve(1) == DriverTemplate('base/put.pdf', {'telegram_id': '1'})
+    assert records.resolve(3) is None
+
+
+def test_put_replaces_record(records):
+    records.put(DriverRecord('1', 'old.pdf', {'a': '1'}))
+    records.put(DriverRecord('1', 'new.pdf', {'b': '2'}))
+    assert list(records) == [DriverRecord('1', 'new.pdf', {'b': '2'})]
+
+
+def test_missing_json_file_has_no_records(tmp_path):
+    assert len(JsonDriverRecords(str(tmp_path / 'missing.json'))) == 0
+
+
+def test_json_file_is_reloaded_after_external_edit(tmp_path):
+    path = tmp_path / 'drivers.json'
+    path.write_text(json.dumps({'1': {'base': 'put.pdf'}}), encoding='utf-8')
+    records = JsonDriverRecords(str(path), check_interval=0)
+    assert records.get(1) == DriverRecord('1', 'put.pdf', {})
+    path.write_text(json.dumps({'2': {'base': 'put.pdf', 'fields': {'x': 'y'}}}), encoding='utf-8')
+    assert records.get(1) is None
+    assert records.get(2).fields == {'x': 'y'}
+
+
+def test_broken_json_keeps_previous_records(tmp_path):
+    path = tmp_path / 'drivers.json'
+    path.write_text(json.dumps({'1': {'base': 'put.pdf'}}), encoding='utf-8')
+    records = JsonDriverRecords(str(path), check_interval=0)
+    path.write_text('{"1": ', encoding='utf-8')
+    assert records.get(1) == DriverRecord('1', 'put.pdf', {})
+
+
+def test_sqlite_records_survive_reopen(tmp_path):
+    path = str(tmp_path / 'drivers.sqlite3')
+    store = SQLiteDriverRecords(path)
+    store.put(DriverRecord('1', 'put.pdf', {'telegram_id': 'один'}))
+    store.close()
+    store = SQLiteDriverRecords(path)
+    assert store.get(1).fields == {'telegram_id': 'один'}
+    store.close()
+
+
+def test_backend_selection():
+    assert create_driver_records(None) is None
+    with pytest.raises(ValueError):
+        create_driver_records('redis')
@@ -0,0 +1,98 @@
+import os
+
+import fitz
+import pytest
+
+import field_fonts
+from conftest import ROOT
+from field_fonts import COMMON_CHARS, FieldFont, get_field_font
+from pdf_handler import PDFFiller
+
+pytest.importorskip('fontTools')
+from fontTools.fontBuilder import FontBuilder  # noqa: E402
+from fontTools.pens.ttGlyphPen import TTGlyphPen  # noqa: E402
+
+FONT_CHARS = sorted(COMMON_CHARS | set('ABCИванЖ'))
+
+
+@pytest.fixture(scope='module')
+def font_path(tmp_path_factory):
+    """Маленький TTF с квадратными глифами для цифр, латиницы и кириллицы"""
+    names = ['.notdef'] + [f'uni{ord(char):04X}' for char in FONT_CHARS]
+    pen = TTGlyphPen(None)
+    pen.moveTo((50, 0))
+    pen.lineTo((50, 700))
+    pen.lineTo((450, 700))
+    pen.lineTo((450, 0))
+    pen.closePath()
+    box = pen.glyph()
+    builder = FontBuilder(1000, isTTF=True)
+    builder.setupGlyphOrder(names)
+    builder.setupCharacterMap({ord(char): f'uni{ord(char):04X}' for char in FONT_CHARS})
+    builder.setupGlyf({name: box for name in names})
+    builder.setupHorizontalMetrics({name: (500, 50) for name in names})
+    builder.setupHorizontalHeader(ascent=800, descent=-200)
+    builder.setupNameTable({'familyName': 'TestSans', 'styleName': 'Regular'})
+    builder.setupOS2()
+    builder.setupPost()
+    path = tmp_path_factory.mktemp('fonts') / 'TestSans.ttf'
+    builder.save(str(path))
+    return str(path)
+
+
+def test_subset_is_cached_by_char_set(font_path):
+    font = FieldFont(font_path)
+    subset = font.for_chars('Иван')
+    assert font.for_chars('навИ') is subset
+    assert font.for_chars('ИванЖ') is not subset
+    # Цифры и знаки дат всегда в подмножестве - они не меняют набор
+    assert font.for_chars('Иван12:') is subset
+
+
+def test_subset_has_only_requested_glyphs(font_path):
+    subset = FieldFont(font_path).for_chars('И')
+    assert subset.has_glyph(ord('И'))
+    assert subset.has_glyph(ord('7'))
+    assert not subset.has_glyph(ord('Ж'))
+    assert FieldFont(font_path).full.has_glyph(ord('Ж'))
+
+
+def test_evicted_subset_is_rebuilt(font_path):
+    font = FieldFont(font_path, max_subsets=1)
+    first = font.for_chars('И')
+    font.for_chars('Ж')
+    assert font.for_chars('И') is not first
+
+
+def test_subset_error_falls_back_to_full_font(font_path, monkeypatch):
+    font = FieldFont(font_path)
+
+    def broken_subset(buffer, chars):
+        raise ValueError("битый шрифт")
+
+    monkeypatch.setattr(field_fonts, 'subset_font', broken_subset)
+    assert font.for_chars('И') is font.full
+    # Подмножества больше не пробуются
+    monkeypatch.undo()
+    assert font.for_chars('Ж') is font.full
+
+
+def test_font_is_loaded_once_per_process(font_path, monkeypatch):
+    monkeypatch.setattr(field_fonts, '_field_fonts', {})
+    monkeypatch.chdir(os.path.dirname(font_path))
+    assert get_field_font(font_path) is get_field_font(os.path.basename(font_path))
+
+
+def embedded_fonts(pdf_bytes):
+    with fitz.open(stream=pdf_bytes, filetype='pdf') as document:
+        return {font[3] for page in document for font in page.get_fonts() if font[1] != 'n/a'}
+
+
+def test_cyrillic_document_embeds_subset_and_latin_does_not(font_path, monkeypatch):
+    monkeypatch.chdir(ROOT)
+    template = os.path.join(ROOT, 'templates', 'driver_665996290.pdf')
+    filler = PDFFiller(font_file=font_path, pdf_thumbnail_size=None)
+    latin = filler.render_waybill_pdf('08:00', '1', template_path=template, serial_number='123456 - 1234567')
+    cyrillic = filler.render_waybill_pdf('08:00', '1', template_path=template, serial_number='Иван 123456')
+    assert not any('TestSans' in name for name in embedded_fonts(latin.pdf_bytes))
+    assert any('TestSans' in name for name in embedded_fonts(cyrillic.pdf_bytes))
@@ -0,0 +1,54 @@
+import pytest
+
+from image_profiles import DEFAULT_PROFILES, AdaptiveProfile, EncodingProfile, get_profile
+
+
+def test_builtin_profiles_by_name():
+    assert get_profile('default') is DEFAULT_PROFILES['default']
+    assert isinstance(get_profile('adaptive'), AdaptiveProfile)
+
+
+def test_unknown_profile_raises():
+    with pytest.raises(ValueError):
+        get_profile('tiff')
+
+
+def test_custom_profile_from_dict_takes_name_and_defaults():
+    profile = get_profile('small', {'small': {'dpi': 120, 'quality': 70}})
+    assert profile == EncodingProfile('small', 'JPEG', 120, False, 70, False, True)
+
+
+def test_custom_profile_overrides_builtin():
+    profile = get_profile('default', {'default': {'dpi': 150}})
+    assert profile.dpi == 150
+
+
+def test_adaptive_candidates_by_name_and_inline():
+    custom = {
+        'phone': {'candidates': ['fast', 'small', {'dpi': 200, 'quality': 90}], 'target_bytes': 200_000},
+        'small': {'dpi': 120, 'grayscale': True},
+    }
+    profile = get_profile('phone', custom)
+    assert profile.target_bytes == 200_000
+    assert profile.min_psnr == 30.0
+    assert profile.candidates[0] is DEFAULT_PROFILES['fast']
+    assert profile.candidates[1] == EncodingProfile('small', dpi=120, grayscale=True)
+    assert profile.candidates[2] == EncodingProfile('phone[2]', dpi=200, quality=90)
+
+
+def test_inline_candidates_get_unique_names():
+    custom = {'phone': {'candidates': [{'dpi': 150}, {'dpi': 200}, {'name': 'best', 'dpi': 300}]}}
+    names = [candidate.name for candidate in get_profile('phone', custom).candidates]
+    assert names == ['phone[0]', 'phone[1]', 'best']
+
+
+def test_adaptive_profile_is_not_a_candidate():
+    custom = {'phone': {'candidates': ['adaptive']}}
+    with pytest.raises(ValueError):
+        get_profile('phone', custom)
+
+
+def test_unknown_candidate_raises():
+    with pytest.raises(ValueError, match='missing'):
+        get_profile('phone', {'phone': {'candidates': ['fast', 'missing']}})
+
@@ -0,0 +1,107 @@
+import asyncio
+import logging
+
+import pytest
+
+from metrics import REGISTRY, MetricsRegistry, MetricsServer, SampledLogger, collect_stages, record_stages, stage
+from simple_http import HttpError, HttpRequest
+
+
+def test_stage_outside_collect_goes_to_registry():
+    before = REGISTRY.get_histogram('waybill_stage_duration_seconds', stage='test_stage')[0]
+    with stage('test_stage'):
+        pass
+    assert REGISTRY.get_histogram('waybill_stage_duration_seconds', stage='test_stage')[0] == before + 1
+
+
+def test_collect_stages_sums_repeated_stages_without_registry():
+    before = REGISTRY.get_histogram('waybill_stage_duration_seconds', stage='collected')
+    with collect_stages() as timings:
+        for _ in range(3):
+            with stage('collected'):
+                pass
+    assert list(timings) == ['collected'] and timings['collected'] >= 0
+    assert REGISTRY.get_histogram('waybill_stage_duration_seconds', stage='collected') == before
+
+
+def test_nested_collect_restores_outer_timings():
+    with collect_stages() as outer:
+        with collect_stages() as inner:
+            with stage('inner'):
+                pass
+        with stage('outer'):
+            pass
+    assert list(inner) == ['inner']
+    assert list(outer) == ['outer']
+
+
+def test_record_stages_from_worker():
+    registry = MetricsRegistry()
+    record_stages({'fill': 0.02, 'encode': 0.3}, registry)
+    assert registry.get_histogram('waybill_stage_duration_seconds', stage='fill') == (1, 0.02)
+    assert registry.get_histogram('waybill_stage_duration_seconds', stage='encode') == (1, 0.3)
+
+
+def test_render_cumulative_buckets_and_counters():
+    registry = MetricsRegistry(buckets=(0.1, 1.0))
+    registry.inc('waybill_requests_total', status='ok')
+    registry.inc('waybill_requests_total', status='ok')
+    registry.observe('waybill_render_duration_seconds', 0.05)
+    registry.observe('waybill_render_duration_seconds', 0.5)
+    registry.observe('waybill_render_duration_seconds', 5)
+    registry.register_gauge('waybill_test_gauge', lambda: 3, "Тест")
+    text = registry.render()
+    assert 'waybill_requests_total{status="ok"} 2' in text
+    assert 'waybill_render_duration_seconds_bucket{le="0.1"} 1' in text
+    assert 'waybill_render_duration_seconds_bucket{le="1"} 2' in text
+    assert 'waybill_render_duration_seconds_bucket{le="+Inf"} 3' in text
+    assert 'waybill_render_duration_seconds_sum 5.55' in text
+    assert 'waybill_test_gauge 3' in text
+    assert text.count('# TYPE waybill_requests_total counter') == 1
+
+
+def test_memory_histogram_has_own_buckets():
+    registry = MetricsRegistry()
+    registry.observe('waybill_job_peak_rss_bytes', 100 * 1024 * 1024, job='render')
+    assert f'le="{128 * 1024 * 1024}"}} 1' in registry.render()
+
+
+def test_sampled_logger_writes_every_nth(caplog):
+    sampled = SampledLogger(logging.getLogger('test_sampled'), every=3)
+    with caplog.at_level(logging.DEBUG, logger='test_sampled'):
+        for number in range(7):
+            sampled.debug("запись %d", number)
+    assert [record.getMessage() for record in caplog.records] == ['запись 0', 'запись 3', 'запись 6']
+
+
+def test_sampled_logger_skips_formatting_when_debug_is_off():
+    class Unformattable:
+        def __str__(self):
+            raise AssertionError("аргумент не должен форматироваться")
+
+    logger = logging.getLogger('test_sampled_off')
+    logger.setLevel(logging.INFO)
+    sampled = SampledLogger(logger, every=1)
+    sampled.debug("запись %s", Unformattable())
+    assert sampled._count == 0
+
+
+def test_metrics_server_ready_and_metrics():
+    state = {'ready': False}
+    registry = MetricsRegistry()
+    registry.inc('waybill_requests_total', status='ok')
+    server = MetricsServer(registry, port=0, ready=lambda: state['ready'])
+
+    def get(path, method='GET'):
+        return asyncio.run(server._handle(HttpRequest(method, path, {}, {}, b'')))
+
+    assert get('/ready') == (503, {'ready': False})
+    state['ready'] = True
+    assert get('/ready') == (200, {'ready': True})
+    status, body, content_type = get('/metrics')
+    assert status == 200 and 'waybill_requests_total{status="ok"} 1' in body
+    assert content_type.startswith('text/plain; version=0.0.4')
+    with pytest.raises(HttpError):
+        get('/other')
+    with pytest.raises(HttpError):
+        get('/metrics', method='POST')
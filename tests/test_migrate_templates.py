@@ -0,0 +1,69 @@
+import csv
+import json
+import os
+
+import pytest
+
+from conftest import ROOT
+from migrate_templates import compare_with_base, init_base, main, migrate, template_signature
+
+DRIVER_PDF = os.path.join(ROOT, 'templates', 'driver_665996290.pdf')
+OTHER_DRIVER_PDF = os.path.join(ROOT, 'templates', 'driver_1682580415.pdf')
+
+
+@pytest.fixture
+def base_dir(tmp_path):
+    base_dir = tmp_path / 'base'
+    init_base(DRIVER_PDF, str(base_dir / 'put.pdf'))
+    return base_dir
+
+
+def test_init_base_clears_driver_fields(base_dir):
+    signature = template_signature(str(base_dir / 'put.pdf'))
+    assert signature.fields['telegram_id'].value == ''
+    assert signature.page_sizes == template_signature(DRIVER_PDF).page_sizes
+
+
+def test_driver_on_same_base_becomes_record(base_dir):
+    record_fields, differences = compare_with_base(template_signature(DRIVER_PDF),
+                                                   template_signature(str(base_dir / 'put.pdf')))
+    assert differences == []
+    assert record_fields == {'telegram_id': '665996290'}
+
+
+def test_driver_with_other_content_is_not_migrated(base_dir):
+    results = list(migrate({'665996290': DRIVER_PDF, '1682580415': OTHER_DRIVER_PDF, '1': '/missing.pdf'},
+                           [str(base_dir / 'put.pdf')], str(base_dir)))
+    by_id = {result.telegram_id: result for result in results}
+    assert by_id['665996290'].status == 'migrated'
+    assert by_id['665996290'].base == 'put.pdf'
+    assert by_id['1682580415'].status == 'differs'
+    assert any(difference.startswith('texts:') for difference in by_id['1682580415'].differences)
+    assert by_id['1'].status == 'error'
+
+
+def test_main_writes_records_and_report(tmp_path, base_dir):
+    templates = tmp_path / 'templates'
+    templates.mkdir()
+    for source in (DRIVER_PDF, OTHER_DRIVER_PDF):
+        (templates / os.path.basename(source)).write_bytes(open(source, 'rb').read())
+    records_path = tmp_path / 'drivers.json'
+    report_path = tmp_path / 'report.csv'
+    assert main(['--templates', str(templates), '--base-dir', str(base_dir), '--records', str(records_path),
+                 '--report', str(report_path)]) == 0
+
+    records = json.loads(records_path.read_text(encoding='utf-8'))
+    assert records == {'665996290': {'base': 'put.pdf', 'fields': {'telegram_id': '665996290'}}}
+    with open(report_path, encoding='utf-8', newline='') as f:
+        statuses = {row['telegram_id']: row['status'] for row in csv.DictReader(f)}
+    assert statuses == {'665996290': 'migrated', '1682580415': 'differs'}
+
+
+def test_dry_run_saves_nothing(tmp_path, base_dir):
+    templates = tmp_path / 'templates'
+    templates.mkdir()
+    (templates / 'driver_665996290.pdf').write_bytes(open(DRIVER_PDF, 'rb').read())
+    records_path = tmp_path / 'drivers.json'
+    assert main(['--templates', str(templates), '--base-dir', str(base_dir), '--records', str(records_path),
+                 '--dry-run']) == 0
+    assert not records_path.exists()
@@ -0,0 +1,48 @@
+import fitz
+import pytest
+
+from pdf_handler import PDFFiller
+
+
+def make_document(sizes):
+    """PDF со страницами заданных размеров в пунктах; на каждой - черный квадрат в левом верхнем углу"""
+    document = fitz.open()
+    for width, height in sizes:
+        page = document.new_page(width=width, height=height)
+        page.draw_rect(fitz.Rect(0, 0, 10, 10), color=(0, 0, 0), fill=(0, 0, 0))
+    return document
+
+
+@pytest.fixture
+def filler():
+    return PDFFiller()
+
+
+def test_single_page_is_rendered_as_is(filler):
+    with make_document([(100, 50)]) as document:
+        image, offsets = filler._render_pages(document, 144)
+    assert image.mode == 'RGB'
+    assert image.size == (200, 100)
+    assert offsets == (0,)
+    assert image.getpixel((5, 5)) == (0, 0, 0)
+    assert image.getpixel((150, 80)) == (255, 255, 255)
+
+
+def test_pages_are_stacked_vertically(filler):
+    with make_document([(100, 50), (60, 40)]) as document:
+        image, offsets = filler._render_pages(document, 72)
+    assert image.size == (100, 90)
+    assert offsets == (0, 50)
+    assert image.getpixel((5, 55)) == (0, 0, 0)
+    # Справа от узкой страницы - белый фон холста
+    assert image.getpixel((80, 70)) == (255, 255, 255)
+    assert image.getpixel((50, 30)) == (255, 255, 255)
+
+
+def test_page_with_padded_stride(filler):
+    # Ширина 101 пиксель: строка растра не кратна 4 байтам, страницы не должны "съезжать"
+    with make_document([(101, 20), (101, 20)]) as document:
+        image, offsets = filler._render_pages(document, 72)
+    assert image.size == (101, 40)
+    assert image.getpixel((5, 25)) == (0, 0, 0)
+    assert image.getpixel((95, 35)) == (255, 255, 255)
@@ -0,0 +1,107 @@
+import os
+import tracemalloc
+from types import SimpleNamespace
+
+import pytest
+
+import profiling
+from profiling import ProfileRequest, ProfilingControl, profile_call
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """perf_counter, который сдвигается на clock.step при каждом вызове"""
+    clock = SimpleNamespace(now=0.0, step=0.0)
+
+    def perf_counter():
+        clock.now += clock.step
+        return clock.now
+
+    monkeypatch.setattr(profiling, 'time', SimpleNamespace(perf_counter=perf_counter))
+    return clock
+
+
+def saved(directory, suffix):
+    return sorted(name for name in os.listdir(directory) if name.endswith(suffix)) if os.path.isdir(directory) else []
+
+
+def test_next_jobs_are_counted_down(tmp_path):
+    control = ProfilingControl(str(tmp_path))
+    assert not control.enabled and control.request() is None
+    control.enable_next(2, memory_frames=5)
+    assert control.request() == ProfileRequest(str(tmp_path), None, 5)
+    assert control.request() == ProfileRequest(str(tmp_path), None, 5)
+    assert control.request() is None
+    assert control.describe() == "выключено"
+
+
+def test_slow_mode_requests_every_job_until_disabled(tmp_path):
+    control = ProfilingControl(str(tmp_path))
+    control.enable_slow(0.8)
+    assert [control.request() for _ in range(3)] == [ProfileRequest(str(tmp_path), 0.8, 0)] * 3
+    assert 'дольше 800 мс' in control.describe()
+    control.disable()
+    assert control.request() is None
+
+
+def test_settings_from_environ():
+    control = ProfilingControl.from_environ(environ={
+        'WAYBILL_PROFILE_DIR': '/tmp/p', 'WAYBILL_PROFILE_JOBS': '3', 'WAYBILL_PROFILE_SLOW_MS': '250',
+        'WAYBILL_PROFILE_MEMORY': '10'})
+    assert (control.output_dir, control.remaining, control.slow_threshold, control.memory_frames) == \
+        ('/tmp/p', 3, 0.25, 10)
+
+
+def test_invalid_environ_keeps_profiling_off():
+    control = ProfilingControl.from_environ(environ={'WAYBILL_PROFILE_JOBS': 'много'})
+    assert not control.enabled
+
+
+def test_profile_is_saved_with_stages(tmp_path):
+    request = ProfileRequest(str(tmp_path), None, 0)
+    result = profile_call(request, ["Задание: тест"], {'render': 0.05}, sum, [1, 2, 3])
+    assert result == 6
+    [report] = saved(str(tmp_path), '.txt')
+    assert len(saved(str(tmp_path), '.prof')) == 1
+    text = (tmp_path / report).read_text(encoding='utf-8')
+    assert text.startswith("Задание: тест")
+    assert 'render' in text and '50.0 мс' in text
+
+
+def test_fast_job_is_not_saved_in_slow_mode(tmp_path, clock):
+    request = ProfileRequest(str(tmp_path / 'fast'), 0.5, 0)
+    clock.step = 0.1
+    profile_call(request, [], {}, len, 'abc')
+    assert saved(request.output_dir, '.txt') == []
+
+    clock.step = 1.0
+    profile_call(request, [], {}, len, 'abc')
+    assert len(saved(request.output_dir, '.txt')) == 1
+
+
+def test_failed_job_is_saved_and_error_propagates(tmp_path):
+    def fail():
+        raise ValueError("шаблон поврежден")
+
+    with pytest.raises(ValueError):
+        profile_call(ProfileRequest(str(tmp_path), None, 0), [], {}, fail)
+    assert len(saved(str(tmp_path), '.prof')) == 1
+
+
+def test_memory_profile_stops_tracemalloc(tmp_path):
+    assert not tracemalloc.is_tracing()
+    profile_call(ProfileRequest(str(tmp_path), None, 3), [], {}, lambda: [bytes(1000) for _ in range(10)])
+    assert not tracemalloc.is_tracing()
+    assert len(saved(str(tmp_path), '.tracemalloc')) == 1
+    [report] = saved(str(tmp_path), '.txt')
+    assert 'Пик памяти Python' in (tmp_path / report).read_text(encoding='utf-8')
+
+
+def test_recent_dumps_newest_first(tmp_path):
+    for index, name in enumerate(['a.txt', 'b.txt', 'c.prof']):
+        path = tmp_path / name
+        path.write_text('')
+        os.utime(path, (index, index))
+    control = ProfilingControl(str(tmp_path))
+    assert control.recent_dumps() == [str(tmp_path / 'b.txt'), str(tmp_path / 'a.txt')]
+    assert ProfilingControl(str(tmp_path / 'missing')).recent_dumps() == []
@@ -0,0 +1,113 @@
+import asyncio
+import os
+import threading
+import time
+
+import pytest
+
+from render_pool import RenderInterrupted, RenderPool, RenderPoolBusy, RenderTimeout, get_worker_filler
+
+
+async def wait_for_pending(pool, value, timeout=10):
+    deadline = time.monotonic() + timeout
+    while pool.pending != value and time.monotonic() < deadline:
+        await asyncio.sleep(0.01)
+    return pool.pending
+
+
+def test_timeout_replaces_hung_worker_process():
+    async def scenario():
+        pool = RenderPool('process', max_workers=1, job_timeout=3)
+        try:
+            first_pid = await pool.run(os.getpid)
+            old_executor = pool._executor
+            processes = list(old_executor._processes.values())
+            with pytest.raises(RenderTimeout):
+                await pool.run(time.sleep, 60)
+            assert pool._executor is not old_executor
+            assert await wait_for_pending(pool, 0) == 0
+            assert not any(process.is_alive() for process in processes)
+            return first_pid, await pool.run(os.getpid)
+        finally:
+            pool.shutdown()
+
+    first_pid, next_pid = asyncio.run(scenario())
+    assert next_pid != first_pid
+
+
+def test_other_jobs_of_replaced_pool_get_retryable_error():
+    async def scenario():
+        pool = RenderPool('process', max_workers=2, job_timeout=3)
+        try:
+            await asyncio.gather(pool.run(os.getpid), pool.run(os.getpid))
+            hung = asyncio.ensure_future(pool.run(time.sleep, 60))
+            await asyncio.sleep(0.5)
+            # Работает во втором воркере и ждет в очереди, когда первый зависает
+            running = asyncio.ensure_future(pool.run(time.sleep, 60))
+            queued = asyncio.ensure_future(pool.run(time.sleep, 60))
+            results = await asyncio.gather(hung, running, queued, return_exceptions=True)
+            return results, await wait_for_pending(pool, 0)
+        finally:
+            pool.shutdown()
+
+    results, pending = asyncio.run(scenario())
+    assert [type(result) for result in results] == [RenderTimeout, RenderInterrupted, RenderInterrupted]
+    assert pending == 0
+
+
+def test_timed_out_thread_job_stays_pending_until_it_finishes():
+    release = threading.Event()
+
+    async def scenario():
+        pool = RenderPool('thread', max_workers=1, job_timeout=0.2)
+        try:
+            with pytest.raises(RenderTimeout):
+                await pool.run(release.wait)
+            # Поток прервать нельзя: задание все еще занимает ресурсы
+            assert pool.pending == 1
+            release.set()
+            return await wait_for_pending(pool, 0)
+        finally:
+            release.set()
+            pool.shutdown()
+
+    assert asyncio.run(scenario()) == 0
+
+
+def test_rejects_jobs_over_workers_and_queue():
+    release = threading.Event()
+
+    async def scenario():
+        pool = RenderPool('thread', max_workers=1, max_queue=1, job_timeout=10)
+        try:
+            accepted = [asyncio.ensure_future(pool.run(release.wait)) for _ in range(2)]
+            await asyncio.sleep(0.05)
+            assert pool.pending == 2
+            assert pool.idle_workers == 0
+            with pytest.raises(RenderPoolBusy):
+                await pool.run(release.wait)
+            release.set()
+            await asyncio.gather(*accepted)
+            return pool.pending
+        finally:
+            release.set()
+            pool.shutdown()
+
+    assert asyncio.run(scenario()) == 0
+
+
+def test_stopped_pool_rejects_jobs():
+    async def scenario():
+        pool = RenderPool('thread', max_workers=1)
+        pool.shutdown()
+        await pool.run(os.getpid)
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(scenario())
+
+
+def test_worker_filler_is_reused_per_options():
+    filler = get_worker_filler({'font_size': 11})
+    assert get_worker_filler({'font_size': 11}) is filler
+    assert get_worker_filler({'font_size': 12}) is not filler
+    assert get_worker_filler() is get_worker_filler({})
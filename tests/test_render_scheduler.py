@@ -0,0 +1,123 @@
+import asyncio
+
+import pytest
+
+from render_jobs import RenderScheduler, SchedulerBusy, WaybillJob, execute_job
+from render_pool import RenderPoolBusy
+
+
+class FakePool:
+    """RenderPool без воркеров: задания ждут release и возвращают то, что вернул бы execute_job"""
+
+    def __init__(self, max_workers=2, error=None):
+        self.max_workers = max_workers
+        self.error = error
+        self.calls = []
+        self.release = asyncio.Event()
+
+    async def run(self, func, job, profile, archive, known_base):
+        assert func is execute_job
+        self.calls.append((job, archive, known_base))
+        await self.release.wait()
+        if self.error is not None:
+            raise self.error
+        return f"image-{job.odometer}", {'render': 0.01}, 0, 'archive' if archive else None
+
+
+def make_job(odometer='12345', user_id=1):
+    return WaybillJob.create(user_id, 'templates/driver_1.pdf', '08:00', odometer, serial_number='111111 - 1111111')
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_same_job_of_user_is_rendered_once():
+    async def scenario():
+        pool = FakePool()
+        scheduler = RenderScheduler(pool)
+        first = asyncio.ensure_future(scheduler.submit(make_job()))
+        await settle()
+        second = asyncio.ensure_future(scheduler.submit(make_job()))
+        await settle()
+        pool.release.set()
+        return pool, scheduler, await asyncio.gather(first, second)
+
+    pool, scheduler, results = asyncio.run(scenario())
+    assert len(pool.calls) == 1
+    assert results == [('image-12345', None), ('image-12345', None)]
+    assert scheduler.coalesced == 1
+    assert scheduler.admitted == 0
+
+
+def test_different_jobs_are_not_coalesced():
+    async def scenario():
+        pool = FakePool()
+        scheduler = RenderScheduler(pool)
+        first = asyncio.ensure_future(scheduler.submit(make_job('12345')))
+        await settle()
+        second = asyncio.ensure_future(scheduler.submit(make_job('12346')))
+        await settle()
+        pool.release.set()
+        return pool, scheduler, await asyncio.gather(first, second)
+
+    pool, scheduler, results = asyncio.run(scenario())
+    assert len(pool.calls) == 2
+    assert [result for result, _ in results] == ['image-12345', 'image-12346']
+    assert scheduler.coalesced == 0
+
+
+def test_rejects_when_running_and_waiting_limit_is_reached():
+    async def scenario():
+        pool = FakePool(max_workers=1)
+        scheduler = RenderScheduler(pool, max_waiting=1)
+        running = [asyncio.ensure_future(scheduler.submit(make_job(user_id=user_id))) for user_id in (1, 2)]
+        await settle()
+        assert len(pool.calls) == 1
+        with pytest.raises(SchedulerBusy):
+            await scheduler.submit(make_job(user_id=3))
+        pool.release.set()
+        await asyncio.gather(*running)
+        return pool, scheduler
+
+    pool, scheduler = asyncio.run(scenario())
+    assert scheduler.rejected == 1
+    assert len(pool.calls) == 2
+    assert scheduler.admitted == 0
+
+
+def test_pool_busy_is_reported_as_scheduler_busy():
+    async def scenario():
+        pool = FakePool(error=RenderPoolBusy('очередь переполнена'))
+        pool.release.set()
+        await RenderScheduler(pool).submit(make_job())
+
+    with pytest.raises(SchedulerBusy):
+        asyncio.run(scenario())
+
+
+def test_render_error_reaches_every_coalesced_waiter():
+    async def scenario():
+        pool = FakePool(error=RuntimeError('render failed'))
+        scheduler = RenderScheduler(pool)
+        waiters = [asyncio.ensure_future(scheduler.submit(make_job())) for _ in range(2)]
+        await settle()
+        pool.release.set()
+        return scheduler, await asyncio.gather(*waiters, return_exceptions=True)
+
+    scheduler, results = asyncio.run(scenario())
+    assert [type(result) for result in results] == [RuntimeError, RuntimeError]
+    assert scheduler.admitted == 0
+
+
+def test_archive_request_is_passed_to_the_pool():
+    async def scenario():
+        pool = FakePool()
+        pool.release.set()
+        result = await RenderScheduler(pool).submit(make_job(), archive=True, known_base='abc')
+        return pool, result
+
+    pool, result = asyncio.run(scenario())
+    assert pool.calls == [(make_job(), True, 'abc')]
+    assert result == ('image-12345', 'archive')
@@ -0,0 +1,79 @@
+import os
+
+import pytest
+
+from render_jobs import WaybillJob
+from result_cache import ResultCache
+
+
+@pytest.fixture
+def template(tmp_path):
+    path = tmp_path / 'driver_1.pdf'
+    path.write_bytes(b'%PDF-1.4')
+    return str(path)
+
+
+def make_job(template, **changes):
+    job = WaybillJob.create(1, template, '08:00', '12345', filler_options={'font_size': 10},
+                            driver_fields={'car': 'A123BC'}, serial_number='123456 - 1234567')
+    return job._replace(**changes)
+
+
+def test_key_ignores_serial_number(template):
+    key = ResultCache.make_key(make_job(template), '17.10.2026')
+    assert key == ResultCache.make_key(make_job(template, serial_number='654321 - 7654321'), '17.10.2026')
+    assert key[0].serial_number is None
+
+
+@pytest.mark.parametrize('changes', [
+    {'odometer': '12346'},
+    {'start_time': '09:00'},
+    {'delivery': 'pdf'},
+    {'dpi': 150},
+    {'user_id': '2'},
+])
+def test_key_depends_on_request(template, changes):
+    assert ResultCache.make_key(make_job(template), '17.10.2026') != \
+        ResultCache.make_key(make_job(template, **changes), '17.10.2026')
+
+
+def test_key_depends_on_driver_fields_and_options(template):
+    base = ResultCache.make_key(make_job(template), '17.10.2026')
+    other_fields = WaybillJob.create(1, template, '08:00', '12345', filler_options={'font_size': 10},
+                                     driver_fields={'car': 'B456CD'})
+    other_options = WaybillJob.create(1, template, '08:00', '12345', filler_options={'font_size': 12},
+                                      driver_fields={'car': 'A123BC'})
+    assert base != ResultCache.make_key(other_fields, '17.10.2026')
+    assert base != ResultCache.make_key(other_options, '17.10.2026')
+
+
+def test_key_depends_on_shift_date(template):
+    assert ResultCache.make_key(make_job(template), '17.10.2026') != \
+        ResultCache.make_key(make_job(template), '18.10.2026')
+
+
+def test_key_changes_with_template_version(template):
+    key = ResultCache.make_key(make_job(template), '17.10.2026')
+    stat = os.stat(template)
+    os.utime(template, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    assert ResultCache.make_key(make_job(template), '17.10.2026') != key
+
+
+def test_missing_template_is_not_cached(tmp_path):
+    job = make_job(str(tmp_path / 'missing.pdf'))
+    assert ResultCache.make_key(job, '17.10.2026') is None
+    cache = ResultCache()
+    cache.put(None, b'image')
+    assert len(cache) == 0
+    assert cache.get(None) is None
+
+
+def test_uploaded_result_keeps_only_file_id(template):
+    cache = ResultCache()
+    key = ResultCache.make_key(make_job(template), '17.10.2026')
+    cache.put(key, b'x' * 1000, serial_number='123456 - 1234567')
+    cache.put(key, file_id='photo-1', serial_number='123456 - 1234567')
+    cached = cache.get(key)
+    assert cached.content is None
+    assert cached.file_id == 'photo-1'
+    assert cache.total_bytes == 256
@@ -0,0 +1,71 @@
+import os
+import stat
+
+import pytest
+
+from shared_templates import SharedTemplateStore
+
+IDENTITY = "('/srv/templates/driver_1.pdf', 'Helvetica', None, 10)"
+
+
+@pytest.fixture
+def store(tmp_path):
+    return SharedTemplateStore(str(tmp_path / 'shared'))
+
+
+def test_published_template_is_loaded_by_other_process(store):
+    published = store.publish(IDENTITY, 100, b'%PDF-1.4 compiled', {'plan': [['odometr', 0]]})
+    # Другой процесс хоста - свое хранилище на тот же каталог
+    loaded = SharedTemplateStore(store.directory).load(IDENTITY, 100)
+    assert loaded.path == published.path
+    assert loaded.data[:] == b'%PDF-1.4 compiled'
+    assert loaded.meta == {'plan': [['odometr', 0]]}
+    assert stat.S_IMODE(os.stat(loaded.path).st_mode) == 0o644
+
+
+def test_missing_or_incomplete_template_is_not_loaded(store):
+    assert store.load(IDENTITY, 100) is None
+    pdf_path, _ = store._paths(IDENTITY, 100)
+    with open(pdf_path, 'wb') as f:
+        f.write(b'%PDF-1.4')
+    # PDF без плана - публикация не закончена
+    assert store.load(IDENTITY, 100) is None
+
+
+def test_first_publication_wins(store):
+    store.publish(IDENTITY, 100, b'first', {'n': 1})
+    second = store.publish(IDENTITY, 100, b'second', {'n': 2})
+    assert second.data[:] == b'first'
+    assert store.load(IDENTITY, 100).meta == {'n': 1}
+    assert not [name for name in os.listdir(store.directory) if name.endswith('.tmp')]
+
+
+def test_new_version_removes_stale_files_of_same_template(store):
+    old = store.publish(IDENTITY, 100, b'old', {})
+    other = store.publish('other template', 100, b'other', {})
+    store.publish(IDENTITY, 200, b'new', {})
+    assert store.load(IDENTITY, 100) is None
+    assert store.load(IDENTITY, 200).data[:] == b'new'
+    assert store.load('other template', 100) is not None
+    # Уже отображенный файл остается доступен процессу, который его открыл
+    assert old.data[:] == b'old'
+    assert other.data[:] == b'other'
+
+
+def test_disk_bytes_counts_pdf_files_only(store):
+    store.publish(IDENTITY, 100, b'x' * 1000, {'plan': 'y' * 500})
+    store.publish('other template', 100, b'x' * 24, {})
+    assert store.disk_bytes() == 1024
+
+
+def test_fillers_share_one_compiled_template(tmp_path):
+    from conftest import ROOT
+    from pdf_handler import PDFFiller
+
+    template = os.path.join(ROOT, 'templates', 'driver_665996290.pdf')
+    directory = str(tmp_path / 'shared')
+    first = PDFFiller(shared_templates_dir=directory).load_template(template)
+    second = PDFFiller(shared_templates_dir=directory).load_template(template)
+    assert sorted(name.rsplit('.', 1)[1] for name in os.listdir(directory)) == ['json', 'pdf']
+    assert bytes(first.data) == bytes(second.data)
+    assert first.plan == second.plan
@@ -0,0 +1,56 @@
+import asyncio
+
+import pytest
+
+from simple_http import HttpError, build_response, read_request
+
+
+def parse(raw, max_body=1024):
+    async def scenario():
+        reader = asyncio.StreamReader()
+        reader.feed_data(raw)
+        reader.feed_eof()
+        return await read_request(reader, max_body)
+
+    return asyncio.run(scenario())
+
+
+def test_reads_request_with_body_and_query():
+    request = parse(b"POST /webhook?a=1 HTTP/1.1\r\nContent-Length: 4\r\nX-Token: s\r\n\r\n{}{}")
+    assert request.method == 'POST'
+    assert request.path == '/webhook'
+    assert request.query == {'a': '1'}
+    assert request.headers['x-token'] == 's'
+    assert request.body == b'{}{}'
+
+
+def test_closed_connection_gives_none():
+    assert parse(b'') is None
+
+
+@pytest.mark.parametrize('length', [b'abc', b'-5', b'1.5'])
+def test_invalid_content_length_is_bad_request(length):
+    with pytest.raises(HttpError) as error:
+        parse(b"POST / HTTP/1.1\r\nContent-Length: " + length + b"\r\n\r\n")
+    assert error.value.status == 400
+
+
+def test_body_over_limit_is_rejected():
+    with pytest.raises(HttpError) as error:
+        parse(b"POST / HTTP/1.1\r\nContent-Length: 2048\r\n\r\n", max_body=1024)
+    assert error.value.status == 413
+
+
+def test_malformed_request_line_is_bad_request():
+    with pytest.raises(HttpError) as error:
+        parse(b"GARBAGE\r\n\r\n")
+    assert error.value.status == 400
+
+
+def test_response_serializes_json_body():
+    response = build_response(200, {'ok': True}, keep_alive=False)
+    head, body = response.split(b'\r\n\r\n', 1)
+    assert head.startswith(b'HTTP/1.1 200 OK')
+    assert b'Content-Length: 12' in head
+    assert b'Connection: close' in head
+    assert body == b'{"ok": true}'
@@ -0,0 +1,135 @@
+import asyncio
+
+import pytest
+
+from render_jobs import SpeculativeRenders, WaybillJob, execute_prerender
+
+
+class FakePool:
+    """RenderPool без воркеров: заготовка ждет release и возвращает строку вместо Prerender"""
+
+    def __init__(self, max_workers=2, error=None):
+        self.max_workers = max_workers
+        self.pending = 0
+        self.error = error
+        self.calls = []
+        self.release = asyncio.Event()
+
+    @property
+    def idle_workers(self):
+        return max(0, self.max_workers - self.pending)
+
+    async def run(self, func, job, profile):
+        assert func is execute_prerender
+        self.calls.append(job)
+        await self.release.wait()
+        if self.error is not None:
+            raise self.error
+        return f"prerender-{job.user_id}-{job.start_time}", {'render': 0.01}, 0
+
+
+def make_job(user_id=1, start_time='08:00', odometer='12345'):
+    return WaybillJob.create(user_id, 'templates/driver_1.pdf', start_time, odometer, serial_number='111111 - 1111111')
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_prerender_is_taken_for_any_odometer():
+    async def scenario():
+        pool = FakePool()
+        renders = SpeculativeRenders(pool)
+        assert renders.start(make_job(odometer=''))
+        pool.release.set()
+        return await renders.take(make_job(odometer='54321')), len(renders)
+
+    assert asyncio.run(scenario()) == ('prerender-1-08:00', 0)
+
+
+def test_not_started_without_idle_worker():
+    async def scenario():
+        pool = FakePool(max_workers=2)
+        pool.pending = 2
+        renders = SpeculativeRenders(pool)
+        started = renders.start(make_job())
+        return started, pool.calls, await renders.take(make_job())
+
+    assert asyncio.run(scenario()) == (False, [], None)
+
+
+def test_prerender_for_other_time_is_cancelled_on_take():
+    async def scenario():
+        renders = SpeculativeRenders(FakePool())
+        renders.start(make_job(start_time='08:00'))
+        task = renders._entries['1'][1]
+        result = await renders.take(make_job(start_time='09:00'))
+        await settle()
+        return result, task.cancelled()
+
+    assert asyncio.run(scenario()) == (None, True)
+
+
+def test_cancelled_prerender_falls_back_to_scheduler():
+    async def scenario():
+        renders = SpeculativeRenders(FakePool())
+        renders.start(make_job())
+        task = renders._entries['1'][1]
+        take = asyncio.ensure_future(renders.take(make_job()))
+        await settle()
+        # Заготовку отменили (например, истек срок), пока водитель ждал лист
+        task.cancel()
+        return await take
+
+    assert asyncio.run(scenario()) is None
+
+
+def test_cancelled_take_cancels_prerender():
+    async def scenario():
+        renders = SpeculativeRenders(FakePool())
+        renders.start(make_job())
+        task = renders._entries['1'][1]
+        take = asyncio.ensure_future(renders.take(make_job()))
+        await settle()
+        take.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await take
+        await settle()
+        return task.cancelled()
+
+    assert asyncio.run(scenario()) is True
+
+
+def test_failed_prerender_gives_none():
+    async def scenario():
+        pool = FakePool(error=RuntimeError('render failed'))
+        renders = SpeculativeRenders(pool)
+        renders.start(make_job())
+        pool.release.set()
+        return await renders.take(make_job())
+
+    assert asyncio.run(scenario()) is None
+
+
+def test_oldest_prerender_is_evicted_over_limit():
+    async def scenario():
+        renders = SpeculativeRenders(FakePool(max_workers=4), max_items=2)
+        for user_id in (1, 2, 3):
+            renders.start(make_job(user_id=user_id))
+            await asyncio.sleep(0.001)
+        users = sorted(renders._entries)
+        renders.clear()
+        return users
+
+    assert asyncio.run(scenario()) == ['2', '3']
+
+
+def test_expired_prerender_is_discarded():
+    async def scenario():
+        renders = SpeculativeRenders(FakePool(), ttl=0.01)
+        renders.start(make_job())
+        await asyncio.sleep(0.05)
+        return len(renders), await renders.take(make_job())
+
+    assert asyncio.run(scenario()) == (0, None)
@@ -0,0 +1,120 @@
+import sqlite3
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import state_store
+from state_store import SQLiteStateStore, create_state_store, MemoryStateStore
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Управляемое time.time для TTL (фоновой записи остается настоящее monotonic)"""
+    clock = SimpleNamespace(now=1_700_000_000.0)
+    monkeypatch.setattr(state_store, 'time', SimpleNamespace(time=lambda: clock.now, monotonic=time.monotonic))
+    return clock
+
+
+@pytest.fixture
+def open_store(tmp_path):
+    """Открывает SQLiteStateStore во временном каталоге; фоновая запись - только по flush_batch"""
+    stores = []
+
+    def open_store(**options):
+        options.setdefault('flush_interval', 3600)
+        store = SQLiteStateStore(str(tmp_path / 'state.sqlite3'), **options)
+        stores.append(store)
+        return store
+
+    yield open_store
+    for store in stores:
+        store.close()
+
+
+def stored_rows(tmp_path):
+    db = sqlite3.connect(str(tmp_path / 'state.sqlite3'))
+    try:
+        return dict(db.execute("SELECT user_id, state FROM dialog_state").fetchall())
+    finally:
+        db.close()
+
+
+def test_put_is_written_only_on_flush(open_store, tmp_path):
+    store = open_store()
+    store.put(1, {'step': 'waiting_time'})
+    assert stored_rows(tmp_path) == {}
+    assert store.flush() == 1
+    assert stored_rows(tmp_path) == {'1': '{"step": "waiting_time"}'}
+    assert store.flush() == 0
+
+
+def test_state_survives_reopen(open_store):
+    store = open_store()
+    store.put(1, {'step': 'waiting_odometer', 'start_time': '08:00'})
+    store.close()
+    assert open_store().get(1) == {'step': 'waiting_odometer', 'start_time': '08:00'}
+
+
+def test_batch_of_changes_is_flushed_in_background(open_store, tmp_path):
+    store = open_store(flush_batch=2)
+    store.put(1, {'step': 'waiting_time'})
+    store.put(2, {'step': 'waiting_time'})
+    deadline = time.monotonic() + 5
+    while len(stored_rows(tmp_path)) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert set(stored_rows(tmp_path)) == {'1', '2'}
+
+
+def test_state_evicted_from_memory_before_flush_is_not_lost(open_store):
+    store = open_store(max_items=1)
+    store.put(1, {'step': 'waiting_odometer'})
+    store.put(2, {'step': 'waiting_time'})
+    assert len(store) == 1
+    assert store.get(1) == {'step': 'waiting_odometer'}
+
+
+def test_pending_delete_hides_stored_state(open_store, tmp_path):
+    store = open_store()
+    store.put(1, {'step': 'waiting_time'})
+    store.flush()
+    store.delete(1)
+    assert store.get(1) is None
+    store.flush()
+    assert stored_rows(tmp_path) == {}
+
+
+def test_state_expires_after_ttl(open_store, clock):
+    store = open_store(ttl=60)
+    store.put(1, {'step': 'waiting_time'})
+    clock.now += 60
+    assert store.get(1) == {'step': 'waiting_time'}
+    clock.now += 1
+    assert store.get(1) is None
+
+
+def test_expire_removes_stale_rows_from_database(open_store, tmp_path, clock):
+    store = open_store(ttl=60)
+    store.put(1, {'step': 'waiting_time'})
+    store.flush()
+    clock.now += 30
+    store.put(2, {'step': 'waiting_time'})
+    store.flush()
+    clock.now += 40
+    assert store.expire() == 1
+    assert set(stored_rows(tmp_path)) == {'2'}
+
+
+def test_expired_row_is_not_loaded_after_reopen(open_store, clock):
+    store = open_store(ttl=60)
+    store.put(1, {'step': 'waiting_time'})
+    store.close()
+    clock.now += 61
+    assert open_store(ttl=60).get(1) is None
+
+
+def test_create_state_store_memory_ignores_sqlite_options():
+    store = create_state_store('memory', path='unused.sqlite3', flush_interval=1, flush_batch=10, ttl=None)
+    assert isinstance(store, MemoryStateStore)
+    with pytest.raises(ValueError):
+        create_state_store('redis')
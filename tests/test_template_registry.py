@@ -0,0 +1,85 @@
+import os
+import shutil
+
+import pytest
+
+from template_registry import TemplateRegistry
+
+
+def add_template(directory, telegram_id, data=b'%PDF-1.4', mtime_ns=None):
+    directory.mkdir(parents=True, exist_ok=True)
+    path = directory / f'driver_{telegram_id}.pdf'
+    path.write_bytes(data)
+    if mtime_ns is not None:
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+    return path
+
+
+@pytest.fixture
+def registry(tmp_path):
+    return TemplateRegistry(str(tmp_path), max_depth=2, watch='off')
+
+
+def test_scan_finds_templates_in_shards_up_to_max_depth(tmp_path, registry):
+    add_template(tmp_path, 1)
+    add_template(tmp_path / '66' / '59', 665996290)
+    add_template(tmp_path / 'a' / 'b' / 'c', 3)  # глубже max_depth
+    (tmp_path / 'notes.pdf').write_bytes(b'')
+    assert registry.scan() == 2
+    assert registry.get(665996290).path == str(tmp_path / '66' / '59' / 'driver_665996290.pdf')
+    assert '1' in registry and 3 not in registry
+
+
+def test_refresh_picks_up_added_and_removed_templates(tmp_path, registry):
+    first = add_template(tmp_path / '11', 1)
+    registry.scan()
+    assert registry.refresh() is False
+    add_template(tmp_path / '22', 2)
+    first.unlink()
+    assert registry.refresh() is True
+    assert sorted(info.telegram_id for info in registry) == ['2']
+
+
+def test_removed_shard_drops_its_templates(tmp_path, registry):
+    add_template(tmp_path / '11', 1)
+    add_template(tmp_path / '22', 2)
+    registry.scan()
+    shutil.rmtree(tmp_path / '22')
+    assert registry.refresh() is True
+    assert 2 not in registry and 1 in registry
+
+
+def test_full_refresh_sees_file_rewritten_in_place(tmp_path, registry):
+    path = add_template(tmp_path, 1, b'%PDF-1.4', mtime_ns=1_000_000_000)
+    registry.scan()
+    directory_stat = os.stat(tmp_path)
+    path.write_bytes(b'%PDF-1.4 new')
+    # Перезапись на месте не меняет mtime папки - заметит только полная проверка
+    os.utime(tmp_path, ns=(directory_stat.st_atime_ns, directory_stat.st_mtime_ns))
+    assert registry.refresh() is False
+    assert registry.refresh(full=True) is True
+    assert registry.get(1).size == len(b'%PDF-1.4 new')
+
+
+def test_newer_duplicate_wins(tmp_path, registry):
+    add_template(tmp_path / '11', 1, mtime_ns=1_000_000_000)
+    newer = add_template(tmp_path / '22', 1, mtime_ns=2_000_000_000)
+    registry.scan()
+    assert registry.get(1).path == str(newer)
+
+
+def test_index_is_swapped_not_mutated(tmp_path, registry):
+    add_template(tmp_path / '11', 1)
+    registry.scan()
+    snapshot = registry._index
+    add_template(tmp_path / '22', 2)
+    registry.refresh()
+    # Читатель, взявший старый индекс, видит его целиком и без изменений
+    assert list(snapshot) == ['1']
+    assert registry._index is not snapshot
+    assert len(registry) == 2
+
+
+def test_unknown_watch_mode_is_rejected(tmp_path):
+    with pytest.raises(ValueError):
+        TemplateRegistry(str(tmp_path), watch='fanotify')
@@ -0,0 +1,92 @@
+import asyncio
+import os
+from types import SimpleNamespace
+
+import pytest
+
+from conftest import ROOT
+from image_profiles import get_profile
+from pdf_handler import PDFFiller
+from warmup import (ProfileCheck, TemplateCheck, _chunks, collect_template_paths, warm_up, warmup_job)
+
+DRIVER_PDF = os.path.join(ROOT, 'templates', 'driver_665996290.pdf')
+
+
+class InlinePool:
+    """RenderPool, который выполняет задание сразу в текущем потоке"""
+
+    def __init__(self, max_workers=2, delay=0):
+        self.max_workers = max_workers
+        self.delay = delay
+        self.calls = []
+
+    async def run(self, func, paths, options, profiles):
+        self.calls.append((list(paths), [profile.name for profile in profiles]))
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        return func(paths, options, profiles)
+
+
+@pytest.fixture
+def broken_pdf(tmp_path):
+    path = tmp_path / 'driver_1.pdf'
+    path.write_bytes(b'not a pdf')
+    return str(path)
+
+
+def test_warmup_job_checks_templates_and_renders_profiles(broken_pdf):
+    templates, profiles = warmup_job([broken_pdf, DRIVER_PDF], profiles=[get_profile('fast')])
+    assert templates[0].path == broken_pdf and templates[0].error
+    assert templates[1] == TemplateCheck(DRIVER_PDF, templates[1].fields, None)
+    assert templates[1].fields > 0
+    assert profiles[0].profile == 'fast' and profiles[0].error is None and profiles[0].size > 0
+
+
+def test_profiles_fail_without_valid_template(broken_pdf):
+    _, profiles = warmup_job([broken_pdf], profiles=[get_profile('fast')])
+    assert profiles == [ProfileCheck('fast', None, None, "нет исправных шаблонов")]
+
+
+def test_chunks_split_paths_evenly():
+    assert _chunks(list(range(5)), 2) == [[0, 2, 4], [1, 3]]
+    assert _chunks([1], 4) == [[1]]
+    assert _chunks([], 3) == [[]]
+
+
+class Records:
+    base_dir = 'templates/base'
+
+    def __iter__(self):
+        return iter([SimpleNamespace(base='b.pdf'), SimpleNamespace(base='a.pdf'), SimpleNamespace(base='a.pdf')])
+
+
+def test_collect_template_paths_includes_record_bases():
+    registry = [SimpleNamespace(path='templates/driver_1.pdf')]
+    assert collect_template_paths(registry, Records()) == [
+        'templates/driver_1.pdf', os.path.join('templates/base', 'a.pdf'), os.path.join('templates/base', 'b.pdf')]
+
+
+def test_warm_up_profiles_only_first_wave(broken_pdf):
+    pool = InlinePool(max_workers=1)
+    filler = PDFFiller(render_mode='overlay')
+    report = asyncio.run(warm_up(pool, filler, [DRIVER_PDF, broken_pdf], [get_profile('fast')]))
+    assert [check.path for check in report.templates] == [DRIVER_PDF, broken_pdf]
+    assert [check.error is None for check in report.templates] == [True, False]
+    assert [check.profile for check in report.profiles] == ['fast']
+    assert pool.calls == [([DRIVER_PDF, broken_pdf], ['fast'])]
+
+
+def test_warm_up_gives_up_after_timeout():
+    pool = InlinePool(max_workers=1, delay=1)
+    report = asyncio.run(warm_up(pool, PDFFiller(), [DRIVER_PDF], [], timeout=0.05))
+    assert report.templates == [] and report.profiles == []
+
+
+def test_pool_error_marks_chunk_templates():
+    class FailingPool(InlinePool):
+        async def run(self, func, paths, options, profiles):
+            raise RuntimeError("воркер упал")
+
+    report = asyncio.run(warm_up(FailingPool(max_workers=1), PDFFiller(), [DRIVER_PDF], [get_profile('fast')]))
+    assert report.templates == [TemplateCheck(DRIVER_PDF, 0, "RuntimeError: воркер упал")]
+    assert report.profiles == [ProfileCheck('fast', None, None, "RuntimeError: воркер упал")]
@@ -0,0 +1,80 @@
+import hashlib
+import sqlite3
+
+import pytest
+
+from waybill_archive import ArchivePdf, SerialAllocationError, WaybillArchive
+
+BASE_PDF = b'%PDF-1.7\n' + b'template ' * 100
+FIELDS = {'start_date': '17.10.2026', 'start_time': '08:00', 'odometr': '12345'}
+
+
+@pytest.fixture
+def archive(tmp_path):
+    archive = WaybillArchive(str(tmp_path / 'waybills.sqlite3'), max_attempts=3)
+    yield archive
+    archive.close()
+
+
+def add_waybill(archive, serial, telegram_id=1, fields=FIELDS, update=b'\nupdate'):
+    archive.add(serial, telegram_id, 'templates/driver_1.pdf', fields, BASE_PDF, update)
+
+
+def test_allocate_serial_skips_serials_already_issued(archive):
+    candidates = iter(['111111 - 1111111', '111111 - 1111111', '222222 - 2222222'])
+    assert archive.allocate_serial(1, lambda: next(candidates)) == '111111 - 1111111'
+    assert archive.allocate_serial(2, lambda: next(candidates)) == '222222 - 2222222'
+
+
+def test_allocate_serial_gives_up_after_max_attempts(archive):
+    archive.allocate_serial(1, lambda: '111111 - 1111111')
+    with pytest.raises(SerialAllocationError):
+        archive.allocate_serial(2, lambda: '111111 - 1111111')
+
+
+def test_pdf_is_stored_as_shared_base_and_update(archive):
+    add_waybill(archive, '111111 - 1111111', update=b'\nupdate 1')
+    add_waybill(archive, '222222 - 2222222', update=b'\nupdate 2')
+    assert archive.get_pdf('111111 - 1111111') == BASE_PDF + b'\nupdate 1'
+    assert archive.get_pdf('222222 - 2222222') == BASE_PDF + b'\nupdate 2'
+    assert archive._db.execute("SELECT COUNT(*) FROM pdf_bases").fetchone()[0] == 1
+    assert archive.get_pdf('333333 - 3333333') is None
+
+
+def test_record_keeps_fields_and_shift_date(archive):
+    add_waybill(archive, '111111 - 1111111', telegram_id=42)
+    archive.set_file_id('111111 - 1111111', 'doc-1', 'document')
+    record = archive.get('111111 - 1111111')
+    assert record.telegram_id == '42'
+    assert record.shift_date == '2026-10-17'
+    assert record.fields == FIELDS
+    assert (record.file_id, record.file_kind) == ('doc-1', 'document')
+    assert [item.serial for item in archive.by_date('2026-10-17', telegram_id=42)] == ['111111 - 1111111']
+    assert archive.history(7) == []
+
+
+def test_add_pdf_without_base_bytes_needs_known_base(archive):
+    digest = hashlib.sha256(BASE_PDF).hexdigest()
+    with pytest.raises(KeyError):
+        archive.add_pdf('111111 - 1111111', 1, 'templates/driver_1.pdf', ArchivePdf(FIELDS, digest, None, b'\nu'))
+    archive.add_pdf('111111 - 1111111', 1, 'templates/driver_1.pdf', ArchivePdf(FIELDS, digest, BASE_PDF, b'\nu'))
+    archive.add_pdf('222222 - 2222222', 1, 'templates/driver_1.pdf', ArchivePdf(FIELDS, digest, None, b'\nv'))
+    assert archive.get_pdf('222222 - 2222222') == BASE_PDF + b'\nv'
+
+
+def test_serial_cannot_be_archived_twice(archive):
+    add_waybill(archive, '111111 - 1111111')
+    with pytest.raises(sqlite3.IntegrityError):
+        add_waybill(archive, '111111 - 1111111')
+
+
+@pytest.mark.parametrize('statement', [
+    "UPDATE waybills SET telegram_id = '2'",
+    "DELETE FROM waybills",
+])
+def test_issued_waybills_are_append_only(archive, statement):
+    add_waybill(archive, '111111 - 1111111')
+    with pytest.raises(sqlite3.DatabaseError, match='только для добавления'):
+        archive._db.execute(statement)
+    assert len(archive) == 1
+    assert archive.get('111111 - 1111111').telegram_id == '1'
@@ -0,0 +1,61 @@
+import io
+import os
+
+import fitz
+import pytest
+from PIL import Image
+
+from conftest import ROOT
+from pdf_handler import PDFFiller, WaybillPdf
+
+DRIVER_PDF = os.path.join(ROOT, 'templates', 'driver_665996290.pdf')
+SERIAL = '123456 - 7654321'
+
+
+def page_text(pdf_bytes):
+    with fitz.open(stream=pdf_bytes, filetype='pdf') as document:
+        return ''.join(page.get_text() for page in document), sum(len(list(page.widgets())) for page in document)
+
+
+@pytest.fixture
+def filler():
+    return PDFFiller()
+
+
+def test_pdf_has_values_and_no_form_fields(filler):
+    result = filler.render_waybill_pdf('08:00', '12345', template_path=DRIVER_PDF, serial_number=SERIAL)
+    assert isinstance(result, WaybillPdf)
+    text, widgets = page_text(result.pdf_bytes)
+    assert '12345' in text and SERIAL in text
+    assert widgets == 0
+
+
+def test_thumbnail_fits_telegram_limit(filler):
+    thumbnail = filler.render_waybill_pdf('08:00', '1', template_path=DRIVER_PDF).thumbnail
+    image = Image.open(io.BytesIO(thumbnail))
+    assert image.format == 'JPEG'
+    assert max(image.size) <= 320
+
+
+def test_thumbnail_can_be_disabled():
+    filler = PDFFiller(pdf_thumbnail_size=None)
+    assert filler.render_waybill_pdf('08:00', '1', template_path=DRIVER_PDF).thumbnail is None
+
+
+def test_pdf_without_template_raises(filler):
+    with pytest.raises(ValueError):
+        filler.render_waybill_pdf('08:00', '1')
+
+
+def test_update_on_shared_base_restores_full_pdf(filler):
+    values = filler.build_field_values('08:00', '12345', serial_number=SERIAL)
+    base, update = filler.build_pdf_update(values, DRIVER_PDF)
+    other_base, other_update = filler.build_pdf_update(
+        filler.build_field_values('09:00', '54321', serial_number=SERIAL), DRIVER_PDF)
+    # Шаблон общий для всех листов водителя, отличается только обновление
+    assert bytes(base) == bytes(other_base)
+    assert update != other_update
+    assert len(update) < len(base) / 10
+    text, widgets = page_text(bytes(base) + update)
+    assert '12345' in text and SERIAL in text
+    assert widgets == 0
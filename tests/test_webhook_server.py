@@ -0,0 +1,93 @@
+import asyncio
+import json
+
+import pytest
+
+from simple_http import HttpError, HttpRequest
+from webhook_server import WebhookServer, extract_user_id, route_update, split_render_workers
+
+
+class FakeQueue:
+    def __init__(self):
+        self.items = []
+
+    def put(self, item):
+        self.items.append(item)
+
+
+def message_update(user_id, update_id=1):
+    return {'update_id': update_id, 'message': {'message_id': 1, 'from': {'id': user_id}, 'text': '08:00'}}
+
+
+@pytest.fixture
+def server():
+    server = WebhookServer('123456:TEST', workers=3, secret_token='secret')
+    server._queues = [FakeQueue() for _ in range(3)]
+    return server
+
+
+def post(server, body, token='secret', path='/webhook'):
+    headers = {'x-telegram-bot-api-secret-token': token} if token is not None else {}
+    request = HttpRequest('POST', path, {}, headers, json.dumps(body).encode() if not isinstance(body, bytes) else body)
+    return asyncio.run(server.handle(request))
+
+
+def test_extract_user_id_from_message_and_callback():
+    assert extract_user_id(message_update(42)) == 42
+    assert extract_user_id({'update_id': 1, 'callback_query': {'from': {'id': 7}}}) == 7
+    assert extract_user_id({'update_id': 1, 'poll': {'id': 'x'}}) is None
+
+
+def test_updates_of_one_driver_go_to_one_worker():
+    workers = {route_update(message_update(665996290, update_id), 3) for update_id in range(10)}
+    assert workers == {665996290 % 3}
+
+
+def test_update_without_user_is_routed_by_update_id():
+    assert route_update({'update_id': 7, 'poll': {}}, 3) == 1
+
+
+def test_render_workers_are_split_between_bot_processes():
+    assert split_render_workers(8, 3) == 2
+    assert split_render_workers(2, 4) == 1
+
+
+def test_update_is_queued_to_its_worker(server):
+    assert post(server, message_update(5)) == (200, {})
+    assert [len(queue.items) for queue in server._queues] == [0, 0, 1]
+    assert server.received == 1
+
+
+@pytest.mark.parametrize('token, body, status', [
+    ('wrong', {'update_id': 1}, 403),
+    (None, {'update_id': 1}, 403),
+    ('secret', b'not json', 400),
+    ('secret', [1, 2], 400),
+])
+def test_rejected_requests(server, token, body, status):
+    with pytest.raises(HttpError) as error:
+        post(server, body, token=token)
+    assert error.value.status == status
+    assert not any(queue.items for queue in server._queues)
+
+
+def test_unknown_path_and_method(server):
+    with pytest.raises(HttpError) as error:
+        post(server, {}, path='/other')
+    assert error.value.status == 404
+    request = HttpRequest('GET', '/webhook', {}, {}, b'')
+    with pytest.raises(HttpError) as error:
+        asyncio.run(server.handle(request))
+    assert error.value.status == 405
+
+
+def test_draining_server_asks_telegram_to_retry(server):
+    server._draining = True
+    with pytest.raises(HttpError) as error:
+        post(server, message_update(5))
+    assert error.value.status == 503
+
+
+def test_not_ready_until_workers_are_warm(server):
+    request = HttpRequest('GET', '/ready', {}, {}, b'')
+    assert asyncio.run(server.handle(request)) == (503, {'ready': False})
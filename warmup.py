@@ -0,0 +1,171 @@
+"""
+Прогрев бота при запуске: шаблоны и пробный рендер до приема первых водителей
+
+После перезапуска первый запрос каждого воркера платит за холодный старт: импорт и
+инициализацию PyMuPDF и Pillow, первые шрифты, разбор шаблона. Прогрев делает это заранее:
+все шаблоны компилируются (и тем самым проверяются) параллельно в пуле воркеров,
+а каждым профилем изображения выполняется один пробный рендер.
+"""
+import asyncio
+import logging
+import os
+import time
+from collections import namedtuple
+from render_pool import get_worker_filler
+
+logger = logging.getLogger(__name__)
+
+# Проверка шаблона: fields - полей для заполнения, error - текст ошибки (None - шаблон исправен)
+TemplateCheck = namedtuple('TemplateCheck', ['path', 'fields', 'error'])
+
+# Пробный рендер профилем: время в мс, размер результата, error - текст ошибки
+ProfileCheck = namedtuple('ProfileCheck', ['profile', 'render_ms', 'size', 'error'])
+
+# Итог прогрева
+WarmupReport = namedtuple('WarmupReport', ['elapsed_s', 'templates', 'profiles'])
+
+WARMUP_START_TIME = '08:00'
+WARMUP_ODOMETER = '0'
+MAX_LOGGED_ERRORS = 20
+
+
+def _describe_error(e):
+    return f"{type(e).__name__}: {e}"
+
+
+def warmup_job(template_paths, filler_options=None, profiles=()):
+    """
+    Прогрев воркера пула: компиляция шаблонов и по одному пробному рендеру каждым профилем
+
+    Args:
+        template_paths: Шаблоны для компиляции и проверки
+        filler_options: Параметры PDFFiller (PDFFiller.get_options())
+        profiles: Профили для пробного рендера (рендерится первый исправный шаблон)
+
+    Returns:
+        tuple: (список TemplateCheck, список ProfileCheck)
+    """
+    filler = get_worker_filler(filler_options)
+    templates = []
+    for path in template_paths:
+        try:
+            entry = filler.load_template(path)
+        except Exception as e:
+            templates.append(TemplateCheck(path, 0, _describe_error(e)))
+            continue
+        if not entry.plan:
+            templates.append(TemplateCheck(path, 0, "нет полей для заполнения"))
+        else:
+            templates.append(TemplateCheck(path, len(entry.plan), None))
+
+    sample_path = next((check.path for check in templates if check.error is None), None)
+    checks = []
+    for profile in profiles:
+        name = getattr(profile, 'name', profile)
+        if sample_path is None:
+            checks.append(ProfileCheck(name, None, None, "нет исправных шаблонов"))
+            continue
+        started = time.perf_counter()
+        try:
+            image_bytes = filler.render_waybill(WARMUP_START_TIME, WARMUP_ODOMETER, template_path=sample_path,
+                                                profile=profile)
+        except Exception as e:
+            checks.append(ProfileCheck(name, None, None, _describe_error(e)))
+            continue
+        checks.append(ProfileCheck(name, round((time.perf_counter() - started) * 1000, 1), len(image_bytes), None))
+    return templates, checks
+
+
+def collect_template_paths(template_registry=None, driver_records=None):
+    """Все шаблоны для прогрева: driver_*.pdf из индекса и базовые шаблоны записей водителей"""
+    paths = []
+    if template_registry is not None:
+        paths.extend(info.path for info in template_registry)
+    if driver_records is not None:
+        bases = {os.path.join(driver_records.base_dir, record.base) for record in driver_records}
+        paths.extend(sorted(bases))
+    return paths
+
+
+def _chunks(items, count):
+    """Делит список на count частей примерно поровну"""
+    count = max(1, min(count, len(items)))
+    return [items[index::count] for index in range(count)]
+
+
+async def warm_up(pool, filler, template_paths, profiles, timeout=None):
+    """
+    Прогревает воркеры пула и PDFFiller основного процесса
+
+    Шаблоны делятся между воркерами; первая волна заданий идет одновременно, по одному
+    заданию на воркер, и в каждом задании - пробный рендер всеми профилями.
+
+    Args:
+        pool: RenderPool
+        filler: PDFFiller основного процесса (его параметры передаются воркерам)
+        template_paths: Шаблоны для проверки (см. collect_template_paths)
+        profiles: Профили изображения для пробного рендера
+        timeout: Ограничение времени прогрева в секундах (None - без ограничения)
+
+    Returns:
+        WarmupReport
+    """
+    started = time.perf_counter()
+    options = filler.get_options()
+    # Мелкие порции: таймаут одного задания пула рассчитан на один путевой лист
+    chunks = _chunks(list(template_paths), max(pool.max_workers, len(template_paths) // 50))
+    semaphore = asyncio.Semaphore(pool.max_workers)
+
+    async def run_chunk(index, paths):
+        async with semaphore:
+            chunk_profiles = profiles if index < pool.max_workers else ()
+            try:
+                return await pool.run(warmup_job, paths, options, chunk_profiles)
+            except Exception as e:
+                error = _describe_error(e)
+                return ([TemplateCheck(path, 0, error) for path in paths],
+                        [ProfileCheck(getattr(profile, 'name', profile), None, None, error)
+                         for profile in chunk_profiles])
+
+    jobs = [run_chunk(index, paths) for index, paths in enumerate(chunks)]
+    templates, profile_checks = [], []
+    try:
+        for chunk_templates, chunk_profiles in await asyncio.wait_for(asyncio.gather(*jobs), timeout):
+            templates.extend(chunk_templates)
+            profile_checks.extend(chunk_profiles)
+    except asyncio.TimeoutError:
+        logger.warning(f"Прогрев не уложился в {timeout} с - бот запускается без полного прогрева")
+
+    # Основной процесс тоже рендерит: дописывает заготовки (шрифты и кодировщики)
+    sample_path = next((check.path for check in templates if check.error is None), None)
+    if sample_path is not None:
+        try:
+            await asyncio.to_thread(filler.render_waybill, WARMUP_START_TIME, WARMUP_ODOMETER,
+                                    template_path=sample_path)
+        except Exception as e:
+            logger.warning(f"Пробный рендер в основном процессе не удался: {_describe_error(e)}")
+
+    report = WarmupReport(round(time.perf_counter() - started, 2), templates, profile_checks)
+    log_report(report)
+    return report
+
+
+def log_report(report):
+    """Итог прогрева в лог: время, неисправные шаблоны и профили"""
+    broken = [check for check in report.templates if check.error]
+    for check in broken[:MAX_LOGGED_ERRORS]:
+        logger.warning(f"Неисправный шаблон {check.path}: {check.error}")
+    if len(broken) > MAX_LOGGED_ERRORS:
+        logger.warning(f"...и еще неисправных шаблонов: {len(broken) - MAX_LOGGED_ERRORS}")
+
+    profiles = {}
+    for check in report.profiles:
+        if check.error:
+            logger.warning(f"Пробный рендер профилем '{check.profile}' не удался: {check.error}")
+        elif check.profile not in profiles or check.render_ms < profiles[check.profile]:
+            profiles[check.profile] = check.render_ms
+    rendered = ', '.join(f"{name} {render_ms} мс" for name, render_ms in sorted(profiles.items()))
+    logger.info(
+        f"Прогрев завершен за {report.elapsed_s} с: шаблонов {len(report.templates)}, "
+        f"неисправных {len(broken)}; пробный рендер: {rendered or 'нет'}"
+    )
@@ -0,0 +1,229 @@
+"""
+Архив выданных путевых листов
+
+Только добавление: каждый выданный лист хранится со сжатым PDF и значениями полей,
+с индексами по номеру, водителю и дате смены. Номер выделяется до рендера и резервируется
+в таблице serials с уникальным ключом, поэтому два листа с одним номером выдать нельзя.
+
+PDF листа - общий шаблон (хранится один раз, по SHA-256) + инкрементальное обновление
+с впечатанными значениями (см. PDFFiller.build_pdf_update): несколько килобайт на лист вместо
+полной копии шаблона с изображениями.
+"""
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+import zlib
+from collections import namedtuple
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# PDF листа для архива, собранный в воркере пула: fields - значения полей, base_sha256 - SHA-256 шаблона,
+# base_pdf - байты шаблона (None, если архив уже хранит шаблон base_sha256), pdf_update - обновление
+ArchivePdf = namedtuple('ArchivePdf', ['fields', 'base_sha256', 'base_pdf', 'pdf_update'])
+
+# Запись архива без PDF (PDF - через get_pdf); file_id - фото или документ в Telegram, если лист был
+# загружен, file_kind - 'photo' или 'document'
+ArchivedWaybill = namedtuple('ArchivedWaybill', ['serial', 'telegram_id', 'shift_date', 'created_at',
+                                                 'template_path', 'fields', 'file_id', 'file_kind'])
+
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS serials ("
+    "serial TEXT PRIMARY KEY, telegram_id TEXT NOT NULL, allocated_at REAL NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS pdf_bases (sha256 TEXT PRIMARY KEY, data BLOB NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS waybills ("
+    "serial TEXT PRIMARY KEY REFERENCES serials(serial), telegram_id TEXT NOT NULL, shift_date TEXT NOT NULL, "
+    "created_at REAL NOT NULL, template_path TEXT NOT NULL, fields TEXT NOT NULL, "
+    "pdf_base TEXT NOT NULL REFERENCES pdf_bases(sha256), pdf_update BLOB NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS waybills_driver ON waybills (telegram_id, created_at)",
+    "CREATE INDEX IF NOT EXISTS waybills_date ON waybills (shift_date)",
+    "CREATE TABLE IF NOT EXISTS waybill_files (serial TEXT PRIMARY KEY REFERENCES waybills(serial), "
+    "file_id TEXT NOT NULL, kind TEXT NOT NULL DEFAULT 'photo')",
+    # Выданный лист не меняется и не удаляется
+    "CREATE TRIGGER IF NOT EXISTS waybills_no_update BEFORE UPDATE ON waybills "
+    "BEGIN SELECT RAISE(ABORT, 'архив путевых листов только для добавления'); END",
+    "CREATE TRIGGER IF NOT EXISTS waybills_no_delete BEFORE DELETE ON waybills "
+    "BEGIN SELECT RAISE(ABORT, 'архив путевых листов только для добавления'); END",
+)
+
+_SELECT = (
+    "SELECT w.serial, w.telegram_id, w.shift_date, w.created_at, w.template_path, w.fields, f.file_id, f.kind "
+    "FROM waybills w LEFT JOIN waybill_files f ON f.serial = w.serial "
+)
+
+
+class SerialAllocationError(Exception):
+    """Не удалось подобрать свободный номер путевого листа"""
+
+
+def shift_date_iso(start_date):
+    """ДД.ММ.ГГГГ → ГГГГ-ММ-ДД (для индекса по дате и выборок по диапазону)"""
+    return datetime.strptime(start_date, '%d.%m.%Y').date().isoformat()
+
+
+class WaybillArchive:
+    def __init__(self, path='waybills.sqlite3', max_attempts=20, compress_level=6):
+        """
+        Args:
+            path: Путь к файлу базы SQLite
+            max_attempts: Сколько раз перевыбирать номер при совпадении
+            compress_level: Уровень сжатия zlib для PDF
+        """
+        self.path = path
+        self.max_attempts = max_attempts
+        self.compress_level = compress_level
+        self._lock = threading.Lock()
+        self._known_bases = set()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        for statement in SCHEMA:
+            self._db.execute(statement)
+        # Архивы до отправки документом: file_id были только у фото
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(waybill_files)")}
+        if 'kind' not in columns:
+            self._db.execute("ALTER TABLE waybill_files ADD COLUMN kind TEXT NOT NULL DEFAULT 'photo'")
+        logger.info(f"Архив путевых листов: {path} ({len(self)} шт.)")
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM waybills").fetchone()[0]
+
+    def allocate_serial(self, telegram_id, generate):
+        """
+        Выделяет номер, которого еще не было
+
+        Args:
+            telegram_id: Водитель, для которого выделен номер
+            generate: Функция () → новый номер (например PDFFiller.generate_serial_number)
+
+        Raises:
+            SerialAllocationError: если за max_attempts попыток свободный номер не найден
+        """
+        for _ in range(self.max_attempts):
+            serial = generate()
+            try:
+                with self._lock:
+                    self._db.execute(
+                        "INSERT INTO serials (serial, telegram_id, allocated_at) VALUES (?, ?, ?)",
+                        (serial, str(telegram_id), time.time())
+                    )
+            except sqlite3.IntegrityError:
+                logger.warning(f"Номер путевого листа {serial} уже выдан, выбираем другой")
+                continue
+            return serial
+        raise SerialAllocationError(f"Не найден свободный номер за {self.max_attempts} попыток")
+
+    def release_serial(self, serial):
+        """
+        Возвращает выделенный, но так и не выданный номер (лист не попал в архив)
+
+        Returns:
+            bool: True, если номер освобожден; False, если по нему уже есть лист
+        """
+        with self._lock:
+            cursor = self._db.execute(
+                "DELETE FROM serials WHERE serial = ? AND NOT EXISTS (SELECT 1 FROM waybills WHERE serial = ?)",
+                (serial, serial)
+            )
+        return cursor.rowcount > 0
+
+    def _store_base(self, base_pdf, digest=None):
+        """
+        Сохраняет шаблон, если его еще нет; возвращает SHA-256
+
+        Raises:
+            KeyError: если передан только digest (base_pdf=None), а такого шаблона в архиве нет
+        """
+        if digest is None:
+            digest = hashlib.sha256(base_pdf).hexdigest()
+        if digest in self._known_bases:
+            return digest
+        with self._lock:
+            exists = self._db.execute("SELECT 1 FROM pdf_bases WHERE sha256 = ?", (digest,)).fetchone()
+        if not exists:
+            if base_pdf is None:
+                raise KeyError(f"Шаблона {digest} нет в архиве")
+            blob = zlib.compress(base_pdf, self.compress_level)
+            with self._lock:
+                self._db.execute("INSERT OR IGNORE INTO pdf_bases (sha256, data) VALUES (?, ?)", (digest, blob))
+        self._known_bases.add(digest)
+        return digest
+
+    def add(self, serial, telegram_id, template_path, fields, base_pdf, pdf_update, base_sha256=None):
+        """
+        Добавляет выданный лист (номер должен быть выделен через allocate_serial)
+
+        Args:
+            base_pdf, pdf_update: PDF листа в виде шаблон + обновление (PDFFiller.build_pdf_update)
+            base_sha256: SHA-256 шаблона, если уже известен; тогда base_pdf может быть None,
+                         если этот шаблон уже в архиве
+        """
+        digest = self._store_base(base_pdf, base_sha256)
+        update_blob = zlib.compress(pdf_update, self.compress_level)
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO waybills (serial, telegram_id, shift_date, created_at, template_path, fields, "
+                "pdf_base, pdf_update) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (serial, str(telegram_id), shift_date_iso(fields['start_date']), time.time(), template_path,
+                 json.dumps(fields, ensure_ascii=False), digest, update_blob)
+            )
+        logger.debug("Путевой лист %s добавлен в архив: обновление PDF %d → %d байт",
+                     serial, len(pdf_update), len(update_blob))
+
+    def add_pdf(self, serial, telegram_id, template_path, archive_pdf):
+        """Добавляет выданный лист, PDF которого собран в воркере пула (ArchivePdf)"""
+        self.add(serial, telegram_id, template_path, archive_pdf.fields, archive_pdf.base_pdf,
+                 archive_pdf.pdf_update, archive_pdf.base_sha256)
+
+    def set_file_id(self, serial, file_id, kind='photo'):
+        """Запоминает file_id загруженного фото или документа (kind) - повторная отправка без загрузки"""
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO waybill_files (serial, file_id, kind) VALUES (?, ?, ?)",
+                             (serial, file_id, kind))
+
+    @staticmethod
+    def _record(row):
+        serial, telegram_id, shift_date, created_at, template_path, fields, file_id, file_kind = row
+        return ArchivedWaybill(serial, telegram_id, shift_date, created_at, template_path, json.loads(fields),
+                               file_id, file_kind)
+
+    def get(self, serial):
+        """ArchivedWaybill или None"""
+        with self._lock:
+            row = self._db.execute(_SELECT + "WHERE w.serial = ?", (serial,)).fetchone()
+        return self._record(row) if row else None
+
+    def get_pdf(self, serial):
+        """PDF выданного листа или None"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT b.data, w.pdf_update FROM waybills w JOIN pdf_bases b ON b.sha256 = w.pdf_base "
+                "WHERE w.serial = ?", (serial,)
+            ).fetchone()
+        return zlib.decompress(row[0]) + zlib.decompress(row[1]) if row else None
+
+    def history(self, telegram_id, limit=10):
+        """Последние листы водителя, новые первыми"""
+        with self._lock:
+            rows = self._db.execute(
+                _SELECT + "WHERE w.telegram_id = ? ORDER BY w.created_at DESC LIMIT ?", (str(telegram_id), limit)
+            ).fetchall()
+        return [self._record(row) for row in rows]
+
+    def by_date(self, shift_date, telegram_id=None):
+        """Листы за дату смены (ГГГГ-ММ-ДД), при необходимости - одного водителя"""
+        query, params = _SELECT + "WHERE w.shift_date = ?", [shift_date]
+        if telegram_id is not None:
+            query += " AND w.telegram_id = ?"
+            params.append(str(telegram_id))
+        with self._lock:
+            rows = self._db.execute(query + " ORDER BY w.created_at", params).fetchall()
+        return [self._record(row) for row in rows]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
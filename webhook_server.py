@@ -0,0 +1,254 @@
+"""
+Режим вебхука: один HTTP-порт и несколько процессов-воркеров бота
+
+Фронтенд принимает обновления от Telegram и раскладывает их по воркерам по user id,
+так что все сообщения водителя обрабатывает один и тот же процесс (и его состояние диалога).
+При остановке фронтенд перестает принимать обновления, а воркеры дорабатывают очередь.
+Вебхук регистрируется, когда все воркеры прогреты; GET /ready отвечает 200 только после этого.
+
+У каждого процесса бота свой пул рендера. Воркеры рендера хоста (RENDER_POOL_WORKERS, по умолчанию
+по числу ядер) делятся между процессами бота поровну: иначе процессов было бы
+процессы бота × воркеры рендера, а ограничения планировщика и заготовок действуют внутри
+одного процесса бота и вместе не сдерживали бы нагрузку.
+"""
+import asyncio
+import hmac
+import json
+import logging
+import multiprocessing
+import os
+import signal
+from simple_http import SimpleHttpServer, HttpError
+
+logger = logging.getLogger(__name__)
+
+# Типы обновлений, в которых пользователь лежит в поле 'from'
+USER_UPDATE_KEYS = (
+    'message', 'edited_message', 'callback_query', 'inline_query', 'chosen_inline_result',
+    'shipping_query', 'pre_checkout_query', 'my_chat_member', 'chat_member', 'chat_join_request',
+)
+
+
+def extract_user_id(update):
+    """Возвращает id пользователя из JSON обновления или None"""
+    for key in USER_UPDATE_KEYS:
+        payload = update.get(key)
+        if isinstance(payload, dict) and isinstance(payload.get('from'), dict):
+            return payload['from'].get('id')
+    return None
+
+
+def route_update(update, workers):
+    """Номер воркера для обновления: по user id, без пользователя - по update_id"""
+    user_id = extract_user_id(update)
+    key = user_id if user_id is not None else update.get('update_id', 0)
+    return int(key) % workers
+
+
+def split_render_workers(total, workers):
+    """Воркеров пула рендера на один процесс бота: total (None - число ядер) поровну, не меньше одного"""
+    total = total or os.cpu_count() or 1
+    return max(1, total // workers)
+
+
+def _worker_main(index, token, queue, base_url, ready_event=None, render_workers=None):
+    """Точка входа процесса-воркера"""
+    # Остановкой управляет фронтенд: Ctrl+C в терминале не должен обрывать обработку
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    logging.basicConfig(level=logging.INFO, format=f"[worker {index}] %(name)s %(levelname)s: %(message)s")
+    asyncio.run(_worker_loop(index, token, queue, base_url, ready_event, render_workers))
+
+
+async def _worker_loop(index, token, queue, base_url, ready_event=None, render_workers=None):
+    from telegram import Update
+    from bot import TaxiBot, METRICS_PORT
+
+    # У каждого воркера свои метрики - и свой порт эндпоинта
+    metrics_port = METRICS_PORT + index if METRICS_PORT is not None else None
+    bot = TaxiBot(token, base_url=base_url, updater=False, metrics_port=metrics_port,
+                  render_workers=render_workers)
+    application = bot.application
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    logger.info(f"Воркер {index} готов")
+    if ready_event is not None:
+        ready_event.set()
+
+    loop = asyncio.get_running_loop()
+    processed = 0
+    try:
+        while True:
+            data = await loop.run_in_executor(None, queue.get)
+            if data is None:
+                break
+            await application.update_queue.put(Update.de_json(data, application.bot))
+            processed += 1
+    finally:
+        # stop() дожидается обработки уже поставленных в очередь обновлений
+        await application.stop()
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+        logger.info(f"Воркер {index} остановлен, обработано обновлений: {processed}")
+
+
+class WebhookServer:
+    def __init__(self, token, host='0.0.0.0', port=8443, path='/webhook', workers=2, secret_token=None,
+                 webhook_url=None, base_url=None, drain_timeout=30, ready_path='/ready', ready_timeout=180,
+                 render_workers=None):
+        """
+        Args:
+            token: Токен бота
+            host: Адрес для прослушивания
+            port: Порт (один на все воркеры)
+            path: Путь вебхука
+            workers: Количество процессов-воркеров
+            secret_token: Секрет из заголовка X-Telegram-Bot-Api-Secret-Token (None - без проверки)
+            webhook_url: Публичный URL; если задан, регистрируется через setWebhook при запуске
+            base_url: Адрес Bot API (None - api.telegram.org), например локальная заглушка
+            drain_timeout: Сколько секунд ждать завершения воркеров при остановке
+            ready_path: Путь проверки готовности (200 - все воркеры прогреты, 503 - еще нет)
+            ready_timeout: Сколько секунд ждать прогрева воркеров перед регистрацией вебхука
+            render_workers: Воркеров пула рендера на все процессы бота вместе (None - по числу ядер)
+        """
+        self.token = token
+        self.host = host
+        self.port = port
+        self.path = path
+        self.workers = workers
+        self.secret_token = secret_token
+        self.webhook_url = webhook_url
+        self.base_url = base_url
+        self.drain_timeout = drain_timeout
+        self.ready_path = ready_path
+        self.ready_timeout = ready_timeout
+        self.render_workers = split_render_workers(render_workers, workers)
+
+        self.server = None
+        self._queues = []
+        self._processes = []
+        self._ready_events = []
+        self._draining = False
+        self._stop_event = None
+        self.received = 0
+
+    def start_workers(self):
+        """Запускает процессы-воркеры (spawn: без унаследованных потоков и соединений)"""
+        context = multiprocessing.get_context('spawn')
+        for index in range(self.workers):
+            queue = context.Queue()
+            ready_event = context.Event()
+            process = context.Process(
+                target=_worker_main,
+                args=(index, self.token, queue, self.base_url, ready_event, self.render_workers),
+                name=f"bot-worker-{index}"
+            )
+            process.start()
+            self._queues.append(queue)
+            self._ready_events.append(ready_event)
+            self._processes.append(process)
+        logger.info(f"Запущено воркеров: {self.workers}, воркеров рендера в каждом: {self.render_workers}")
+
+    @property
+    def ready(self):
+        """Все воркеры прогреты и принимают обновления"""
+        return bool(self._ready_events) and all(event.is_set() for event in self._ready_events)
+
+    async def wait_ready(self, timeout=None):
+        """Ждет прогрева всех воркеров; False - не дождались за timeout"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout if timeout is not None else None
+        for event in self._ready_events:
+            remaining = max(0.0, deadline - loop.time()) if deadline is not None else None
+            if not await loop.run_in_executor(None, event.wait, remaining):
+                return False
+        return True
+
+    async def handle(self, request):
+        """Обрабатывает POST от Telegram и передает обновление воркеру"""
+        if request.path == self.ready_path and request.method == 'GET':
+            if self.ready and not self._draining:
+                return 200, {'ready': True}
+            return 503, {'ready': False}
+        if request.path != self.path:
+            raise HttpError(404)
+        if request.method != 'POST':
+            raise HttpError(405)
+        if self.secret_token is not None:
+            received_token = request.headers.get('x-telegram-bot-api-secret-token', '')
+            if not hmac.compare_digest(received_token, self.secret_token):
+                raise HttpError(403)
+        if self._draining:
+            # Telegram повторит доставку позже - ее примет новый экземпляр
+            raise HttpError(503)
+
+        try:
+            update = json.loads(request.body)
+        except ValueError:
+            raise HttpError(400, "Некорректный JSON")
+        if not isinstance(update, dict):
+            raise HttpError(400, "Обновление должно быть объектом JSON")
+
+        self._queues[route_update(update, self.workers)].put(update)
+        self.received += 1
+        return 200, {}
+
+    async def start(self):
+        """Запускает воркеры и HTTP-сервер"""
+        self.start_workers()
+        self.server = SimpleHttpServer(self.handle, host=self.host, port=self.port)
+        await self.server.start()
+        self.port = self.server.port
+        logger.info(f"Вебхук слушает {self.server.url}{self.path}")
+
+        # Обновления, пришедшие во время прогрева, ждут в очередях воркеров
+        if await self.wait_ready(self.ready_timeout):
+            logger.info("Все воркеры прогреты")
+        else:
+            logger.warning(f"Воркеры не прогрелись за {self.ready_timeout} с")
+
+        if self.webhook_url:
+            from telegram import Bot
+            bot_kwargs = {'base_url': self.base_url} if self.base_url else {}
+            async with Bot(self.token, **bot_kwargs) as bot:
+                await bot.set_webhook(self.webhook_url, secret_token=self.secret_token)
+            logger.info(f"Вебхук зарегистрирован: {self.webhook_url}")
+
+    async def stop(self):
+        """Плавная остановка: новые обновления отклоняются, воркеры дорабатывают очередь"""
+        if self._draining:
+            return
+        self._draining = True
+        logger.info("Остановка: дорабатываем принятые обновления...")
+        for queue in self._queues:
+            queue.put(None)
+
+        loop = asyncio.get_running_loop()
+        for process in self._processes:
+            await loop.run_in_executor(None, process.join, self.drain_timeout)
+            if process.is_alive():
+                logger.warning(f"{process.name} не завершился за {self.drain_timeout} с, принудительная остановка")
+                process.terminate()
+                await loop.run_in_executor(None, process.join, 5)
+
+        if self.server is not None:
+            await self.server.stop()
+        logger.info(f"Вебхук остановлен, принято обновлений: {self.received}")
+
+    async def serve_forever(self):
+        """Работает до SIGINT/SIGTERM, затем плавно останавливается"""
+        self._stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self._stop_event.set)
+        await self.start()
+        try:
+            await self._stop_event.wait()
+        finally:
+            await self.stop()
+
+    def run(self):
+        asyncio.run(self.serve_forever())